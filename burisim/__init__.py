@@ -4,12 +4,67 @@ Simulate the buri microcomputer.
 Usage:
     burisim (-h | --help)
     burisim [options] [--serial URL] [--load FILE] <rom>
+    burisim [options] --attach SOCKET
+    burisim [options] --replay LOG
 
 Options:
     -h, --help          Show a brief usage summary.
     -q, --quiet         Decrease verbosity.
 
-    --no-gui            Don't create GUI.
+    --no-gui            Don't create GUI. Unless --serial is given, ACIA1
+                        output is shown on a terminal whose changed lines
+                        are printed.
+    --block-cache       Cache decoded ROM code rather than decoding it each
+                        time it is run.
+
+Memory options:
+    --memory-file FILE  Back machine memory with FILE so that RAM persists
+                        between runs.
+    --shared-memory NAME
+                        Back machine memory with the POSIX shared memory
+                        segment NAME so that other processes can watch it.
+
+Record/replay options:
+    --record LOG        Record external events such as serial input to LOG.
+    --replay LOG        Replay LOG as fast as possible, check that the machine
+                        behaved as it did when recording and exit.
+
+Coverage options:
+    --coverage FILE     Record which addresses are executed, read and written
+                        and add them to the coverage in FILE on exit. Works
+                        with --replay. See burisim-coverage.
+    --trace FILE        Write every instruction executed and the memory it
+                        accesses to FILE. Works with --replay. See
+                        burisim-trace.
+
+Telemetry options:
+    --metrics-log FILE  Append a sample of the simulator metrics to FILE as a
+                        line of JSON every 10 seconds.
+    --metrics-port PORT Serve the simulator metrics for Prometheus at
+                        http://127.0.0.1:PORT/metrics.
+
+Warm boot options:
+    --warm-boot UNTIL   Boot until UNTIL, either "pc=ADDR" for the program
+                        counter reaching ADDR, in hex, or "prompt=TEXT" for
+                        TEXT being sent to ACIA1, and cache the booted
+                        machine. Later runs with the same ROM, --load image
+                        and UNTIL start from the cached machine. Ignored when
+                        recording. The boot is not traced or covered.
+    --boot-cache DIR    Directory to cache booted machines in
+                        [default: ~/.cache/burisim/boot].
+    --boot-cache-size MB
+                        Remove the least recently used booted machines to
+                        keep the cache under MB megabytes [default: 64].
+
+Client/server options:
+    --serve SOCKET      Run without a GUI and serve the simulator to clients
+                        on the Unix socket SOCKET.
+    --attach SOCKET     Run the GUI attached to a simulator served on SOCKET.
+    --debug-server ADDRESS
+                        Serve breakpoints, stepping and memory and register
+                        access to debuggers on the Unix socket ADDRESS or,
+                        if ADDRESS is a number, on that TCP port of
+                        127.0.0.1. See burisim.debugserver.
 
 Hardware options:
     --serial URL        Connect ACIA1 to this serial port.
@@ -26,8 +81,10 @@ from builtins import (  # pylint: disable=redefined-builtin, unused-import
 )
 from past.builtins import basestring # pylint: disable=redefined-builtin
 
+import atexit
 import cgi
 import logging
+import os
 import signal
 import struct
 import sys
@@ -35,30 +92,82 @@ import sys
 from docopt import docopt
 from PySide import QtCore, QtGui
 
+from burisim.backing import open_file, open_shared, unlink_shared
+from burisim.bootcache import BootCache, parse_condition, warm_boot
+from burisim.client import SimClient
+from burisim.coverage import Coverage
+from burisim.debugserver import DebugServer
+from burisim.metrics import JsonLinesExporter, PrometheusExporter
+from burisim.replay import Recorder, replay
+from burisim.server import SimServer
 from burisim.sim import BuriSim
+from burisim.term import TerminalSink
+from burisim.trace import TraceWriter
 from burisim.ui import create_ui
 
 _LOGGER = logging.getLogger(__name__)
 
 def create_sim(opts):
+    # Back memory with a file or shared memory if requested. Serving requires
+    # a backing so use a private shared memory segment if none was given.
+    backing = None
+    if opts['--memory-file'] is not None:
+        backing = open_file(opts['--memory-file'])
+    elif opts['--shared-memory'] is not None:
+        backing = open_shared(opts['--shared-memory'])
+    elif opts['--serve'] is not None:
+        name = 'burisim-{0}'.format(os.getpid())
+        backing = open_shared(name)
+        atexit.register(unlink_shared, name)
+
     # Create simulator
-    sim = BuriSim()
+    sim = BuriSim(backing=backing)
+
+    # Read ROM and RAM images, keeping them to identify warm boots
+    images = []
+    with open(opts['<rom>'], 'rb') as fobj:
+        images.append((BuriSim.ROM_RANGE[0], fobj.read()))
+    sim.load_rom_bytes(images[-1][1])
 
-    # Read ROM
-    sim.load_rom(opts['<rom>'])
+    if opts['--block-cache']:
+        sim.block_cache = True
 
     if opts['--load'] is not None:
-        sim.load_ram(opts['--load'], 0x5000)
+        with open(opts['--load'], 'rb') as fobj:
+            images.append((0x5000, fobj.read()))
+        sim.load_ram_bytes(images[-1][1], 0x5000)
+
+    # Record from the first reset onwards
+    if opts['--record'] is not None:
+        start_recording(sim, opts['--record'])
 
     if opts['--serial'] is not None:
-        attach_file_to_acia(sim.acia1, opts['--serial'])
+        attach_file_to_serial(sim, opts['--serial'])
 
     # Reset the simulator
     sim.reset()
 
+    # Boot, or restore a booted machine, if requested. A warm boot would
+    # hide the boot from the recording and so is skipped.
+    if opts['--warm-boot'] is not None:
+        if opts['--record'] is not None:
+            _LOGGER.warning('not warm booting while recording')
+        else:
+            cache = BootCache(
+                os.path.expanduser(opts['--boot-cache']),
+                int(opts['--boot-cache-size']) * 1024 * 1024
+            )
+            warm_boot(sim, cache, parse_condition(opts['--warm-boot']), images)
+
+    if opts['--coverage'] is not None:
+        record_coverage(sim, opts['--coverage'])
+
+    if opts['--trace'] is not None:
+        start_tracing(sim, opts['--trace'])
+
     return sim
 
-def attach_file_to_acia(acia, filename):
+def attach_file_to_serial(sim, filename):
     sp = QtCore.QFile(filename)
     ok = sp.open(QtCore.QIODevice.ReadWrite | QtCore.QIODevice.Unbuffered)
     if not ok:
@@ -66,14 +175,90 @@ def attach_file_to_acia(acia, filename):
 
     def have_input():
         bs = sp.read(1)
-        acia.receive_byte(struct.unpack('B', bs[0])[0])
+        sim.receive_serial(struct.unpack('B', bs[0])[0])
     sn = QtCore.QSocketNotifier(sp.handle(), QtCore.QSocketNotifier.Read)
     sn.activated.connect(have_input)
 
-    acia.register_listener(sp.putChar)
+    sim.acia1.register_listener(sp.putChar)
 
     # HACK: stop sp and sn being garbage collected
-    acia._stashed_notifier = (sp, sn)
+    sim.acia1._stashed_notifier = (sp, sn)
+
+def record_coverage(sim, filename):
+    sim.coverage = Coverage()
+
+    def save_coverage():
+        # Accumulate coverage over several runs
+        coverage = sim.coverage
+        if os.path.exists(filename):
+            coverage = coverage | Coverage.load(filename)
+        coverage.save(filename)
+        _LOGGER.info('saved coverage to %s', filename)
+
+    # Save on exit, by which time the simulation thread has stopped
+    atexit.register(save_coverage)
+
+def start_tracing(sim, filename):
+    writer = TraceWriter(filename)
+    sim.trace = writer
+
+    def stop_tracing():
+        sim.trace = None
+        writer.close()
+        _LOGGER.info('traced %s instructions to %s', writer.records_written, filename)
+
+    # Finish the trace on exit, by which time the simulation thread has stopped
+    atexit.register(stop_tracing)
+
+# How often, in milliseconds, print_serial_output() prints changed lines.
+TERMINAL_POLL_INTERVAL = 500
+
+def print_serial_output(sim, app):
+    """Show the output of ACIA1 on a TerminalSink and print the lines of its
+    screen which have changed every TERMINAL_POLL_INTERVAL milliseconds and
+    on exit. Returns the sink.
+
+    """
+    sink = TerminalSink()
+    sink.attach(sim.acia1)
+
+    def print_dirty_lines():
+        for idx, line in sorted(sink.dirty_lines().items()):
+            print('{0:2d}| {1}'.format(idx, line.rstrip()))
+        sys.stdout.flush()
+
+    timer = QtCore.QTimer(app)
+    timer.timeout.connect(print_dirty_lines)
+    timer.start(TERMINAL_POLL_INTERVAL)
+    app.aboutToQuit.connect(print_dirty_lines)
+    return sink
+
+def replay_log(opts):
+    sim = BuriSim()
+    if opts['--coverage'] is not None:
+        record_coverage(sim, opts['--coverage'])
+    if opts['--trace'] is not None:
+        start_tracing(sim, opts['--trace'])
+
+    with open(opts['--replay']) as fobj:
+        result = replay(fobj, sim)
+    print('replayed {0.events} events over {0.cycles} cycles in '
+          '{0.seconds:.2f}s'.format(result))
+    for mismatch in result.mismatches:
+        print('MISMATCH: ' + mismatch)
+    return 0 if len(result.mismatches) == 0 else 1
+
+def start_recording(sim, filename):
+    fobj = open(filename, 'w')
+    sim.start_recording(Recorder(fobj))
+
+    def stop_recording():
+        recorder = sim.stop_recording()
+        fobj.close()
+        _LOGGER.info('recorded %s events to %s', recorder.events, filename)
+
+    # Finish the log on exit, by which time the simulation thread has stopped
+    atexit.register(stop_recording)
 
 def main():
     opts = docopt(__doc__)
@@ -82,6 +267,14 @@ def main():
         stream=sys.stderr, format='%(name)s: %(message)s'
     )
 
+    # Replaying needs neither an application nor a simulation thread
+    if opts['--replay'] is not None:
+        sys.exit(replay_log(opts))
+
+    # A served simulator has no GUI of its own
+    if opts['--serve'] is not None:
+        opts['--no-gui'] = True
+
     # Create GUI or non-GUI application as appropriate
     if opts['--no-gui']:
         app = QtCore.QCoreApplication(sys.argv)
@@ -94,15 +287,43 @@ def main():
         app.quit()
     signal.signal(signal.SIGINT, interrupt)
 
+    # Attaching to a served simulator only needs the UI.
+    if opts['--attach'] is not None:
+        client = SimClient(opts['--attach'])
+        app.aboutToQuit.connect(client.close)
+        ui = create_ui(client)
+        sys.exit(app.exec_())
+
     # Create the main simulator and attach it to application quit events.
     sim = create_sim(opts)
 
     # Stop simulating when app is quitting
     app.aboutToQuit.connect(sim.stop)
 
-    # Create the sim UI if requested
+    # Serve the simulator if requested
+    if opts['--serve'] is not None:
+        server = SimServer(sim, opts['--serve'])
+        server.start()
+        app.aboutToQuit.connect(server.stop)
+    if opts['--debug-server'] is not None:
+        debug_server = DebugServer(sim, opts['--debug-server'])
+        debug_server.start()
+        app.aboutToQuit.connect(debug_server.stop)
+
+    # Export telemetry if requested
+    if opts['--metrics-log'] is not None:
+        metrics_log = JsonLinesExporter(sim.metrics, opts['--metrics-log'])
+        app.aboutToQuit.connect(metrics_log.stop)
+    if opts['--metrics-port'] is not None:
+        metrics_server = PrometheusExporter(sim.metrics, int(opts['--metrics-port']))
+        app.aboutToQuit.connect(metrics_server.stop)
+
+    # Create the sim UI if requested. Without one, serial output goes to a
+    # terminal on stdout unless it goes to a serial port.
     if not opts['--no-gui']:
         ui = create_ui(sim)
+    elif opts['--serial'] is None:
+        terminal = print_serial_output(sim, app)
 
     # Start simulating once event loop is running
     QtCore.QTimer.singleShot(0, sim.start)
@@ -76,6 +76,7 @@ ffi.set_source(
     "burisim._lib6502",
     read_src_file("lib6502.c") + special_src,
     include_dirs=["lib6502"],
+    libraries=["pthread"],
 )
 
 # From lib6502 man page:
@@ -95,15 +96,135 @@ ffi.cdef("""
 
     typedef struct _M6502_Callbacks M6502_Callbacks;
 
+    struct _M6502_State
+    {
+        unsigned int     sequence;     /* seqlock counter */
+        M6502_Registers  registers;    /* registers at time of publication */
+        uint64_t         cycles;       /* total ticks at time of publication */
+    };
+    typedef struct _M6502_State M6502_State;
+
     struct _M6502
     {
         M6502_Registers  *registers;   /* processor state */
         uint8_t          *memory;      /* memory image */
         uint32_t          target_freq; /* in kHz, defaults to 2000 */
+        uint64_t          cycles;      /* total ticks run */
+        M6502_State      *state;       /* latest published state */
+        int               idle_detect; /* skip busy-wait loops */
+        uint64_t          idle_cycles; /* total ticks skipped */
+        unsigned int      stop_reason; /* why _run() stopped early */
+        uint16_t          stop_pc;     /* instruction which stopped it */
+        uint16_t          stop_address;/* address associated with stop */
+        uint8_t           stop_data;   /* data associated with stop */
+        uint32_t          cycle_charge;/* ticks to charge for call callback */
+        uint64_t          trap_cycles; /* total ticks charged by callbacks */
+        uint64_t          instructions;  /* total instructions run */
+        uint64_t          irqs;          /* total IRQs taken */
+        uint64_t          nmis;          /* total NMIs taken */
+        uint64_t          callbacks_run; /* total callbacks called */
+        uint64_t          callback_nsec; /* wall time in callbacks */
+        uint64_t          sleep_nsec;    /* wall time sleeping in _run() */
+        uint8_t           page_attrs[256]; /* M6502_Page... per page */
+        uint16_t          block_start; /* first address of the block cache */
+        uint32_t          block_size;  /* bytes covered, 0 => none */
         ...;
     };
     typedef struct _M6502 M6502;
 
+    enum {
+        M6502_StopNone,
+        M6502_StopIllegal,
+        M6502_StopSTP,
+        M6502_StopFault,
+        M6502_StopTrace,
+        M6502_StopBreak,
+        ...
+    };
+
+    enum {
+        M6502_PageRAM,
+        M6502_PageIO,
+        M6502_PageROMIgnore,
+        M6502_PageROMFault,
+        ...
+    };
+
+    enum {
+        M6502_CoverageExec,
+        M6502_CoverageRead,
+        M6502_CoverageWrite,
+        M6502_CoverageSize,
+        ...
+    };
+
+    struct _M6502_ProfileNode
+    {
+        uint16_t  address;      /* entry point of the routine */
+        uint8_t   kind;         /* M6502_Profile... */
+        uint32_t  parent;       /* index of the calling context */
+        uint64_t  calls;        /* times entered */
+        uint64_t  cycles;       /* ticks excluding callees */
+        ...;
+    };
+    typedef struct _M6502_ProfileNode M6502_ProfileNode;
+
+    struct _M6502_Profile
+    {
+        M6502_ProfileNode *nodes;   /* node 0 is the root */
+        uint32_t  n_nodes;
+        uint32_t  depth;            /* frames above the root */
+        uint32_t  stack_node[...];  /* node of each frame */
+        ...;
+    };
+    typedef struct _M6502_Profile M6502_Profile;
+
+    struct _M6502_TraceRecord
+    {
+        uint64_t  cycles;       /* cycle count before the instruction */
+        uint16_t  pc;           /* address of the instruction */
+        uint16_t  address;      /* data address read and/or written */
+        uint8_t   opcode;
+        uint8_t   a, x, y, p, s; /* registers before the instruction */
+        uint8_t   access;       /* M6502_TraceRead | M6502_TraceWrite */
+        uint8_t   data;         /* value written */
+        ...;
+    };
+    typedef struct _M6502_TraceRecord M6502_TraceRecord;
+
+    typedef struct _M6502_Trace M6502_Trace;
+    struct _M6502_Trace
+    {
+        M6502_TraceRecord *records;
+        uint32_t           size;    /* capacity of records */
+        uint32_t           n;       /* records used */
+        void             (*flush)(M6502_Trace *trace);
+        void              *context; /* for use by flush */
+        int                stop;    /* set non-zero by flush to stop */
+        ...;
+    };
+
+    enum {
+        M6502_TraceRead,
+        M6502_TraceWrite,
+        ...
+    };
+
+    enum {
+        M6502_ProfileCall,
+        M6502_ProfileIRQ,
+        M6502_ProfileNMI,
+        M6502_ProfileBRK,
+        ...
+    };
+
+    enum {
+        M6502_CountReads,
+        M6502_CountWrites,
+        M6502_CountSize,
+        ...
+    };
+
     M6502 *
     M6502_new(M6502_Registers *registers, M6502_Memory memory,
             M6502_Callbacks *callbacks);
@@ -117,6 +238,12 @@ ffi.cdef("""
     void
     M6502_irq(M6502 *mpu);
 
+    void
+    M6502_setIRQLine(M6502 *mpu, unsigned int line, int asserted);
+
+    unsigned int
+    M6502_getIRQLines(M6502 *mpu);
+
     void
     M6502_exit(M6502 *mpu);
 
@@ -161,12 +288,63 @@ ffi.cdef("""
     uint64_t
     M6502_run(M6502 *mpu, uint64_t n_ticks);
 
+    uint64_t
+    M6502_step(M6502 *mpu, uint64_t n_insns, uint64_t n_ticks);
+
+    int
+    M6502_trapReturn(M6502 *mpu, uint16_t address, uint8_t data);
+
     int
     M6502_disassemble(M6502 *mpu, uint16_t addres_s, char buffer[64]);
 
     void
     M6502_dump(M6502 *mpu, char buffer[64]);
 
+    void
+    M6502_publish(M6502 *mpu);
+
+    void
+    M6502_setRegisters(M6502 *mpu, const M6502_Registers *registers);
+
+    void
+    M6502_getState(M6502 *mpu, M6502_State *state);
+
+    int
+    M6502_readState(const M6502_State *shared, M6502_State *state);
+
+    void
+    M6502_setState(M6502 *mpu, M6502_State *state);
+
+    void
+    M6502_setPageAttrs(M6502 *mpu, uint16_t start, uint32_t size, uint8_t attr);
+
+    void
+    M6502_setBlockCache(M6502 *mpu, uint16_t start, uint32_t size);
+
+    void
+    M6502_flushBlockCache(M6502 *mpu);
+
+    void
+    M6502_setCoverage(M6502 *mpu, uint8_t *coverage);
+
+    void
+    M6502_setAccessCounts(M6502 *mpu, uint32_t *counts);
+
+    M6502_Profile *
+    M6502_newProfile(void);
+
+    void
+    M6502_deleteProfile(M6502_Profile *profile);
+
+    void
+    M6502_setProfile(M6502 *mpu, M6502_Profile *profile);
+
+    void
+    M6502_setTrace(M6502 *mpu, M6502_Trace *trace);
+
+    void
+    M6502_setBreakpoints(M6502 *mpu, uint8_t *breakpoints);
+
     void
     M6502_delete(M6502 *mpu);
 """)
@@ -0,0 +1,271 @@
+"""
+Drive a BuriSim from an asyncio event loop. Requires Python 3.
+
+An AsyncBuriSim wraps a BuriSim whose simulation thread is started paused.
+Awaiting run() or run_until() resumes the machine and completes once it has
+paused again:
+
+    async def boot(rom):
+        async with AsyncBuriSim() as sim:
+            sim.sim.load_rom_bytes(rom)
+            sim.sim.reset()
+            await sim.run_until(lambda s: s.mpu.registers.pc == 0xe123)
+            sim.serial.write(b'help\\r')
+            return await sim.serial.read_until(b'> ')
+
+Completion conditions are checked on the simulation thread after each slice
+so waiting costs the event loop nothing. Completions are handed back to the
+loop in batches: however many machines complete during a turn of the loop,
+it is woken once. This lets one loop orchestrate many machines without a
+thread per waiter.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import asyncio
+from collections import deque
+import threading
+import weakref
+
+from burisim.sim import BuriSim
+
+# _Dispatcher for each event loop
+_DISPATCHERS = weakref.WeakKeyDictionary()
+_DISPATCHERS_LOCK = threading.Lock()
+
+class _Dispatcher(object):
+    """Call functions on an event loop from other threads. Calls made before
+    the loop gets round to them are run in one callback.
+
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._calls = []
+
+    @staticmethod
+    def for_loop(loop):
+        with _DISPATCHERS_LOCK:
+            dispatcher = _DISPATCHERS.get(loop)
+            if dispatcher is None:
+                dispatcher = _DISPATCHERS[loop] = _Dispatcher(loop)
+            return dispatcher
+
+    def call(self, fn, *args):
+        with self._lock:
+            self._calls.append((fn, args))
+            schedule = len(self._calls) == 1
+        if schedule:
+            self._loop.call_soon_threadsafe(self._run_calls)
+
+    def _run_calls(self):
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for fn, args in calls:
+            fn(*args)
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+class AsyncBuriSim(object):
+    """An asyncio facade for sim, a BuriSim which defaults to a new one. The
+    facade must be created on the thread running loop, which defaults to the
+    current event loop. sim must not be running.
+
+    Only one run() or run_until() may be outstanding at a time. Other methods
+    of sim, e.g. load_rom_bytes(), may be used directly but they block until
+    the next slice boundary.
+
+    """
+    def __init__(self, sim=None, loop=None):
+        self.sim = sim if sim is not None else BuriSim()
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._dispatcher = _Dispatcher.for_loop(self._loop)
+
+        # (predicate, future) of the outstanding run. Only accessed on the
+        # simulation thread.
+        self._run = None
+        self._busy = False
+
+        self.serial = AsyncSerial(self.sim, self._loop, self._dispatcher)
+
+    def start(self):
+        """Start the simulation thread, paused.
+
+        """
+        self.sim.pause()
+        self.sim.add_slice_listener(self._end_slice)
+        self.serial.attach()
+        self.sim.start()
+
+    def stop(self):
+        """Stop the simulation thread. An outstanding run is cancelled.
+
+        """
+        self.sim.stop()
+        self.serial.detach()
+        self.sim.remove_slice_listener(self._end_slice)
+        if self._run is not None:
+            self._run[1].cancel()
+            self._run = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.stop()
+
+    def run(self, cycles):
+        """Run the machine for cycles clock ticks and pause. The returned
+        future completes with the total cycle count, or raises the
+        MachineError which paused the machine early.
+
+        """
+        return self._start_run(None, cycles)
+
+    def run_until(self, predicate):
+        """Run the machine until predicate(sim) is true and pause. predicate
+        is called on the simulation thread after each slice, so it may read
+        sim.mpu directly but it should be quick. The returned future completes
+        with the total cycle count, or raises the MachineError which paused
+        the machine early.
+
+        """
+        return self._start_run(predicate, None)
+
+    def _start_run(self, predicate, cycles):
+        if self._busy:
+            raise RuntimeError('A run is already in progress')
+        future = self._loop.create_future()
+        self._busy = True
+
+        def start():
+            # pylint: disable=protected-access
+            self._run = (predicate, future)
+            self.sim._resume(cycles)
+
+        def done(_):
+            self._busy = False
+            if future.cancelled():
+                self.sim._submit(self._cancel_run, wait=False) # pylint: disable=protected-access
+
+        future.add_done_callback(done)
+        self.sim._submit(start, wait=False) # pylint: disable=protected-access
+        return future
+
+    def _cancel_run(self):
+        if self._run is not None and self._run[1].cancelled():
+            self._run = None
+            self.sim._paused = True # pylint: disable=protected-access
+
+    def _end_slice(self):
+        # Called on the simulation thread after each slice.
+        self.serial._end_slice() # pylint: disable=protected-access
+        if self._run is None:
+            return
+        sim = self.sim
+        predicate, future = self._run
+        if sim.error is not None:
+            self._run = None
+            self._dispatcher.call(_set_exception, future, sim.error)
+        elif predicate is not None and predicate(sim):
+            self._run = None
+            sim._paused = True # pylint: disable=protected-access
+            self._dispatcher.call(_set_result, future, sim.mpu.cycles)
+        elif sim.is_paused():
+            self._run = None
+            self._dispatcher.call(_set_result, future, sim.mpu.cycles)
+
+class AsyncSerial(object):
+    """The serial port, ACIA1, of an AsyncBuriSim. Bytes sent by the machine
+    are buffered until read.
+
+    """
+    def __init__(self, sim, loop, dispatcher):
+        self._sim = sim
+        self._loop = loop
+        self._dispatcher = dispatcher
+
+        # Bytes from the ACIA listener, appended on the simulation thread
+        self._incoming = deque()
+
+        # Received bytes and outstanding (delimiter, future) reads, guarded by
+        # _lock.
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._readers = deque()
+
+    def attach(self):
+        self._sim.acia1.register_listener(self._incoming.append)
+
+    def detach(self):
+        self._sim.acia1.unregister_listener(self._incoming.append)
+
+    def write(self, data):
+        """Send the bytes-like object data to the machine. Returns without
+        waiting for it to be delivered.
+
+        """
+        for b in bytearray(data):
+            self._sim.receive_serial(b)
+
+    def read_until(self, delimiter):
+        """Return a future which completes with the bytes received up to and
+        including the next occurrence of delimiter. Reads complete in the
+        order they were made.
+
+        """
+        delimiter = bytes(delimiter)
+        future = self._loop.create_future()
+        with self._lock:
+            self._readers.append((delimiter, future))
+            self._complete_reads()
+        return future
+
+    def read_available(self):
+        """Return the bytes received which have not yet been read.
+
+        """
+        with self._lock:
+            self._receive()
+            data, self._buffer = bytes(self._buffer), bytearray()
+            return data
+
+    def _end_slice(self):
+        if len(self._incoming) > 0 and len(self._readers) > 0:
+            with self._lock:
+                self._complete_reads()
+
+    def _receive(self):
+        # Called with _lock held.
+        popleft = self._incoming.popleft
+        self._buffer.extend(popleft() for _ in range(len(self._incoming)))
+
+    def _complete_reads(self):
+        # Called with _lock held.
+        self._receive()
+        while len(self._readers) > 0:
+            delimiter, future = self._readers[0]
+            if future.cancelled():
+                self._readers.popleft()
+                continue
+            idx = self._buffer.find(delimiter)
+            if idx < 0:
+                break
+            self._readers.popleft()
+            end = idx + len(delimiter)
+            data, self._buffer = bytes(self._buffer[:end]), self._buffer[end:]
+            self._dispatcher.call(_set_result, future, data)
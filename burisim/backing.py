@@ -0,0 +1,154 @@
+"""
+Back machine memory with a memory-mapped file or POSIX shared memory.
+
+A backing is a single mapping laid out as follows:
+
+    offset 0x00000  64K of machine memory
+    offset 0x10000  M6502_State published by the processor (see lib6502.h)
+
+Since the processor publishes its registers and cycle count into the mapping
+under a seqlock, another process can map the same file or shared memory
+segment and watch the machine with no copying and without contending with the
+emulation thread. Use read_state() to read a consistent copy.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import logging
+import mmap
+import os
+
+from burisim._lib6502 import lib, ffi # pylint: disable=no-name-in-module
+from burisim.lib6502 import M6502, ProcessorState
+
+_LOGGER = logging.getLogger(__name__)
+
+# Offsets and size of the backing layout
+MEMORY_OFFSET = 0
+STATE_OFFSET = M6502.MEMORY_SIZE
+BACKING_SIZE = STATE_OFFSET + M6502.STATE_SIZE
+
+# Where POSIX shared memory segments live on Linux
+SHM_DIR = '/dev/shm'
+
+class StateUnavailableError(Exception):
+    """Raised by read_state() if the state was being updated throughout the
+    attempt to read it, e.g. because the publishing process died part way
+    through an update."""
+    pass
+
+class MemoryBacking(object):
+    """A shared mapping of machine memory and processor state. Pass memory and
+    state_buffer to M6502 or pass the backing itself to BuriSim.
+
+    The mapping cannot be closed while an M6502 is using it.
+
+    """
+    def __init__(self, fileno, path=None):
+        self.path = path
+        self._mmap = mmap.mmap(fileno, BACKING_SIZE, mmap.MAP_SHARED)
+        self._view = memoryview(self._mmap)
+        self._state = ffi.cast(
+            'M6502_State *', ffi.from_buffer(self._view[STATE_OFFSET:])
+        )
+
+    @property
+    def memory(self):
+        """A writable memoryview of the 64K of machine memory.
+
+        """
+        return self._view[MEMORY_OFFSET:MEMORY_OFFSET + M6502.MEMORY_SIZE]
+
+    @property
+    def state_buffer(self):
+        """A writable memoryview of the published M6502_State.
+
+        """
+        return self._view[STATE_OFFSET:BACKING_SIZE]
+
+    def read_state(self):
+        """Return a ProcessorState read from the backing. See read_state().
+
+        """
+        return read_state(self._state)
+
+    def flush(self):
+        """Write any changes to memory back to a file backing.
+
+        """
+        self._mmap.flush()
+
+    def close(self):
+        self._state = None
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_state(state_ptr):
+    """Read a consistent ProcessorState from state_ptr, a cffi "M6502_State *"
+    which may be in memory shared with another process. Raises
+    StateUnavailableError if no consistent copy could be read.
+
+    """
+    s = ffi.new('M6502_State *')
+    if not lib.M6502_readState(state_ptr, s):
+        raise StateUnavailableError('Processor state is being updated')
+    r = s.registers
+    return ProcessorState(r.a, r.x, r.y, r.p, r.s, r.pc, s.cycles, s.sequence)
+
+def _open(path, create):
+    flags = os.O_RDWR | (os.O_CREAT if create else 0)
+    fd = os.open(path, flags, 0o600)
+    try:
+        if os.fstat(fd).st_size < BACKING_SIZE:
+            if not create:
+                raise ValueError('{0} is too small to be a backing'.format(path))
+            # Newly created files read as zero.
+            os.ftruncate(fd, BACKING_SIZE)
+        return MemoryBacking(fd, path)
+    finally:
+        # The mapping keeps its own reference to the file.
+        os.close(fd)
+
+def open_file(path, create=True):
+    """Return a MemoryBacking mapping the file at path. The file is created or
+    extended if necessary. Since the file persists, so does RAM between runs,
+    like battery-backed RAM.
+
+    """
+    _LOGGER.info('backing memory with file %s', path)
+    return _open(path, create)
+
+def open_shared(name, create=True):
+    """Return a MemoryBacking mapping the POSIX shared memory segment name. The
+    segment is created if necessary and create is True. Other processes may
+    open the same segment with create=False to watch the machine.
+
+    """
+    _LOGGER.info('backing memory with shared memory segment %s', name)
+    return _open(_shm_path(name), create)
+
+def unlink_shared(name):
+    """Remove the POSIX shared memory segment name. Existing mappings are
+    unaffected.
+
+    """
+    os.unlink(_shm_path(name))
+
+def _shm_path(name):
+    name = name.lstrip('/')
+    if name == '' or '/' in name:
+        raise ValueError('Invalid shared memory name: ' + repr(name))
+    return os.path.join(SHM_DIR, name)
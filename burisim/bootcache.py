@@ -0,0 +1,260 @@
+"""
+Skip booting the ROM by starting from a cached snapshot of a booted machine.
+
+warm_boot() runs a freshly reset machine, unthrottled, until a BootCondition
+is met, e.g. the program counter reaching the main loop or a prompt being
+sent to the serial port. It then stores the processor registers, memory and
+device registers in a BootCache. The cache is keyed by a hash of everything
+which determines the booted state, i.e. the ROM and RAM images loaded and the
+condition, so that the next warm_boot() with the same inputs restores the
+state in place of booting.
+
+Each entry is a JSON file in the cache directory. Entries are evicted, least
+recently used first, to keep the directory below a maximum size.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import base64
+from collections import namedtuple
+import errno
+import glob
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+from burisim.lib6502 import ProcessorState
+from burisim.sim import BreakpointError, MachineError, MachineSnapshot
+
+_LOGGER = logging.getLogger(__name__)
+
+# Version of the entry format. Part of the key so that entries written by
+# other versions are never used.
+VERSION = 1
+
+_REGISTERS = ('a', 'x', 'y', 'p', 's', 'pc')
+
+BootCondition = namedtuple('BootCondition', 'pc prompt')
+BootCondition.__doc__ = """When booting is complete: once the program
+counter has reached pc or once the bytes prompt have been sent to ACIA1. The
+other field is None. See parse_condition().
+
+"""
+
+def parse_condition(s):
+    """Parse a BootCondition from a string "pc=ADDR", with ADDR in hex, or
+    "prompt=TEXT". Raises ValueError if s is neither.
+
+    """
+    kind, _, value = s.partition('=')
+    if kind == 'pc' and value != '':
+        return BootCondition(int(value.lstrip('$'), 16), None)
+    elif kind == 'prompt' and value != '':
+        return BootCondition(None, value.encode('utf8'))
+    raise ValueError('Boot condition must be pc=ADDR or prompt=TEXT: ' + repr(s))
+
+class BootCache(object):
+    """A directory of booted machine states which is kept below max_bytes by
+    removing the least recently used.
+
+    """
+    MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(condition, images):
+        """Return the key for booting until condition, a BootCondition, with
+        images, a sequence of (address, bytes) pairs giving the ROM and RAM
+        images loaded.
+
+        """
+        h = hashlib.sha256()
+        h.update(struct.pack('<I', VERSION))
+        h.update(json.dumps([
+            condition.pc,
+            None if condition.prompt is None else base64.b64encode(condition.prompt).decode('ascii'),
+        ]).encode('ascii'))
+        for address, data in images:
+            h.update(struct.pack('<IQ', address, len(data)))
+            h.update(bytes(data))
+        return h.hexdigest()
+
+    def load(self, key):
+        """Return the entry for key or None if there is none. Loading counts
+        as a use for eviction.
+
+        """
+        path = self._path(key)
+        try:
+            with open(path) as fobj:
+                entry = json.load(fobj)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            _LOGGER.warning('removing corrupt boot cache entry %s', path)
+            os.unlink(path)
+            return None
+        os.utime(path, None)
+        return entry
+
+    def save(self, key, entry):
+        """Store entry under key and evict old entries if necessary.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(entry, fobj, sort_keys=True)
+        os.rename(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the total size of the
+        entries is at most max_bytes.
+
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            _LOGGER.info('evicting boot cache entry %s', path)
+            os.unlink(path)
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+def capture(sim):
+    """Return an entry for a BootCache recording the state of sim, a BuriSim
+    whose simulation thread is not running.
+
+    """
+    snapshot = sim.snapshot()
+    return {
+        'version': VERSION,
+        'state': dict((r, getattr(snapshot.state, r)) for r in _REGISTERS),
+        'memory': base64.b64encode(zlib.compress(bytes(snapshot.memory))).decode('ascii'),
+        'acia1': sim.acia1.get_state(),
+        'lcd1': sim.display.get_state(),
+    }
+
+def restore(sim, entry):
+    """Restore an entry returned by capture() to sim, a BuriSim whose
+    simulation thread is not running. The cycle count is unaffected.
+
+    """
+    state = ProcessorState(
+        cycles=sim.mpu.cycles, sequence=0,
+        **dict((r, entry['state'][r]) for r in _REGISTERS)
+    )
+    memory = zlib.decompress(base64.b64decode(entry['memory'].encode('ascii')))
+    sim.restore(MachineSnapshot(state, memory))
+    sim.acia1.set_state(entry['acia1'])
+    sim.display.set_state(entry['lcd1'])
+
+# Bounds on booting. Slices are short so that a prompt is noticed soon after
+# it is sent.
+MAX_BOOT_CYCLES = 500 * 1000 * 1000
+_BOOT_SLICE = 10000
+
+def boot(sim, condition, max_cycles=MAX_BOOT_CYCLES):
+    """Run sim, a BuriSim whose simulation thread is not running, unthrottled
+    on the calling thread until condition, a BootCondition, is met. Returns
+    True if it was met within max_cycles clock ticks. If condition has a pc,
+    a breakpoint stops the machine before the instruction at pc is run.
+
+    """
+    if sim.is_running():
+        raise ValueError('Cannot boot while the simulation thread is running')
+
+    received = bytearray()
+    pc = condition.pc
+    if pc is not None:
+        had_breakpoint = pc in sim.breakpoints
+        sim.add_breakpoint(pc)
+    else:
+        sim.acia1.register_listener(received.append)
+
+    mpu = sim.mpu
+    target_freq, mpu.target_freq = mpu.target_freq, 0
+    end = mpu.cycles + max_cycles
+    try:
+        while mpu.cycles < end:
+            try:
+                sim.step(_BOOT_SLICE)
+            except BreakpointError as e:
+                if e.address != pc:
+                    raise
+                return True
+            if condition.prompt is not None and condition.prompt in received:
+                return True
+        return False
+    finally:
+        mpu.target_freq = target_freq
+        if pc is not None:
+            if not had_breakpoint:
+                sim.remove_breakpoint(pc)
+        else:
+            sim.acia1.unregister_listener(received.append)
+
+def warm_boot(sim, cache, condition, images, max_cycles=MAX_BOOT_CYCLES):
+    """Bring sim, a freshly reset BuriSim whose simulation thread is not
+    running, to the state after booting until condition, a BootCondition,
+    with images, a sequence of (address, bytes) pairs giving the ROM and RAM
+    images loaded. The state is restored from cache, a BootCache, if present
+    and otherwise booted and added to cache. Returns True if the state came
+    from the cache.
+
+    If booting fails, a warning is logged and sim is reset so that it boots
+    normally once started.
+
+    """
+    key = BootCache.key(condition, images)
+    entry = cache.load(key)
+    if entry is not None:
+        restore(sim, entry)
+        _LOGGER.info('restored booted machine from %s', cache.directory)
+        return True
+
+    start = time.time()
+    try:
+        booted = boot(sim, condition, max_cycles)
+    except MachineError as e:
+        _LOGGER.warning('%s while booting: booting normally', e)
+        booted = False
+    else:
+        if not booted:
+            _LOGGER.warning('boot incomplete after %s cycles: booting normally', max_cycles)
+    if not booted:
+        sim.reset()
+        return False
+
+    cache.save(key, capture(sim))
+    _LOGGER.info(
+        'booted in %s cycles, %.2fs: saved to %s',
+        sim.mpu.cycles, time.time() - start, cache.directory
+    )
+    return False
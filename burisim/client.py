@@ -0,0 +1,170 @@
+"""
+Attach to a simulator served by burisim.server.
+
+SimClient provides the parts of the BuriSim interface used by burisim.ui so
+that the UI can run in a separate process from the emulator. Rendering in the
+client can then never slow the machine down.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import binascii
+import logging
+import socket
+import threading
+
+import numpy as np
+
+from burisim import ipc
+from burisim.backing import open_file
+from burisim.hw.hd44780 import HD44780
+
+_LOGGER = logging.getLogger(__name__)
+
+class RemoteSerial(object):
+    """Stands in for the served simulator's ACIA1 so that listeners may be
+    registered for serial output.
+
+    """
+    def __init__(self, client):
+        self._client = client
+        self._listeners = []
+
+    def register_listener(self, l):
+        self._listeners.append(l)
+
+    def _received(self, data):
+        for b in bytearray(data):
+            for l in self._listeners:
+                l(b)
+
+class SimClient(object):
+    """Connect to the server listening on the Unix socket at path. Listeners
+    and display updates are called on a background thread as they would be
+    by the simulation thread of an in-process BuriSim.
+
+    """
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._send_lock = threading.Lock()
+        self._reader = ipc.MessageReader()
+        self._pending = []
+
+        self.acia1 = RemoteSerial(self)
+        self.display = HD44780()
+        self.backing = None
+
+        # The server always begins with HELLO.
+        msg_type, payload = self._next_message()
+        if msg_type != ipc.HELLO:
+            raise ipc.ProtocolError('Expected HELLO from server')
+        hello = ipc.decode_json(payload)
+        if hello['version'] != ipc.VERSION:
+            raise ipc.ProtocolError(
+                'Unsupported protocol version {0}'.format(hello['version'])
+            )
+        self.backing = open_file(hello['backing'], create=False)
+
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def memory(self):
+        """A view of the machine memory shared with the server. As with
+        BuriSim.memory, don't mutate this.
+
+        """
+        return self.backing.memory
+
+    @property
+    def memory_array(self):
+        """A numpy uint8 array viewing memory. See BuriSim.memory_array.
+
+        """
+        return np.frombuffer(self.backing.memory, np.uint8)
+
+    @property
+    def state(self):
+        """A ProcessorState read from the memory shared with the server.
+
+        """
+        return self.backing.read_state()
+
+    def reset(self):
+        self._command(op='reset')
+
+    def receive_serial(self, b):
+        self._send(ipc.encode(ipc.SERIAL, bytes(bytearray([b]))))
+
+    def pause(self):
+        self._command(op='pause')
+
+    def resume(self):
+        self._command(op='resume')
+
+    def poke(self, addr, data):
+        if isinstance(data, int):
+            data = bytes(bytearray([data]))
+        self._command(op='poke', addr=addr, data=binascii.hexlify(data).decode('ascii'))
+
+    def set_throttled(self, v):
+        self._command(op='throttled', value=bool(v))
+
+    def close(self):
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._thread.join()
+        self._sock.close()
+
+    def _command(self, **cmd):
+        self._send(ipc.encode_json(ipc.COMMAND, cmd))
+
+    def _send(self, data):
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def _next_message(self):
+        messages = []
+        while len(messages) == 0:
+            data = self._sock.recv(4096)
+            if len(data) == 0:
+                raise ipc.ProtocolError('Server closed connection')
+            messages = self._reader.feed(data)
+        # The server sends the initial LCD state straight after HELLO so
+        # keep any further messages for _receive().
+        self._pending = messages[1:]
+        return messages[0]
+
+    def _receive(self):
+        messages = self._pending
+        while True:
+            for msg_type, payload in messages:
+                self._dispatch(msg_type, payload)
+            try:
+                data = self._sock.recv(4096)
+            except socket.error:
+                data = b''
+            if len(data) == 0:
+                _LOGGER.info('disconnected from server')
+                return
+            messages = self._reader.feed(data)
+
+    def _dispatch(self, msg_type, payload):
+        if msg_type == ipc.SERIAL:
+            self.acia1._received(payload)
+        elif msg_type == ipc.LCD:
+            payload = bytearray(payload)
+            self.display.cursor_index = payload[0]
+            self.display.ddram = list(payload[1:129])
+            self.display.set_cgram(payload[129:])
+            self.display.update.emit()
+        elif msg_type == ipc.ERROR:
+            _LOGGER.error('server: %s', payload.decode('utf8'))
@@ -0,0 +1,240 @@
+"""
+Code coverage of the emulated machine.
+
+Usage:
+    burisim-coverage (-h | --help)
+    burisim-coverage [options] <coverage>...
+
+Options:
+    -h, --help          Show a brief usage summary.
+
+    -o, --output FILE   Write the union of the input coverage files to FILE.
+    --symbols FILE      Read source lines and symbols from FILE, an ld65 debug
+                        info file (--dbgfile) or VICE label file (-Ln).
+    --lcov FILE         Write an lcov tracefile to FILE. Needs --symbols.
+
+A Coverage holds three planes of flags with one byte per address recording
+which addresses have been executed as the start of an instruction and which
+have been read or written as data by an instruction. The planes are numpy
+arrays which the processor writes to directly while the coverage is attached
+to a BuriSim via BuriSim.coverage, so looking at them involves no copying.
+
+Coverage from several runs, perhaps in different processes, is combined with
+merge() or the | operator. Coverage objects may be pickled or saved to and
+loaded from .npy files. Given a burisim.symbols.SourceMap, lines() gives
+per-line coverage and write_lcov() writes it in the lcov tracefile format
+understood by genhtml and most CI coverage tools.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from collections import namedtuple, OrderedDict
+import io
+import logging
+import sys
+
+from docopt import docopt
+import numpy as np
+from past.builtins import basestring # pylint: disable=redefined-builtin
+
+from burisim import symbols
+from burisim.lib6502 import M6502
+
+_LOGGER = logging.getLogger(__name__)
+
+# Indices of the planes. These match the layout of the buffer described in
+# M6502.set_coverage().
+EXEC = M6502.COVERAGE_EXEC // M6502.MEMORY_SIZE
+READ = M6502.COVERAGE_READ // M6502.MEMORY_SIZE
+WRITE = M6502.COVERAGE_WRITE // M6502.MEMORY_SIZE
+
+LineCoverage = namedtuple('LineCoverage', 'filename line hit')
+LineCoverage.__doc__ = """Coverage of a source line. hit is True if any of its
+addresses was executed or read.
+
+"""
+
+class Coverage(object):
+    """Coverage flags for each address. If planes is not None it is an array
+    of shape (3, MEMORY_SIZE) giving the initial flags, e.g. from load().
+    Otherwise coverage starts empty.
+
+    """
+    def __init__(self, planes=None):
+        shape = (M6502.COVERAGE_SIZE // M6502.MEMORY_SIZE, M6502.MEMORY_SIZE)
+        if planes is None:
+            planes = np.zeros(shape, np.uint8)
+        planes = np.ascontiguousarray(planes, np.uint8)
+        if planes.shape != shape:
+            raise ValueError('Coverage must have shape {0}'.format(shape))
+        self.planes = planes
+
+    @property
+    def buffer(self):
+        """A flat view of the planes to pass to M6502.set_coverage().
+
+        """
+        return self.planes.reshape(-1)
+
+    @property
+    def executed(self):
+        """A boolean array which is True for each address at which an
+        instruction has been executed.
+
+        """
+        return self.planes[EXEC] != 0
+
+    @property
+    def read(self):
+        """A boolean array which is True for each address read as data.
+
+        """
+        return self.planes[READ] != 0
+
+    @property
+    def written(self):
+        """A boolean array which is True for each address written as data.
+
+        """
+        return self.planes[WRITE] != 0
+
+    def clear(self):
+        self.planes[...] = 0
+
+    def merge(self, other):
+        """Add the coverage of other to this and return self.
+
+        """
+        np.bitwise_or(self.planes, other.planes, out=self.planes)
+        return self
+
+    def __or__(self, other):
+        return Coverage(self.planes | other.planes)
+
+    def copy(self):
+        return Coverage(self.planes.copy())
+
+    def save(self, fobj_or_string):
+        """Save to a file object or filename in numpy .npy format.
+
+        """
+        if isinstance(fobj_or_string, basestring):
+            with open(fobj_or_string, 'wb') as fobj:
+                np.save(fobj, self.planes)
+        else:
+            np.save(fobj_or_string, self.planes)
+
+    @classmethod
+    def load(cls, fobj_or_string):
+        """Return a Coverage loaded from a file object or filename saved by
+        save().
+
+        """
+        if isinstance(fobj_or_string, basestring):
+            with open(fobj_or_string, 'rb') as fobj:
+                return cls(np.load(fobj))
+        return cls(np.load(fobj_or_string))
+
+    def lines(self, source_map):
+        """Return a list of LineCoverage for each line of source_map, a
+        burisim.symbols.SourceMap. Lines are hit if any of their addresses
+        were executed, or read so that data tables count as covered when
+        used.
+
+        """
+        used = (self.planes[EXEC] | self.planes[READ]) != 0
+        return [
+            LineCoverage(l.filename, l.line, any(
+                used[start:start+size].any() for start, size in l.ranges
+            ))
+            for l in source_map.lines
+        ]
+
+    def write_lcov(self, fobj, source_map, test_name=''):
+        """Write coverage of source_map, a burisim.symbols.SourceMap, to fobj,
+        a file-like object open for writing text, as an lcov tracefile.
+        Symbols are reported as functions which are hit if the instruction at
+        their address was executed.
+
+        """
+        files = OrderedDict()
+        for line in self.lines(source_map):
+            files.setdefault(line.filename, ([], []))[0].append(line)
+        for symbol in source_map.symbols:
+            if symbol.filename in files:
+                files[symbol.filename][1].append(symbol)
+
+        executed = self.planes[EXEC]
+        for filename, (lines, syms) in files.items():
+            out = ['TN:' + test_name, 'SF:' + filename]
+            for symbol in syms:
+                out.append('FN:{0},{1}'.format(symbol.line, symbol.name))
+            for symbol in syms:
+                out.append('FNDA:{0},{1}'.format(
+                    int(executed[symbol.address]), symbol.name
+                ))
+            out.append('FNF:{0}'.format(len(syms)))
+            out.append('FNH:{0}'.format(
+                sum(1 for s in syms if executed[s.address])
+            ))
+            for line in lines:
+                out.append('DA:{0},{1}'.format(line.line, int(line.hit)))
+            out.append('LF:{0}'.format(len(lines)))
+            out.append('LH:{0}'.format(sum(1 for l in lines if l.hit)))
+            out.append('end_of_record')
+            fobj.write('\n'.join(out) + '\n')
+
+def merge(coverages):
+    """Return a new Coverage which is the union of an iterable of Coverage
+    objects, e.g. those returned by a pool of worker processes.
+
+    """
+    result = Coverage()
+    for c in coverages:
+        result.merge(c)
+    return result
+
+def main():
+    opts = docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO, stream=sys.stderr, format='%(name)s: %(message)s'
+    )
+
+    if opts['--lcov'] is not None and opts['--symbols'] is None:
+        sys.stderr.write('--lcov needs --symbols\n')
+        sys.exit(1)
+
+    coverage = merge(Coverage.load(f) for f in opts['<coverage>'])
+    if opts['--output'] is not None:
+        coverage.save(opts['--output'])
+
+    print('{0} addresses executed, {1} read, {2} written'.format(
+        coverage.executed.sum(), coverage.read.sum(), coverage.written.sum()
+    ))
+
+    if opts['--symbols'] is None:
+        return
+
+    source_map = symbols.load(opts['--symbols'])
+    totals = OrderedDict()
+    for line in coverage.lines(source_map):
+        hit, total = totals.get(line.filename, (0, 0))
+        totals[line.filename] = (hit + int(line.hit), total + 1)
+    for filename, (hit, total) in totals.items():
+        print('{0}: {1}/{2} lines ({3:.1f}%)'.format(
+            filename, hit, total, 100.0 * hit / max(1, total)
+        ))
+
+    if opts['--lcov'] is not None:
+        with io.open(opts['--lcov'], 'w') as fobj:
+            coverage.write_lcov(fobj, source_map)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+Serve a debugging protocol for a running BuriSim to external tools.
+
+A DebugServer listens on a Unix socket or a TCP port on the loopback
+interface and runs on its own thread. Each request is applied through the
+simulator's control plane at the next slice boundary and so never holds up
+the simulation thread for longer than a slice.
+
+Requests and responses are framed as by burisim.ipc: a 4 byte big-endian
+payload length, a 1 byte type and the payload. Bulk data is sent raw so that
+all 64K of memory is read or written in a single round trip. Each request is
+answered, in order, by an OK message with the payload given below or by an
+ERROR message with a UTF-8 description of what went wrong. Integers in
+payloads are little-endian.
+
+    READ_MEMORY         address (u16), length (u32) -> the bytes
+    WRITE_MEMORY        address (u16), bytes -> empty
+    READ_REGISTERS      empty -> REGISTERS
+    WRITE_REGISTERS     REGISTERS, cycles ignored -> empty
+    SET_BREAKPOINT      address (u16) -> empty
+    CLEAR_BREAKPOINT    address (u16) -> empty
+    LIST_BREAKPOINTS    empty -> an address (u16) per breakpoint
+    STEP                count (u32) -> instructions run (u32), REGISTERS
+    CONTINUE            empty -> empty
+    PAUSE               empty -> REGISTERS
+    STATUS              empty -> STATUS
+    SNAPSHOT            empty -> REGISTERS, 64K of memory
+    RESTORE             REGISTERS, 64K of memory -> empty
+
+REGISTERS is A, X, Y, P and S (u8 each), PC (u16) and the cycle count (u64).
+STATUS is whether the machine is paused (u8), why it stopped (u8, one of the
+STOPPED_... values), the address at which it stopped (u16) and REGISTERS.
+STEP pauses the machine and steps over a breakpoint at the current address,
+as does CONTINUE before resuming.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import errno
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+
+from burisim import ipc
+from burisim.lib6502 import M6502, ProcessorState
+from burisim.sim import BreakpointError, MachineSnapshot
+
+_LOGGER = logging.getLogger(__name__)
+
+# Request types
+READ_MEMORY = 1
+WRITE_MEMORY = 2
+READ_REGISTERS = 3
+WRITE_REGISTERS = 4
+SET_BREAKPOINT = 5
+CLEAR_BREAKPOINT = 6
+LIST_BREAKPOINTS = 7
+STEP = 8
+CONTINUE = 9
+PAUSE = 10
+STATUS = 11
+SNAPSHOT = 12
+RESTORE = 13
+
+# Response types
+OK = 0x80
+ERROR = 0x81
+
+# Values for why the machine stopped in STATUS
+STOPPED_NONE = 0        # running or paused by request
+STOPPED_BREAKPOINT = 1  # reached a breakpoint
+STOPPED_ERROR = 2       # paused by a MachineError other than a breakpoint
+
+REGISTERS = struct.Struct('<BBBBBHQ')
+STATUS_HEADER = struct.Struct('<BBH')
+_ADDRESS = struct.Struct('<H')
+_READ = struct.Struct('<HI')
+_COUNT = struct.Struct('<I')
+
+class DebugError(Exception):
+    """Raised for a request which cannot be applied. The message is sent to
+    the client.
+
+    """
+    pass
+
+def parse_address(address):
+    """Return the socket family and address for address, a port number or a
+    string giving a port number, for TCP on the loopback interface, or the
+    path of a Unix socket.
+
+    """
+    if isinstance(address, int) or address.isdigit():
+        return socket.AF_INET, ('127.0.0.1', int(address))
+    return socket.AF_UNIX, address
+
+class DebugServer(object):
+    """Serve the debugging protocol for sim at address, see parse_address().
+
+    """
+    # Largest number of instructions run by a single STEP. The simulation
+    # thread runs them a slice at a time but the client waits for them all.
+    MAX_STEP = 0x10000
+
+    def __init__(self, sim, address):
+        self.sim = sim
+        self.family, self.address = parse_address(address)
+
+        self._listen_sock = None
+        self._clients = {}
+        self._thread = None
+        self._want_stop = False
+
+        self._handlers = {
+            READ_MEMORY: self._read_memory,
+            WRITE_MEMORY: self._write_memory,
+            READ_REGISTERS: self._read_registers,
+            WRITE_REGISTERS: self._write_registers,
+            SET_BREAKPOINT: self._set_breakpoint,
+            CLEAR_BREAKPOINT: self._clear_breakpoint,
+            LIST_BREAKPOINTS: self._list_breakpoints,
+            STEP: self._step,
+            CONTINUE: self._continue,
+            PAUSE: self._pause,
+            STATUS: self._status,
+            SNAPSHOT: self._snapshot,
+            RESTORE: self._restore,
+        }
+
+    def start(self):
+        """Start listening and serving clients on a new thread.
+
+        """
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listen_sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self._listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listen_sock.bind(self.address)
+        self._listen_sock.listen(5)
+        if self.family == socket.AF_INET:
+            self.address = self._listen_sock.getsockname()
+        _LOGGER.info('serving debugger on %s', self.address)
+
+        self._want_stop = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._want_stop = True
+        self._thread.join()
+        self._thread = None
+
+        for sock in list(self._clients):
+            self._drop(sock)
+        self._listen_sock.close()
+        if self.family == socket.AF_UNIX:
+            os.unlink(self.address)
+
+    def _serve(self):
+        while not self._want_stop:
+            socks = [self._listen_sock] + list(self._clients)
+            readable, _, _ = select.select(socks, [], [], 0.1)
+            for sock in readable:
+                if sock is self._listen_sock:
+                    self._accept()
+                else:
+                    self._receive(sock)
+
+    def _accept(self):
+        sock, _ = self._listen_sock.accept()
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _LOGGER.info('debugger connected')
+        self._clients[sock] = ipc.MessageReader()
+
+    def _drop(self, sock):
+        _LOGGER.info('debugger disconnected')
+        self._clients.pop(sock, None)
+        sock.close()
+
+    def _send(self, sock, data):
+        try:
+            sock.sendall(data)
+        except socket.error as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            self._drop(sock)
+
+    def _receive(self, sock):
+        try:
+            data = sock.recv(0x10000)
+        except socket.error:
+            data = b''
+        if len(data) == 0:
+            self._drop(sock)
+            return
+
+        try:
+            messages = self._clients[sock].feed(data)
+        except ipc.ProtocolError as e:
+            _LOGGER.error('dropping debugger: %s', e)
+            self._drop(sock)
+            return
+
+        for msg_type, payload in messages:
+            try:
+                handler = self._handlers.get(msg_type)
+                if handler is None:
+                    raise DebugError('Unknown request type: {0}'.format(msg_type))
+                response = ipc.encode(OK, handler(payload))
+            except (DebugError, struct.error, ValueError) as e:
+                response = ipc.encode(ERROR, str(e).encode('utf8'))
+            except Exception as e: # pylint: disable=broad-except
+                _LOGGER.exception('debug request failed')
+                response = ipc.encode(ERROR, str(e).encode('utf8'))
+            self._send(sock, response)
+            if sock not in self._clients:
+                return
+
+    # Requests. Each is passed the request payload and returns the response
+    # payload.
+
+    def _read_memory(self, payload):
+        address, length = _READ.unpack(payload)
+        if address + length > M6502.MEMORY_SIZE:
+            raise DebugError('Read beyond end of memory')
+        return self.sim._submit( # pylint: disable=protected-access
+            lambda: self.sim.mpu.read_memory(address, length)
+        )
+
+    def _write_memory(self, payload):
+        address, = _ADDRESS.unpack_from(payload)
+        data = payload[_ADDRESS.size:]
+        if address + len(data) > M6502.MEMORY_SIZE:
+            raise DebugError('Write beyond end of memory')
+        self.sim.poke(address, data)
+        return b''
+
+    def _read_registers(self, payload):
+        return self.sim._submit(self._registers) # pylint: disable=protected-access
+
+    def _write_registers(self, payload):
+        a, x, y, p, s, pc, _ = REGISTERS.unpack(payload)
+        self.sim._submit( # pylint: disable=protected-access
+            lambda: self.sim.mpu.set_registers(a, x, y, p, s, pc)
+        )
+        return b''
+
+    def _set_breakpoint(self, payload):
+        self.sim.add_breakpoint(_ADDRESS.unpack(payload)[0])
+        return b''
+
+    def _clear_breakpoint(self, payload):
+        self.sim.remove_breakpoint(_ADDRESS.unpack(payload)[0])
+        return b''
+
+    def _list_breakpoints(self, payload):
+        return b''.join(_ADDRESS.pack(a) for a in self.sim.breakpoints)
+
+    def _step(self, payload):
+        count, = _COUNT.unpack(payload)
+        if count > DebugServer.MAX_STEP:
+            raise DebugError('Cannot step more than {0} instructions'.format(DebugServer.MAX_STEP))
+        n_run = self.sim.step_instructions(count)
+        return _COUNT.pack(n_run) + self.sim._submit(self._registers) # pylint: disable=protected-access
+
+    def _continue(self, payload):
+        sim = self.sim
+        pc = sim._submit(lambda: sim.mpu.registers.pc) # pylint: disable=protected-access
+        if pc in sim.breakpoints:
+            sim.step_instructions(1)
+        sim.resume()
+        return b''
+
+    def _pause(self, payload):
+        self.sim.pause()
+        return self.sim._submit(self._registers) # pylint: disable=protected-access
+
+    def _status(self, payload):
+        def status():
+            sim, reason, address = self.sim, STOPPED_NONE, 0
+            if sim.error is not None:
+                reason = STOPPED_BREAKPOINT if isinstance(sim.error, BreakpointError) \
+                    else STOPPED_ERROR
+                address = getattr(sim.error, 'address', 0)
+            header = STATUS_HEADER.pack(1 if sim.is_paused() else 0, reason, address)
+            return header + self._registers()
+        return self.sim._submit(status) # pylint: disable=protected-access
+
+    def _snapshot(self, payload):
+        def snapshot():
+            return self._registers() + self.sim.mpu.read_memory(0, M6502.MEMORY_SIZE)
+        return self.sim._submit(snapshot) # pylint: disable=protected-access
+
+    def _restore(self, payload):
+        if len(payload) != REGISTERS.size + M6502.MEMORY_SIZE:
+            raise DebugError('Snapshot must be registers and 64K of memory')
+        a, x, y, p, s, pc, cycles = REGISTERS.unpack_from(payload)
+        state = ProcessorState(a, x, y, p, s, pc, cycles, 0)
+        self.sim.restore(MachineSnapshot(state, payload[REGISTERS.size:]))
+        return b''
+
+    def _registers(self):
+        # Called on the simulation thread.
+        r = self.sim.mpu.registers
+        return REGISTERS.pack(r.a, r.x, r.y, r.p, r.s, r.pc, self.sim.mpu.cycles)
@@ -0,0 +1,103 @@
+"""
+Count how often each address of the emulated machine is read and written.
+
+A HeatMap holds numpy arrays of per-address read and write counters which the
+processor increments directly while the heat map is attached to a BuriSim via
+BuriSim.heat_map, so counting needs no Python callbacks and looking at the
+counts involves no copying. The counters are never reset so that they can be
+sampled from another thread without racing with the processor. Instead,
+sample() takes the difference from the previous sample and adds it to a
+window of recent accesses which decays at each sample.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import numpy as np
+
+from burisim.lib6502 import M6502
+
+# Indices of the planes. These match the layout of the buffer described in
+# M6502.set_access_counts().
+READS = M6502.COUNT_READS // M6502.MEMORY_SIZE
+WRITES = M6502.COUNT_WRITES // M6502.MEMORY_SIZE
+
+class HeatMap(object):
+    """Read and write counts for each address. At each sample() the window of
+    recent accesses is multiplied by decay before the new accesses are added.
+    A decay of 0 makes the window the accesses since the previous sample and
+    a decay of 1 makes it all accesses since reset().
+
+    """
+    def __init__(self, decay=0.5):
+        shape = (M6502.COUNT_SIZE // M6502.MEMORY_SIZE, M6502.MEMORY_SIZE)
+        self.decay = decay
+        self.counts = np.zeros(shape, np.uint32)
+        self.window = np.zeros(shape, np.float32)
+        self._last = self.counts.copy()
+
+    @property
+    def buffer(self):
+        """A flat view of the counters to pass to M6502.set_access_counts().
+
+        """
+        return self.counts.reshape(-1)
+
+    @property
+    def reads(self):
+        """A uint32 array of the total number of reads of each address. The
+        count wraps around on overflow.
+
+        """
+        return self.counts[READS]
+
+    @property
+    def writes(self):
+        """A uint32 array of the total number of writes to each address. The
+        count wraps around on overflow.
+
+        """
+        return self.counts[WRITES]
+
+    def sample(self):
+        """Add the accesses since the previous sample to window, after
+        decaying it, and return window.
+
+        """
+        current = self.counts.copy()
+        # Unsigned subtraction gives the right answer across wrap around.
+        delta = current - self._last
+        self._last = current
+        self.window *= self.decay
+        self.window += delta
+        return self.window
+
+    def reset(self):
+        """Empty the window. Accesses before now are not sampled.
+
+        """
+        self._last = self.counts.copy()
+        self.window[...] = 0
+
+    def image(self, window=None):
+        """Return a 256x256 uint32 array of 0xffRRGGBB pixels showing window,
+        which defaults to the window of the last sample. There is a row per
+        page. Reads are green and writes red with brightness proportional to
+        the log of the number of accesses relative to the busiest address.
+
+        """
+        if window is None:
+            window = self.window
+        scaled = np.log1p(window)
+        peak = scaled.max()
+        if peak > 0:
+            scaled *= 255.0 / peak
+        levels = scaled.astype(np.uint32)
+        pixels = 0xff000000 | (levels[WRITES] << 16) | (levels[READS] << 8)
+        return pixels.reshape(0x100, 0x100)
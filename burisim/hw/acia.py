@@ -42,6 +42,9 @@ class ACIA(object):
     def register_listener(self, l):
         self._listeners.append(l)
 
+    def unregister_listener(self, l):
+        self._listeners.remove(l)
+
     def receive_byte(self, b):
         """Called when the device has received a byte from the outside world."""
         self._input_queue.put(b)
@@ -66,6 +69,26 @@ class ACIA(object):
         self._status_reg = 0b00010000
         self._control_reg = 0b00000000
         self._command_reg = 0b00000000
+        self._set_irq(True)
+        self._update_serial_port()
+
+    def get_state(self):
+        """Return the contents of the registers as a dict which can be passed
+        to set_state().
+
+        """
+        return dict(
+            recv_data=self._recv_data, status_reg=self._status_reg,
+            command_reg=self._command_reg, control_reg=self._control_reg,
+        )
+
+    def set_state(self, state):
+        """Restore registers saved by get_state(). Queued input is kept."""
+        self._recv_data = state['recv_data']
+        self._status_reg = state['status_reg']
+        self._command_reg = state['command_reg']
+        self._control_reg = state['control_reg']
+        self._set_irq(not self.irq)
         self._update_serial_port()
 
     def write_reg(self, reg_idx, value):
@@ -131,6 +154,7 @@ class ACIA(object):
         # NOTE: does not change control reg
         self._status_reg = 0b00010000
         self._command_reg = 0b00000000
+        self._set_irq(True)
         self._update_serial_port()
 
     def _tx(self, value):
@@ -1,15 +1,29 @@
 from PySide import QtCore
 
 class HD44780(QtCore.QObject):
+    """A HD44780 LCD controller. ddram holds the 128 character codes of the
+    display data RAM and cgram the 64 bytes of the character generator RAM
+    which define the glyphs of character codes 0 to 7, 8 bytes per glyph in
+    the format of CHAR_ROM. Codes 8 to 15 repeat them.
+
+    cgram_generations counts the changes to each of the 8 CGRAM glyphs so
+    that views can redraw only those which have changed.
+
+    """
     # emitted when cursor position, cursor style, scroll position or
     # screen contents have changed
     update = QtCore.Signal()
 
+    # Number of glyphs defined by CGRAM
+    CGRAM_GLYPHS = 8
+
     def __init__(self, *args, **kwargs):
         super(HD44780, self).__init__(*args, **kwargs)
         self.cursor_index = 0
         self.ddram = []
         self.cgram = []
+        self.cgram_generations = [0] * HD44780.CGRAM_GLYPHS
+        self._cgram_selected = False
         self.reset()
 
     def write(self, reg, value):
@@ -18,19 +32,28 @@ class HD44780(QtCore.QObject):
 
         # write data?
         if reg == 1:
-            if self.cursor_index < len(self.ddram):
+            if self._cgram_selected:
+                self._write_cgram(self.cursor_index, value)
+            elif self.cursor_index < len(self.ddram):
                 self.ddram[self.cursor_index] = value
             self._advance_ac()
         elif value & 0x80 == 0x80:
-            # set address
+            # set DDRAM address
             self.cursor_index = value & 0x7f
+            self._cgram_selected = False
+        elif value & 0x40 == 0x40:
+            # set CGRAM address
+            self.cursor_index = value & 0x3f
+            self._cgram_selected = True
         elif value == 0x01:
             # clear display and return home
             self.ddram = [ord(' ')] * 128
             self.cursor_index = 0
+            self._cgram_selected = False
         elif value & 0x02 == 0x02:
             # return home
             self.cursor_index = 0
+            self._cgram_selected = False
 
         self.update.emit()
 
@@ -40,7 +63,10 @@ class HD44780(QtCore.QObject):
 
         # read data?
         if reg == 1:
-            v = self.ddram[self.cursor_index % len(self.ddram)]
+            if self._cgram_selected:
+                v = self.cgram[self.cursor_index]
+            else:
+                v = self.ddram[self.cursor_index % len(self.ddram)]
             self._advance_ac()
             return v
         else:
@@ -52,6 +78,129 @@ class HD44780(QtCore.QObject):
         self.ddram = [ord(' ')] * 128 # display ram
         self.cgram = [0] * 64 # character gen ram
         self.cursor_index = 0 # address counter
+        self._cgram_selected = False
+        self.cgram_generations = [g + 1 for g in self.cgram_generations]
+
+    def get_state(self):
+        """Return the contents of the display as a dict which can be passed
+        to set_state().
+
+        """
+        return dict(
+            ddram=list(self.ddram), cgram=list(self.cgram),
+            cursor_index=self.cursor_index, cgram_selected=self._cgram_selected,
+        )
+
+    def set_state(self, state):
+        """Restore the display saved by get_state()."""
+        self.ddram = list(state['ddram'])
+        self.set_cgram(state['cgram'])
+        self.cursor_index = state['cursor_index']
+        self._cgram_selected = state['cgram_selected']
+        self.update.emit()
+
+    def set_cgram(self, data):
+        """Replace the contents of CGRAM with the 64 byte values in data,
+        e.g. when mirroring a remote display.
+
+        """
+        for addr, value in enumerate(bytearray(data)[:len(self.cgram)]):
+            self._write_cgram(addr, value)
+
+    def _write_cgram(self, addr, value):
+        # Only the low 5 bits of each row are pixels
+        value &= 0x1f
+        if self.cgram[addr] != value:
+            self.cgram[addr] = value
+            self.cgram_generations[addr >> 3] += 1
 
     def _advance_ac(self):
-        self.cursor_index = (self.cursor_index + 1) & 0x7f
+        mask = 0x3f if self._cgram_selected else 0x7f
+        self.cursor_index = (self.cursor_index + 1) & mask
+
+# The character generator ROM: 8 bytes for each of the 256 character codes,
+# one per row of the 5x8 glyph from the top with the leftmost pixel in bit 4.
+# The bottom row is where the cursor is drawn and so is blank. Codes 0x00 to
+# 0x0F display the character generator RAM on real hardware.
+CHAR_ROM = bytes(bytearray.fromhex(
+    # 0x00
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    # 0x10
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    # 0x20
+    '0000000000000000 0404040404000400 0a0a0a0000000000 0a0a1f0a1f0a0a00'
+    '040f140e051e0400 1819020408130300 0c12140815120d00 0c04080000000000'
+    '0204080808040200 0804020202040800 0004150e15040000 0004041f04040000'
+    '000000000c040800 0000001f00000000 00000000000c0c00 0001020408100000'
+    # 0x30
+    '0e11131519110e00 040c040404040e00 0e11010204081f00 1f02040201110e00'
+    '02060a121f020200 1f101e0101110e00 0608101e11110e00 1f01020408080800'
+    '0e11110e11110e00 0e11110f01020c00 000c0c000c0c0000 000c0c000c040800'
+    '0204081008040200 00001f001f000000 1008040204081000 0e11010204000400'
+    # 0x40
+    '0e11010d15150e00 0e1111111f111100 1e11111e11111e00 0e11101010110e00'
+    '1e11111111111e00 1f10101e10101f00 1f10101e10101000 0e11101711110f00'
+    '1111111f11111100 0e04040404040e00 0702020202120c00 1112141814121100'
+    '1010101010101f00 111b151511111100 1111191513111100 0e11111111110e00'
+    # 0x50
+    '1e11111e10101000 0e11111115120d00 1e11111e14121100 0f10100e01011e00'
+    '1f04040404040400 1111111111110e00 11111111110a0400 1111111515150a00'
+    '11110a040a111100 1111110a04040400 1f01020408101f00 0e08080808080e00'
+    '110a1f041f040400 0e02020202020e00 040a110000000000 0000000000001f00'
+    # 0x60
+    '0804020000000000 00000e010f110f00 1010161911111e00 00000e1010110e00'
+    '01010d1311110f00 00000e111f100e00 0609081c08080800 00000f110f010e00'
+    '1010161911111100 04000c0404040e00 0206020202120c00 1010121418141200'
+    '0c04040404040e00 00001a1515111100 0000161911111100 00000e1111110e00'
+    # 0x70
+    '00001e111e101000 00000d130f010100 0000161910101000 00000f100e011e00'
+    '08081c0808090600 0000111111130d00 00001111110a0400 0000111115150a00'
+    '0000110a040a1100 000011110f010e00 00001f0204081f00 0204040804040200'
+    '0404040404040400 0804040204040800 0004021f02040000 0004081f08040000'
+    # 0x80
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    # 0x90
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    '0000000000000000 0000000000000000 0000000000000000 0000000000000000'
+    # 0xA0
+    '0000000000000000 000000001c141c00 0704040400000000 0000000404041c00'
+    '0000000010080400 0000000c0c000000 001f011f01020400 00001f0106040800'
+    '000002040c140400 0000041f11010600 0000001f04041f00 0000021f060a1200'
+    '0000081f090a0800 0000000e02021f00 00001e021e021e00 0000001515010600'
+    # 0xB0
+    '000000001f000000 1f01050604040800 0102040c14040400 041f111101020400'
+    '00001f0404041f00 021f02060a120200 081f090909091200 041f041f04040400'
+    '000f091101020c00 080f120202020400 001f010101011f00 0a1f0a0a02040800'
+    '0018011901021c00 001f0102040a1100 081f090a08080700 0011110901020c00'
+    # 0xC0
+    '000f091503020c00 021c041f04040800 0015150101020400 0e001f0404040800'
+    '0808080c0a080800 04041f0404081000 000e000000001f00 001f010a040a1000'
+    '041f02040e150400 0202020202040800 0004021111111100 10101f1010100f00'
+    '001f010101020c00 0008140201010000 041f040415150400 001f01010a040200'
+    # 0xD0
+    '000e000e000e0100 00040810111f0100 0001010a040a1000 001f081f08080700'
+    '08081f090a080800 000e020202021f00 001f011f01011f00 0e001f0101020400'
+    '1212121202040800 0004141415151600 0010101112141800 001f111111111f00'
+    '001f111101020400 0018000101021c00 0412080000000000 1c141c0000000000'
+    # 0xE0
+    '0000091512120d00 0a000e010f110f00 000e111e111e1000 00000e100c110e00'
+    '00111111131d1000 00000f1412110e00 00060911111e1000 000f1111110f0100'
+    '0000070404140800 021a020000000000 0200060202020200 0014081400000000'
+    '040e14150e040000 08081c081c080f00 0e00161911111100 0a000e1111110e00'
+    # 0xF0
+    '00161911111e1000 000d1311110f0100 0e111f11110e0000 000000000b151a00'
+    '000e11110a1b0000 0a00111111130d00 1f10080408101f00 001f0a0a0a130000'
+    '1f00110a040a1100 00111111110f0100 011e041f04040000 001f080f09110000'
+    '001f151f11110000 000004001f000400 0000000000000000 1f1f1f1f1f1f1f00'
+))
@@ -0,0 +1,79 @@
+"""
+Message framing for the local IPC channel between a headless simulator server
+(burisim.server) and its clients (burisim.client).
+
+Each message is a 4 byte big-endian payload length, a 1 byte message type and
+then the payload. Bulk state such as memory and registers is not sent over the
+channel at all; it is shared via the burisim.backing file or shared memory
+segment named in the HELLO message.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import json
+import struct
+
+# Protocol version sent in HELLO
+VERSION = 2
+
+# Message types.
+HELLO = 1   # server -> client: JSON with version and backing path
+SERIAL = 2  # both ways: bytes sent by (server) or to (client) ACIA1
+LCD = 3     # server -> client: cursor index byte, the 128 byte DDRAM and the
+            # 64 byte CGRAM
+COMMAND = 4 # client -> server: JSON control command, see burisim.server
+ERROR = 5   # server -> client: UTF-8 error message for a failed command
+
+_HEADER = struct.Struct('>IB')
+
+# Largest payload accepted. Guards against a corrupt stream.
+MAX_PAYLOAD = 0x100000
+
+class ProtocolError(Exception):
+    pass
+
+def encode(msg_type, payload=b''):
+    """Return the bytes framing a message of type msg_type with the given bytes
+    payload.
+
+    """
+    return _HEADER.pack(len(payload), msg_type) + bytes(payload)
+
+def encode_json(msg_type, obj):
+    return encode(msg_type, json.dumps(obj).encode('utf8'))
+
+def decode_json(payload):
+    return json.loads(bytes(payload).decode('utf8'))
+
+class MessageReader(object):
+    """Reassembles messages from a stream of bytes which may arrive in
+    arbitrary chunks.
+
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add data received from the stream and return a list of (msg_type,
+        payload) pairs for each message now complete.
+
+        """
+        self._buffer.extend(data)
+        messages = []
+        while len(self._buffer) >= _HEADER.size:
+            length, msg_type = _HEADER.unpack_from(bytes(self._buffer[:_HEADER.size]))
+            if length > MAX_PAYLOAD:
+                raise ProtocolError('Message too long: {0} bytes'.format(length))
+            end = _HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            messages.append((msg_type, bytes(self._buffer[_HEADER.size:end])))
+            del self._buffer[:end]
+        return messages
@@ -1,3 +1,6 @@
+from collections import namedtuple
+import time
+from timeit import default_timer
 import weakref
 
 import intervaltree
@@ -29,8 +32,7 @@ def _call_cb(mpu, addr, _):
     obj = _mpu_to_obj(mpu)
     if obj is None:
         return int(0)
-    obj._call(addr) # pylint: disable=no-member,protected-access
-    return int(0)
+    return int(obj._call(addr) or 0) # pylint: disable=no-member,protected-access
 
 @ffi.callback("M6502_Callback")
 def _write_cb(mpu, addr, data):
@@ -40,29 +42,183 @@ def _write_cb(mpu, addr, data):
     obj._write(addr, data) # pylint: disable=no-member,protected-access
     return int(0)
 
+# A native call handler for register_native_call_handler() which makes calls to
+# a subroutine return immediately as if it consisted of a single RTS.
+NATIVE_TRAP_RETURN = lib.M6502_trapReturn
+
+ProcessorState = namedtuple(
+    'ProcessorState', 'a x y p s pc cycles sequence'
+)
+ProcessorState.__doc__ = """A consistent snapshot of the processor
+registers along with the total number of clock ticks run at the time the
+snapshot was published. sequence increases with each publication.
+
+"""
+
+# A monotonic clock in integer nanoseconds for timing handlers.
+_perf_counter_ns = getattr(time, 'perf_counter_ns', None) or (
+    lambda: int(default_timer() * 1e9)
+)
+
+class HandlerStats(object):
+    """The number of times a read, write or call handler has been called, the
+    total wall time spent in it and the (begin, end) address ranges it was
+    registered for. If latency is being recorded, see M6502.record_latency,
+    histogram is a list of HISTOGRAM_BUCKETS counts where bucket 0 counts
+    calls taking no measurable time and bucket i > 0 counts calls taking at
+    least 2**(i-1) and less than 2**i nanoseconds. The last bucket also counts
+    anything slower. Otherwise histogram is None.
+
+    """
+    HISTOGRAM_BUCKETS = 32
+
+    __slots__ = ('calls', 'nsec', 'ranges', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.nsec = 0
+        self.ranges = []
+        self.histogram = None
+
+    @property
+    def seconds(self):
+        return self.nsec * 1e-9
+
+    def record(self, nsec):
+        """Record a call taking nsec nanoseconds.
+
+        """
+        self.calls += 1
+        self.nsec += nsec
+        histogram = self.histogram
+        if histogram is not None:
+            histogram[min(nsec.bit_length(), HandlerStats.HISTOGRAM_BUCKETS - 1)] += 1
+
+    def percentile(self, q):
+        """Return an upper bound in nanoseconds on the time taken by q percent
+        of the calls recorded in histogram or None if there are none.
+
+        """
+        histogram = self.histogram
+        if histogram is None:
+            return None
+        total = sum(histogram)
+        if total == 0:
+            return None
+        seen = 0
+        for idx, count in enumerate(histogram):
+            seen += count
+            if seen * 100 >= q * total:
+                return 1 << idx
+        return 1 << (len(histogram) - 1)
+
 class M6502(object):
     """A 65C02 processor emulator.
 
     """
-    def __init__(self):
+    # Number of level-sensitive IRQ lines supported by set_irq_line()
+    MAX_IRQ_LINES = 24
+
+    # Values for stop_reason
+    STOP_NONE = lib.M6502_StopNone
+    STOP_ILLEGAL = lib.M6502_StopIllegal
+    STOP_STP = lib.M6502_StopSTP
+    STOP_FAULT = lib.M6502_StopFault
+    STOP_TRACE = lib.M6502_StopTrace
+    STOP_BREAK = lib.M6502_StopBreak
+
+    # Values for page attributes. See set_page_attributes().
+    PAGE_RAM = lib.M6502_PageRAM
+    PAGE_IO = lib.M6502_PageIO
+    PAGE_ROM_IGNORE = lib.M6502_PageROMIgnore
+    PAGE_ROM_FAULT = lib.M6502_PageROMFault
+
+    # Size of the address space and of the buffer needed to publish state
+    MEMORY_SIZE = 0x10000
+    STATE_SIZE = ffi.sizeof('M6502_State')
+
+    # Offsets of the planes in a coverage buffer and its size. See
+    # set_coverage().
+    COVERAGE_EXEC = lib.M6502_CoverageExec
+    COVERAGE_READ = lib.M6502_CoverageRead
+    COVERAGE_WRITE = lib.M6502_CoverageWrite
+    COVERAGE_SIZE = lib.M6502_CoverageSize
+
+    # Offsets of the planes in an access counts buffer and its length in
+    # counters. See set_access_counts().
+    COUNT_READS = lib.M6502_CountReads
+    COUNT_WRITES = lib.M6502_CountWrites
+    COUNT_SIZE = lib.M6502_CountSize
+
+    def __init__(self, memory=None, state=None):
+        """If memory is not None, it is a writable buffer, e.g. an mmap, of at
+        least MEMORY_SIZE bytes which is used as the processor's memory
+        instead of allocating it. Similarly, if state is not None, it is a
+        writable buffer of at least STATE_SIZE bytes to which the processor
+        state is published. The buffers must outlive this object. See
+        burisim.backing.
+
+        """
+        # Keep any external buffers alive for as long as we are.
+        self._backing = []
+        self._coverage = None
+        self._access_counts = None
+        self._profile = None
+        self._trace = None
+        self._breakpoints = None
+        mem_ptr = ffi.NULL
+        if memory is not None:
+            mem_ptr = self._from_buffer(memory, M6502.MEMORY_SIZE, 'uint8_t *')
+
         # Create underlying C object wrapped so that M6502_delete is called
         # automatically on destruction.
         self._mpu = ffi.gc(
-            lib.M6502_new(ffi.NULL, ffi.NULL, ffi.NULL),
+            lib.M6502_new(ffi.NULL, mem_ptr, ffi.NULL),
             lib.M6502_delete
         )
 
+        if state is not None:
+            lib.M6502_setState(
+                self._mpu,
+                self._from_buffer(state, M6502.STATE_SIZE, 'M6502_State *')
+            )
+
         # Three interval trees mapping address intervals to callables for read,
         # write and call callbacks.
         self._read_cbs = intervaltree.IntervalTree()
         self._write_cbs = intervaltree.IntervalTree()
         self._call_cbs = intervaltree.IntervalTree()
 
+        # HandlerStats for each handler keyed by (kind, name).
+        self.handler_stats = {}
+        self._record_latency = False
+
         # Record a weak reference ourselves in the mapping dict for callbacks.
         _map_dict[self._mpu] = weakref.ref(self)
         self.reset()
 
-    def register_read_handler(self, offset, length, read_cb):
+    def _from_buffer(self, buf, min_size, ctype):
+        c_buf = ffi.from_buffer(buf)
+        if len(c_buf) < min_size:
+            raise ValueError(
+                'Buffer is too small: need {0} bytes'.format(min_size)
+            )
+        self._backing.append(c_buf)
+        return ffi.cast(ctype, c_buf)
+
+    def _handler(self, kind, name, cb, offset, length):
+        if name is None:
+            name = '${0:04X}-${1:04X}'.format(offset, offset+length-1)
+        stats = self.handler_stats.get((kind, name))
+        if stats is None:
+            stats = HandlerStats()
+            if self._record_latency:
+                stats.histogram = [0] * HandlerStats.HISTOGRAM_BUCKETS
+            self.handler_stats[(kind, name)] = stats
+        stats.ranges.append((offset, offset+length))
+        return (cb, stats)
+
+    def register_read_handler(self, offset, length, read_cb, name=None):
         """Registers read_cb as a callable called each time an address in the
         range [offset, offset_length) is read. Note that this is *non-inclusive*
         at the high address range. read_cb will be called with a single argument
@@ -73,28 +229,57 @@ class M6502(object):
         If multiple callbacks are defined for a given location, the order they
         are called in is not guaranteed. The one called last will "win".
 
+        Calls and time spent are accumulated in handler_stats under ("read",
+        name). name defaults to the address range, e.g. "$DFFC-$DFFF".
+
         """
-        self._read_cbs.addi(offset, offset+length, read_cb)
+        self._read_cbs.addi(offset, offset+length, self._handler('read', name, read_cb, offset, length))
         for v in range(offset, offset+length):
             lib.M6502_setReadCallback(self._mpu, v, _read_cb)
 
-    def register_call_handler(self, offset, length, call_cb):
+    def register_call_handler(self, offset, length, call_cb, name=None):
         """Registers call_cb as a callable called each time an address in the
         range [offset, offset_length) is jumped to due to anything other than a
         relative branch. Note that this is *non-inclusive* at the high address
         range. call_cb will be called with a single argument giving the address
-        relative to offset, i.e. in the range [0, length). It should return the
-        value to be call from that location in the range [0x00, 0xFF].
+        relative to offset, i.e. in the range [0, length).
+
+        If call_cb returns None or 0, execution continues at the called address
+        as normal. Otherwise, the return value is the address at which
+        execution continues instead. This allows call_cb to act as a trap which
+        replaces a ROM routine. While call_cb runs, registers reflects the
+        processor state and call_cb may modify registers and memory. Register
+        changes only take effect if an address is returned. A trap replacing a
+        subroutine called via JSR will usually end with "return
+        mpu.return_from_subroutine()". Use charge_cycles() to account for the
+        time the replaced routine would have taken.
 
         If multiple callbacks are defined for a given location, the order they
-        are called in is not guaranteed.
+        are called in is not guaranteed. The one called last will "win".
+
+        Calls and time spent are accumulated in handler_stats under ("call",
+        name). name defaults to the address range, e.g. "$DFFC-$DFFF".
 
         """
-        self._call_cbs.addi(offset, offset+length, call_cb)
+        self._call_cbs.addi(offset, offset+length, self._handler('call', name, call_cb, offset, length))
         for v in range(offset, offset+length):
             lib.M6502_setCallCallback(self._mpu, v, _call_cb)
 
-    def register_write_handler(self, offset, length, write_cb):
+    def register_native_call_handler(self, offset, length, c_callback):
+        """Like register_call_handler() but installs a C function pointer with
+        the M6502_Callback signature directly, e.g. NATIVE_TRAP_RETURN or a
+        function from another cffi module. The callback is passed the M6502
+        pointer and the absolute address called. It should return 0 or the
+        address at which to continue and may add to the M6502 cycle_charge
+        field to account for emulated ticks. Any Python call handlers for the
+        range are replaced.
+
+        """
+        self._call_cbs.remove_envelop(offset, offset+length)
+        for v in range(offset, offset+length):
+            lib.M6502_setCallCallback(self._mpu, v, c_callback)
+
+    def register_write_handler(self, offset, length, write_cb, name=None):
         """Registers write_cb as a writeable called each time an address in the
         range [offset, offset_length) is written to. Note that this is
         *non-inclusive* at the high address range. write_cb will be called with
@@ -104,11 +289,51 @@ class M6502(object):
         If multiple callbacks are defined for a given location, the order they
         are called in is not guaranteed.
 
+        Calls and time spent are accumulated in handler_stats under ("write",
+        name). name defaults to the address range, e.g. "$DFFC-$DFFF".
+
         """
-        self._write_cbs.addi(offset, offset+length, write_cb)
+        self._write_cbs.addi(offset, offset+length, self._handler('write', name, write_cb, offset, length))
         for v in range(offset, offset+length):
             lib.M6502_setWriteCallback(self._mpu, v, _write_cb)
 
+    @property
+    def record_latency(self):
+        """If True, each HandlerStats in handler_stats keeps a histogram of
+        the time taken by each call of its handler. Setting this to False
+        discards the histograms. Defaults to False.
+
+        """
+        return self._record_latency
+
+    @record_latency.setter
+    def record_latency(self, v):
+        self._record_latency = bool(v)
+        for stats in self.handler_stats.values():
+            if not v:
+                stats.histogram = None
+            elif stats.histogram is None:
+                stats.histogram = [0] * HandlerStats.HISTOGRAM_BUCKETS
+
+    def set_page_attributes(self, offset, length, attr):
+        """Set the attributes of each 256 byte page overlapping the range
+        [offset, offset+length) to one of the PAGE_... constants. Pages are
+        PAGE_RAM by default. Writes to a PAGE_ROM_IGNORE page are discarded
+        and writes to a PAGE_ROM_FAULT page are discarded and stop the
+        processor with STOP_FAULT. PAGE_IO pages behave as RAM but are never
+        included in the block cache. Write handlers take precedence over page
+        attributes. Checking attributes is done natively and is much cheaper
+        than a write handler.
+
+        """
+        lib.M6502_setPageAttrs(self._mpu, offset, length, attr)
+
+    def page_attributes(self, addr):
+        """Return the attributes of the page containing addr.
+
+        """
+        return self._mpu.page_attrs[(addr >> 8) & 0xff]
+
     @property
     def memory(self):
         """A list-like object which allows direct read/write access to the 64K
@@ -118,6 +343,301 @@ class M6502(object):
         """
         return self._mpu.memory
 
+    @property
+    def memory_buffer(self):
+        """A writable buffer over the 64K of memory, e.g. for numpy. Like
+        memory, this does not trigger any callbacks.
+
+        """
+        return ffi.buffer(self._mpu.memory, M6502.MEMORY_SIZE)
+
+    def read_memory(self, offset, length):
+        """Return a bytes object copied from memory in the range [offset,
+        offset+length). Like memory, this does not trigger any callbacks.
+
+        """
+        return ffi.buffer(self._mpu.memory + offset, length)[:]
+
+    def write_memory(self, offset, data):
+        """Copy the bytes-like object data into memory starting at offset.
+        Like memory, this does not trigger any callbacks. The block cache is
+        flushed if data overlaps it.
+
+        """
+        ffi.memmove(self._mpu.memory + offset, data, len(data))
+        start, size = self._mpu.block_start, self._mpu.block_size
+        if size > 0 and offset < start + size and offset + len(data) > start:
+            lib.M6502_flushBlockCache(self._mpu)
+
+    def set_block_cache(self, offset, length):
+        """Enable the block cache for code in the range [offset,
+        offset+length). Straight-line runs of instructions in this range are
+        decoded once and then run without being fetched and decoded again.
+        Control flow and instructions which directly access a location with a
+        read or write handler or in a PAGE_IO page are always interpreted. The range should be
+        read-only, e.g. ROM, since modifying memory other than via
+        write_memory() does not flush the cache. Pass a length of 0 to disable
+        the cache. It is disabled by default.
+
+        """
+        lib.M6502_setBlockCache(self._mpu, offset, length)
+
+    def flush_block_cache(self):
+        """Discard all cached blocks. Call this after modifying memory covered
+        by the block cache via memory.
+
+        """
+        lib.M6502_flushBlockCache(self._mpu)
+
+    @property
+    def block_cache(self):
+        """A (offset, length) pair giving the range covered by the block cache
+        as set by set_block_cache().
+
+        """
+        return (self._mpu.block_start, self._mpu.block_size)
+
+    def set_coverage(self, coverage):
+        """Record code coverage into coverage, a writable buffer of at least
+        COVERAGE_SIZE bytes such as a numpy array, or stop recording if
+        coverage is None. The buffer holds three planes of MEMORY_SIZE bytes
+        at offsets COVERAGE_EXEC, COVERAGE_READ and COVERAGE_WRITE. The byte
+        for an address in each plane is set to 1 when an instruction starting
+        at the address is executed or when an instruction reads or writes the
+        address as data. Bytes are never cleared so zero the buffer to start
+        afresh. The buffer is kept alive until coverage is next set.
+
+        """
+        if coverage is None:
+            lib.M6502_setCoverage(self._mpu, ffi.NULL)
+            self._coverage = None
+            return
+
+        c_buf = ffi.from_buffer(coverage)
+        if len(c_buf) < M6502.COVERAGE_SIZE:
+            raise ValueError(
+                'Buffer is too small: need {0} bytes'.format(M6502.COVERAGE_SIZE)
+            )
+        lib.M6502_setCoverage(self._mpu, ffi.cast('uint8_t *', c_buf))
+        self._coverage = c_buf
+
+    def set_access_counts(self, counts):
+        """Count memory accesses into counts, a writable buffer of at least
+        COUNT_SIZE native-endian 32-bit counters such as a numpy uint32 array,
+        or stop counting if counts is None. The buffer holds two planes of
+        MEMORY_SIZE counters at offsets COUNT_READS and COUNT_WRITES. The
+        counter for an address is incremented, wrapping around, each time an
+        instruction reads or writes the address as data. Counters are never
+        reset. The buffer is kept alive until counts is next set.
+
+        """
+        if counts is None:
+            lib.M6502_setAccessCounts(self._mpu, ffi.NULL)
+            self._access_counts = None
+            return
+
+        c_buf = ffi.from_buffer(counts)
+        if len(c_buf) < M6502.COUNT_SIZE * 4:
+            raise ValueError(
+                'Buffer is too small: need {0} counters'.format(M6502.COUNT_SIZE)
+            )
+        lib.M6502_setAccessCounts(self._mpu, ffi.cast('uint32_t *', c_buf))
+        self._access_counts = c_buf
+
+    def set_profile(self, profile):
+        """Follow calls and returns into profile, a cffi "M6502_Profile *",
+        or stop profiling if profile is None. See burisim.profile. The profile
+        is kept alive until the profile is next set.
+
+        """
+        lib.M6502_setProfile(self._mpu, ffi.NULL if profile is None else profile)
+        self._profile = profile
+
+    def set_breakpoints(self, breakpoints):
+        """Stop at breakpoints, a writable buffer of at least MEMORY_SIZE
+        bytes such as a numpy array, or stop checking for breakpoints if
+        breakpoints is None. run() stops with STOP_BREAK before executing an
+        instruction at an address whose byte is non-zero unless the previous
+        call stopped at that breakpoint, so that calling run() again continues
+        past it. The buffer is kept alive until breakpoints are next set.
+
+        """
+        if breakpoints is None:
+            lib.M6502_setBreakpoints(self._mpu, ffi.NULL)
+            self._breakpoints = None
+            return
+
+        c_buf = ffi.from_buffer(breakpoints)
+        if len(c_buf) < M6502.MEMORY_SIZE:
+            raise ValueError(
+                'Buffer is too small: need {0} bytes'.format(M6502.MEMORY_SIZE)
+            )
+        lib.M6502_setBreakpoints(self._mpu, ffi.cast('uint8_t *', c_buf))
+        self._breakpoints = c_buf
+
+    def set_trace(self, trace):
+        """Append a record of each instruction run to trace, a cffi
+        "M6502_Trace *", or stop tracing if trace is None. See
+        burisim.trace. The trace is kept alive until the trace is next set.
+
+        """
+        lib.M6502_setTrace(self._mpu, ffi.NULL if trace is None else trace)
+        self._trace = trace
+
+    @property
+    def registers(self):
+        """A struct-like object with fields a, x, y, p, s and pc giving direct
+        access to the processor registers. Reading and writing is cheap but is
+        only meaningful when the processor is not running. Use state() to
+        observe a running processor.
+
+        """
+        return self._mpu.registers
+
+    @property
+    def cycles(self):
+        """Total number of clock ticks run by the processor.
+
+        """
+        return self._mpu.cycles
+
+    def state(self):
+        """Return a ProcessorState giving the registers and cycle count as of
+        the end of the most recent 1ms slice of run(). This never blocks the
+        processor and may be called from any thread.
+
+        """
+        s = ffi.new('M6502_State *')
+        lib.M6502_getState(self._mpu, s)
+        r = s.registers
+        return ProcessorState(r.a, r.x, r.y, r.p, r.s, r.pc, s.cycles, s.sequence)
+
+    def publish_state(self):
+        """Publish the current registers so that they are reflected by state().
+        This is done automatically by run() and reset() and so only needs to
+        be called after modifying registers directly. Do not call this while
+        run() is in progress on another thread.
+
+        """
+        lib.M6502_publish(self._mpu)
+
+    def set_registers(self, a, x, y, p, s, pc):
+        """Set all the registers and publish them. Unlike writing to
+        registers directly, this also forgets any WAI instruction being
+        waited on so that the processor continues from pc. Do not call this
+        while run() is in progress on another thread.
+
+        """
+        lib.M6502_setRegisters(self._mpu, ffi.new('M6502_Registers *', {
+            'a': a, 'x': x, 'y': y, 'p': p, 's': s, 'pc': pc,
+        }))
+
+    def return_from_subroutine(self):
+        """Pop a return address from the stack as RTS would and return the
+        address at which execution should continue. For use by call handlers
+        which replace a subroutine called via JSR.
+
+        """
+        r, mem = self._mpu.registers, self._mpu.memory
+        addr = mem[0x100 + ((r.s + 1) & 0xff)]
+        addr |= mem[0x100 + ((r.s + 2) & 0xff)] << 8
+        r.s = (r.s + 2) & 0xff
+        return (addr + 1) & 0xffff
+
+    def charge_cycles(self, ticks):
+        """Called from within a call handler to add ticks to the emulated
+        time, e.g. to account for the ticks taken by the routine it replaces.
+
+        """
+        self._mpu.cycle_charge += ticks
+
+    @property
+    def trap_cycles(self):
+        """Total number of ticks charged by call handlers. These are included in
+        cycles.
+
+        """
+        return self._mpu.trap_cycles
+
+    @property
+    def target_freq(self):
+        """The clock frequency, in kHz, which run() is throttled to. If 0, run()
+        is not throttled.
+
+        """
+        return self._mpu.target_freq
+
+    @target_freq.setter
+    def target_freq(self, v):
+        self._mpu.target_freq = v
+
+    @property
+    def idle_detection(self):
+        """If True, run() detects busy-wait loops which poll a single I/O
+        location and skips ahead to the end of the current 1ms slice, or to the
+        end of the run if not throttled. Defaults to True.
+
+        """
+        return self._mpu.idle_detect != 0
+
+    @idle_detection.setter
+    def idle_detection(self, v):
+        self._mpu.idle_detect = 1 if v else 0
+
+    @property
+    def idle_cycles(self):
+        """Total number of clock ticks skipped by idle detection. These are
+        included in cycles.
+
+        """
+        return self._mpu.idle_cycles
+
+    @property
+    def instructions(self):
+        """Total number of instructions run.
+
+        """
+        return self._mpu.instructions
+
+    @property
+    def irqs(self):
+        """Total number of IRQs taken. BRK is not counted.
+
+        """
+        return self._mpu.irqs
+
+    @property
+    def nmis(self):
+        """Total number of NMIs taken.
+
+        """
+        return self._mpu.nmis
+
+    @property
+    def callbacks_run(self):
+        """Total number of read, write and call callbacks called by run(),
+        including native call handlers.
+
+        """
+        return self._mpu.callbacks_run
+
+    @property
+    def callback_time(self):
+        """Total wall time in seconds spent in callbacks called by run(). For
+        Python handlers this includes acquiring the GIL and dispatching to the
+        handler as well as the time accumulated in handler_stats.
+
+        """
+        return self._mpu.callback_nsec * 1e-9
+
+    @property
+    def sleep_time(self):
+        """Total wall time in seconds run() has spent sleeping to throttle the
+        processor or waiting for an interrupt.
+
+        """
+        return self._mpu.sleep_nsec * 1e-9
+
     def run(self, ticks=0):
         """Run the processor for at least the specified number of clock ticks.
         If ticks is 0, the processor is run forever. Due to an implementation
@@ -130,6 +650,46 @@ class M6502(object):
         """
         return lib.M6502_run(self._mpu, ticks)
 
+    def step(self, instructions, ticks=0):
+        """Run at most the specified number of instructions, one at a time
+        rather than in cached blocks, or until at least ticks clock ticks have
+        run. If ticks is 0, there is no limit on clock ticks.
+
+        Returns the number of instructions run. This is less than the number
+        requested if the tick limit was reached or the processor stopped
+        early, see stop_reason.
+
+        """
+        return lib.M6502_step(self._mpu, instructions, ticks)
+
+    @property
+    def stop_reason(self):
+        """Why the last call to run() stopped early. One of the STOP_...
+        constants. If not STOP_NONE, stop_pc is the address of the offending
+        instruction which will be executed again by the next call to run().
+        For STOP_ILLEGAL, stop_data is the opcode. For STOP_FAULT, the
+        faulting instruction has completed without writing, stop_pc is the
+        address of the next instruction and stop_address and stop_data are
+        the address and value of the write. For STOP_TRACE, a trace flush
+        asked to stop, stop_pc is the address of the next instruction and
+        the next call to run() continues from it. For STOP_BREAK, stop_pc is
+        the address of the breakpoint, see set_breakpoints().
+
+        """
+        return self._mpu.stop_reason
+
+    @property
+    def stop_pc(self):
+        return self._mpu.stop_pc
+
+    @property
+    def stop_address(self):
+        return self._mpu.stop_address
+
+    @property
+    def stop_data(self):
+        return self._mpu.stop_data
+
     def reset(self):
         """Trigger a processor reset.
 
@@ -137,18 +697,39 @@ class M6502(object):
         lib.M6502_reset(self._mpu)
 
     def nmi(self):
-        """Trigger a non-maskable interrupt.
+        """Trigger a non-maskable interrupt. The interrupt is taken before the
+        next instruction run.
 
+        This call is thread-safe.
         """
         lib.M6502_nmi(self._mpu)
 
     def irq(self):
-        """Trigger a maskable interrupt.
+        """Trigger a one-shot maskable interrupt. This also wakes a processor
+        waiting on a WAI instruction.
 
         This call is thread-safe.
         """
         lib.M6502_irq(self._mpu)
 
+    def set_irq_line(self, line, asserted):
+        """Set the state of IRQ line number line, 0 <= line < MAX_IRQ_LINES.
+        IRQ lines are level-sensitive: an interrupt is taken whenever any line
+        is asserted and interrupts are enabled.
+
+        This call is thread-safe.
+        """
+        if line < 0 or line >= M6502.MAX_IRQ_LINES:
+            raise IndexError('No such IRQ line: ' + repr(line))
+        lib.M6502_setIRQLine(self._mpu, line, 1 if asserted else 0)
+
+    @property
+    def irq_lines(self):
+        """A bitmask of the currently asserted IRQ lines.
+
+        """
+        return lib.M6502_getIRQLines(self._mpu)
+
     def exit(self):
         """Cause the current call to run() to exit ASAP. If no call to run() is
         currently in progress, the next one will return.
@@ -186,7 +767,10 @@ class M6502(object):
     def _read(self, addr):
         v = 0
         for i in self._read_cbs[addr]:
-            v = i.data(addr - i.begin)
+            cb, stats = i.data
+            start = _perf_counter_ns()
+            v = cb(addr - i.begin)
+            stats.record(_perf_counter_ns() - start)
 
         # reflect in memory array
         self._mpu.memory[addr] = v
@@ -199,8 +783,18 @@ class M6502(object):
         self._mpu.memory[addr] = data
 
         for i in self._write_cbs[addr]:
-            i.data(addr - i.begin, data)
+            cb, stats = i.data
+            start = _perf_counter_ns()
+            cb(addr - i.begin, data)
+            stats.record(_perf_counter_ns() - start)
 
     def _call(self, addr):
+        continuation = None
         for i in self._call_cbs[addr]:
-            i.data(addr - i.begin)
+            cb, stats = i.data
+            start = _perf_counter_ns()
+            v = cb(addr - i.begin)
+            stats.record(_perf_counter_ns() - start)
+            if v is not None:
+                continuation = v
+        return continuation
@@ -0,0 +1,289 @@
+"""
+Telemetry of a running BuriSim.
+
+BuriSim.metrics is a Metrics which the simulation thread updates after each
+slice. Its sample() method returns a dict of counters and rates which is safe
+to take from any thread. Most counters are kept natively by the processor, see
+M6502.instructions and friends, so that collecting them costs next to
+nothing.
+
+For long-running headless instances, a JsonLinesExporter appends a sample to a
+file at a fixed interval and a PrometheusExporter serves the latest values in
+the Prometheus text exposition format over HTTP.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import threading
+import time
+from timeit import default_timer
+
+from past.builtins import basestring # pylint: disable=redefined-builtin
+
+_LOGGER = logging.getLogger(__name__)
+
+class Metrics(object):
+    """Telemetry for the processor mpu, a burisim.lib6502.M6502. The
+    simulation thread calls record_slice() after each call to M6502.run().
+
+    sample() returns a dict with the following keys:
+
+        time                    Wall clock time of the sample.
+        cycles                  Total clock ticks emulated.
+        instructions            Total instructions run.
+        idle_cycles             Ticks skipped by idle detection.
+        trap_cycles             Ticks charged by call handlers.
+        irqs, nmis              Interrupts taken.
+        mhz_1s, mhz_10s, mhz_60s
+                                Effective clock speed over the last 1, 10
+                                and 60 seconds.
+        slices                  Number of calls to run().
+        run_seconds             Wall time spent in run().
+        sleep_seconds           Time in run() spent sleeping to throttle the
+                                processor or waiting for an interrupt.
+        execute_seconds         Time in run() spent emulating.
+        callbacks               Read, write and call callbacks called.
+        callback_seconds        Time spent in callbacks.
+        handler_seconds         Time spent running Python handlers.
+        callback_overhead_seconds
+                                Time spent in callbacks but not in handlers,
+                                i.e. acquiring the GIL and finding the
+                                handler. Contention for the GIL shows here.
+        handlers                A list of dicts with keys kind ("read",
+                                "write" or "call"), name, calls and seconds
+                                for each handler. See M6502.handler_stats.
+
+    Times are in seconds and all counters are totals since mpu was created.
+
+    """
+    # Windows, in seconds, over which the effective clock speed is measured
+    WINDOWS = (1, 10, 60)
+
+    # Minimum interval, in seconds, between points in the speed history
+    HISTORY_INTERVAL = 0.1
+
+    def __init__(self, mpu):
+        self._mpu = mpu
+        self._lock = threading.Lock()
+        self._slices = 0
+        self._run_seconds = 0.0
+
+        # (time, cycles) pairs covering the longest window
+        self._history = deque()
+
+    def record_slice(self, seconds):
+        """Record that run() took seconds of wall time. Called by the
+        simulation thread.
+
+        """
+        now, cycles = default_timer(), self._mpu.cycles
+        with self._lock:
+            self._slices += 1
+            self._run_seconds += seconds
+            history = self._history
+            if len(history) == 0 or now - history[-1][0] >= Metrics.HISTORY_INTERVAL:
+                history.append((now, cycles))
+            while now - history[0][0] > max(Metrics.WINDOWS) + Metrics.HISTORY_INTERVAL:
+                history.popleft()
+
+    def mhz(self, window):
+        """Return the effective clock speed in MHz over the last window
+        seconds. If less history is available, the speed is measured over what
+        there is.
+
+        """
+        now, cycles = default_timer(), self._mpu.cycles
+        with self._lock:
+            start = None
+            for t, c in self._history:
+                if now - t <= window:
+                    start = (t, c)
+                    break
+        if start is None or now <= start[0]:
+            return 0.0
+        return 1e-6 * (cycles - start[1]) / (now - start[0])
+
+    def sample(self):
+        """Return a dict of the current values of the metrics.
+
+        """
+        mpu = self._mpu
+        with self._lock:
+            slices, run_seconds = self._slices, self._run_seconds
+
+        handlers = [
+            dict(kind=kind, name=name, calls=stats.calls, seconds=stats.seconds)
+            for (kind, name), stats in sorted(mpu.handler_stats.items())
+        ]
+        handler_seconds = sum(h['seconds'] for h in handlers)
+        sleep_seconds, callback_seconds = mpu.sleep_time, mpu.callback_time
+
+        sample = dict(
+            time=time.time(),
+            cycles=mpu.cycles, instructions=mpu.instructions,
+            idle_cycles=mpu.idle_cycles, trap_cycles=mpu.trap_cycles,
+            irqs=mpu.irqs, nmis=mpu.nmis,
+            slices=slices, run_seconds=run_seconds,
+            sleep_seconds=sleep_seconds,
+            execute_seconds=max(0.0, run_seconds - sleep_seconds),
+            callbacks=mpu.callbacks_run, callback_seconds=callback_seconds,
+            handler_seconds=handler_seconds,
+            callback_overhead_seconds=max(0.0, callback_seconds - handler_seconds),
+            handlers=handlers,
+        )
+        for window in Metrics.WINDOWS:
+            sample['mhz_{0}s'.format(window)] = self.mhz(window)
+        return sample
+
+class _PeriodicThread(object):
+    """Call fn every interval seconds on a daemon thread until stop().
+
+    """
+    def __init__(self, fn, interval):
+        self._fn = fn
+        self._interval = interval
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _loop(self):
+        while not self._stopping.wait(self._interval):
+            try:
+                self._fn()
+            except Exception: # pylint: disable=broad-except
+                _LOGGER.exception('exporting metrics failed')
+
+class JsonLinesExporter(object):
+    """Append a sample of metrics, a Metrics, as a line of JSON to a file
+    object or filename every interval seconds. A final sample is written by
+    stop().
+
+    """
+    def __init__(self, metrics, fobj_or_string, interval=10.0):
+        self.metrics = metrics
+        if isinstance(fobj_or_string, basestring):
+            self._fobj, self._owns_fobj = open(fobj_or_string, 'a'), True
+        else:
+            self._fobj, self._owns_fobj = fobj_or_string, False
+        self._thread = _PeriodicThread(self.write_sample, interval)
+
+    def write_sample(self):
+        self._fobj.write(json.dumps(self.metrics.sample(), sort_keys=True) + '\n')
+        self._fobj.flush()
+
+    def stop(self):
+        self._thread.stop()
+        self.write_sample()
+        if self._owns_fobj:
+            self._fobj.close()
+
+# Prometheus metric name, type, help and sample key for each scalar metric
+_PROMETHEUS_METRICS = (
+    ('cycles_total', 'counter', 'Clock ticks emulated.', 'cycles'),
+    ('instructions_total', 'counter', 'Instructions run.', 'instructions'),
+    ('idle_cycles_total', 'counter', 'Ticks skipped by idle detection.', 'idle_cycles'),
+    ('trap_cycles_total', 'counter', 'Ticks charged by call handlers.', 'trap_cycles'),
+    ('irqs_total', 'counter', 'IRQs taken.', 'irqs'),
+    ('nmis_total', 'counter', 'NMIs taken.', 'nmis'),
+    ('slices_total', 'counter', 'Slices run by the simulation thread.', 'slices'),
+    ('run_seconds_total', 'counter', 'Wall time spent running the processor.', 'run_seconds'),
+    ('sleep_seconds_total', 'counter', 'Time spent sleeping to throttle the processor.',
+     'sleep_seconds'),
+    ('execute_seconds_total', 'counter', 'Time spent emulating.', 'execute_seconds'),
+    ('callbacks_total', 'counter', 'Read, write and call callbacks called.', 'callbacks'),
+    ('callback_seconds_total', 'counter', 'Time spent in callbacks.', 'callback_seconds'),
+    ('callback_overhead_seconds_total', 'counter',
+     'Time spent in callbacks outside handlers, including acquiring the GIL.',
+     'callback_overhead_seconds'),
+)
+
+def prometheus_text(sample, prefix='burisim_'):
+    """Return a sample from Metrics.sample() in the Prometheus text
+    exposition format.
+
+    """
+    lines = []
+    def add(name, kind, help_text, values):
+        lines.append('# HELP {0}{1} {2}'.format(prefix, name, help_text))
+        lines.append('# TYPE {0}{1} {2}'.format(prefix, name, kind))
+        for labels, value in values:
+            label_text = ','.join(
+                '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels
+            )
+            if label_text != '':
+                label_text = '{' + label_text + '}'
+            lines.append('{0}{1}{2} {3!r}'.format(prefix, name, label_text, float(value)))
+
+    for name, kind, help_text, key in _PROMETHEUS_METRICS:
+        add(name, kind, help_text, [((), sample[key])])
+    add('mhz', 'gauge', 'Effective clock speed over a window.', [
+        ((('window', '{0}s'.format(w)),), sample['mhz_{0}s'.format(w)])
+        for w in Metrics.WINDOWS
+    ])
+    labels = [(('kind', h['kind']), ('name', h['name'])) for h in sample['handlers']]
+    add('handler_calls_total', 'counter', 'Calls of each Python handler.', [
+        (l, h['calls']) for l, h in zip(labels, sample['handlers'])
+    ])
+    add('handler_seconds_total', 'counter', 'Time spent in each Python handler.', [
+        (l, h['seconds']) for l, h in zip(labels, sample['handlers'])
+    ])
+    return '\n'.join(lines) + '\n'
+
+class PrometheusExporter(object):
+    """Serve metrics, a Metrics, over HTTP at http://host:port/metrics in the
+    Prometheus text exposition format. Serving is done on a daemon thread.
+    Only bind to a non-local host if untrusted clients cannot reach it.
+
+    """
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.metrics = metrics
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self): # pylint: disable=invalid-name
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = prometheus_text(exporter.metrics.sample()).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                _LOGGER.debug(format, *args)
+
+        self._server = HTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def port(self):
+        """The port being served on. Useful if port 0 was requested.
+
+        """
+        return self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,417 @@
+"""
+Profile where the emulated machine spends its time.
+
+Usage:
+    burisim-profile (-h | --help)
+    burisim-profile --callgraph [--handlers] [options] [--load FILE] <rom>
+    burisim-profile --callgraph [--handlers] [options] --replay LOG
+    burisim-profile --handlers [options] [--load FILE] <rom>
+    burisim-profile --handlers [options] --replay LOG
+    burisim-profile bench [--seconds N]
+
+Options:
+    -h, --help          Show a brief usage summary.
+
+    --callgraph         Report cycles per routine and per caller/callee edge.
+    --handlers          Report calls of and wall time spent in each I/O
+                        handler with latency percentiles.
+    --cycles N          Run the ROM for N cycles [default: 20000000].
+    --load FILE         Pre-load FILE at location 0x5000 in RAM.
+    --replay LOG        Profile the replay of LOG recorded by burisim --record.
+    --block-cache       Cache decoded ROM code rather than decoding it each
+                        time it is run.
+    --symbols FILE      Name routines using an ld65 debug info file
+                        (--dbgfile) or VICE label file (-Ln).
+    --top N             Report the N most expensive routines and edges
+                        [default: 20].
+    --collapsed FILE    Write collapsed stacks to FILE for flamegraph.pl.
+    --seconds N         Run each benchmark for about N seconds [default: 2].
+
+A CallGraphProfiler attached to a BuriSim via BuriSim.profiler follows JSR,
+BRK and interrupts into routines and RTS and RTI out of them with a shadow
+call stack maintained natively by the processor. Cycles are attributed to a
+calling-context tree with a node for each distinct chain of calls. See
+M6502_setProfile() in lib6502.h for how stack manipulation is tolerated.
+
+BuriSim.call_graph() returns a CallGraph copied from the tree. It gives the
+inclusive and exclusive cycles for each routine and caller/callee edge and
+can be written as collapsed stacks for flame graphs.
+
+With --handlers, latency histograms are recorded for the Python handlers of
+memory-mapped devices, see BuriSim.record_handler_latency, and
+handler_report() shows which device is slowing emulation down.
+
+"burisim-profile bench" measures the raw speed of the processor on a loop
+which does little but dispatch instructions, unthrottled and with idle
+detection off. It is run as is and with an IRQ line asserted while
+interrupts are disabled. The run loop checks for interrupts with one relaxed
+load per instruction, so the masked IRQ should cost next to nothing. As a
+guide, expect several hundred emulated MHz.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from collections import namedtuple
+import io
+import logging
+import sys
+from timeit import default_timer
+
+from docopt import docopt
+
+from burisim import symbols
+from burisim._lib6502 import lib, ffi # pylint: disable=no-name-in-module
+from burisim.lib6502 import M6502
+from burisim.replay import replay
+from burisim.sim import BuriSim, MachineError
+
+_LOGGER = logging.getLogger(__name__)
+
+# Ways in which a routine is entered
+CALL = lib.M6502_ProfileCall
+IRQ = lib.M6502_ProfileIRQ
+NMI = lib.M6502_ProfileNMI
+BRK = lib.M6502_ProfileBRK
+
+_KIND_PREFIXES = {CALL: '', IRQ: 'irq:', NMI: 'nmi:', BRK: 'brk:'}
+
+# Name of the root of the tree, i.e. code run outside of any call
+ROOT_NAME = '[top]'
+
+CallNode = namedtuple('CallNode', 'address kind parent calls cycles')
+CallNode.__doc__ = """A node of a calling-context tree. The routine at address
+was entered by kind (CALL, IRQ, NMI or BRK) calls times from the context with
+index parent and cycles were spent in it excluding callees.
+
+"""
+
+RoutineStats = namedtuple('RoutineStats', 'routine calls inclusive exclusive')
+RoutineStats.__doc__ = """Totals over all contexts of a routine, a (address,
+kind) pair or None for the root. Inclusive cycles count recursive calls
+once.
+
+"""
+
+EdgeStats = namedtuple('EdgeStats', 'caller callee calls inclusive')
+EdgeStats.__doc__ = """Totals for calls from routine caller to routine callee.
+inclusive is the cycles spent in callee and its callees when called from
+caller.
+
+"""
+
+class CallGraphProfiler(object):
+    """A calling-context profile maintained natively by the processor. Attach
+    to a BuriSim via BuriSim.profiler.
+
+    """
+    def __init__(self):
+        self._profile = ffi.gc(lib.M6502_newProfile(), lib.M6502_deleteProfile)
+
+    @property
+    def handle(self):
+        """The cffi "M6502_Profile *" to pass to M6502.set_profile().
+
+        """
+        return self._profile
+
+    def call_graph(self):
+        """Return a CallGraph copied from the profile. Must not be called
+        while the processor is running. Use BuriSim.call_graph() instead.
+
+        """
+        nodes = self._profile.nodes
+        return CallGraph([
+            CallNode(n.address, n.kind, n.parent, n.calls, n.cycles)
+            for n in (nodes[i] for i in range(self._profile.n_nodes))
+        ])
+
+class CallGraph(object):
+    """A calling-context tree given by a list of CallNode. The first node is
+    the root and each node follows its parent.
+
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self._children = [[] for _ in nodes]
+        for idx, node in enumerate(nodes[1:], 1):
+            self._children[node.parent].append(idx)
+
+        # Inclusive cycles of each context
+        self.inclusive = [n.cycles for n in nodes]
+        for idx in range(len(nodes) - 1, 0, -1):
+            self.inclusive[nodes[idx].parent] += self.inclusive[idx]
+
+    @property
+    def total_cycles(self):
+        return self.inclusive[0] if len(self.inclusive) > 0 else 0
+
+    def routine(self, idx):
+        """The routine of node idx as an (address, kind) pair or None for the
+        root.
+
+        """
+        if idx == 0:
+            return None
+        return (self.nodes[idx].address, self.nodes[idx].kind)
+
+    def _walk(self):
+        """Yield (idx, path) for each node in depth-first order where path is
+        the list of node indices from the root to idx.
+
+        """
+        stack = [(0, [0])]
+        while len(stack) > 0:
+            idx, path = stack.pop()
+            yield idx, path
+            for child in self._children[idx]:
+                stack.append((child, path + [child]))
+
+    def routines(self):
+        """Return a list of RoutineStats, most inclusive cycles first.
+
+        """
+        stats = {}
+        for idx, path in self._walk():
+            key = self.routine(idx)
+            calls, inclusive, exclusive = stats.get(key, (0, 0, 0))
+            calls += self.nodes[idx].calls
+            exclusive += self.nodes[idx].cycles
+            # Don't count recursive calls twice
+            if key not in set(self.routine(i) for i in path[:-1]):
+                inclusive += self.inclusive[idx]
+            stats[key] = (calls, inclusive, exclusive)
+        return sorted(
+            (RoutineStats(k, *v) for k, v in stats.items()),
+            key=lambda s: -s.inclusive
+        )
+
+    def edges(self):
+        """Return a list of EdgeStats, most inclusive cycles first.
+
+        """
+        stats = {}
+        for idx, path in self._walk():
+            if idx == 0:
+                continue
+            key = (self.routine(path[-2]), self.routine(idx))
+            calls, inclusive = stats.get(key, (0, 0))
+            calls += self.nodes[idx].calls
+            edges_above = set(
+                (self.routine(a), self.routine(b))
+                for a, b in zip(path[:-2], path[1:-1])
+            )
+            if key not in edges_above:
+                inclusive += self.inclusive[idx]
+            stats[key] = (calls, inclusive)
+        return sorted(
+            (EdgeStats(k[0], k[1], *v) for k, v in stats.items()),
+            key=lambda s: -s.inclusive
+        )
+
+    def name(self, routine, name_for=None):
+        """Return a name for routine, an (address, kind) pair or None, using
+        name_for to name addresses if not None. See
+        burisim.symbols.SourceMap.name_for().
+
+        """
+        if routine is None:
+            return ROOT_NAME
+        address, kind = routine
+        name = name_for(address) if name_for is not None else '${0:04X}'.format(address)
+        return _KIND_PREFIXES.get(kind, '') + name
+
+    def write_collapsed(self, fobj, name_for=None):
+        """Write the exclusive cycles of each context to fobj, a file-like
+        object open for writing text, in the collapsed stack format read by
+        flamegraph.pl.
+
+        """
+        counts = {}
+        for idx, path in self._walk():
+            if self.nodes[idx].cycles == 0:
+                continue
+            stack = ';'.join(
+                self.name(self.routine(i), name_for).replace(';', ':')
+                for i in path
+            )
+            counts[stack] = counts.get(stack, 0) + self.nodes[idx].cycles
+        for stack in sorted(counts):
+            fobj.write('{0} {1}\n'.format(stack, counts[stack]))
+
+    def report(self, top=20, name_for=None):
+        """Return a text report of the top routines and edges by inclusive
+        cycles.
+
+        """
+        total = max(1, self.total_cycles)
+        pc = lambda n: 100.0 * n / total
+        lines = [
+            'Total: {0} cycles'.format(self.total_cycles), '',
+            'Routines by inclusive cycles:',
+            '{0:>12} {1:>6} {2:>12} {3:>6} {4:>10}  {5}'.format(
+                'inclusive', '%', 'exclusive', '%', 'calls', 'routine'
+            ),
+        ]
+        for s in self.routines()[:top]:
+            lines.append('{0:>12} {1:>5.1f}% {2:>12} {3:>5.1f}% {4:>10}  {5}'.format(
+                s.inclusive, pc(s.inclusive), s.exclusive, pc(s.exclusive),
+                s.calls, self.name(s.routine, name_for)
+            ))
+        lines.extend([
+            '', 'Edges by inclusive cycles:',
+            '{0:>12} {1:>6} {2:>10}  {3}'.format(
+                'inclusive', '%', 'calls', 'caller -> callee'
+            ),
+        ])
+        for e in self.edges()[:top]:
+            lines.append('{0:>12} {1:>5.1f}% {2:>10}  {3} -> {4}'.format(
+                e.inclusive, pc(e.inclusive), e.calls,
+                self.name(e.caller, name_for), self.name(e.callee, name_for)
+            ))
+        return '\n'.join(lines)
+
+def _format_nsec(nsec):
+    if nsec is None:
+        return '-'
+    if nsec < 1000:
+        return '{0}ns'.format(nsec)
+    if nsec < 1000000:
+        return '{0:.1f}us'.format(nsec / 1e3)
+    return '{0:.1f}ms'.format(nsec / 1e6)
+
+def handler_report(handler_stats):
+    """Return a text report of handler_stats, see BuriSim.handler_stats,
+    most total time first. Percentiles are upper bounds given by the
+    power-of-two buckets of the latency histograms.
+
+    """
+    fmt = '{0:<5} {1:<10} {2:<14} {3:>10} {4:>10} {5:>8} {6:>8} {7:>8} {8:>8}'
+    lines = [
+        'I/O handlers by total time:',
+        fmt.format('kind', 'handler', 'addresses', 'calls', 'total', 'mean',
+                   'p50', 'p90', 'p99'),
+    ]
+    for (kind, name), stats in sorted(handler_stats.items(), key=lambda i: -i[1].nsec):
+        lines.append(fmt.format(
+            kind, name,
+            ','.join('${0:04X}-${1:04X}'.format(b, e - 1) for b, e in stats.ranges),
+            stats.calls, _format_nsec(stats.nsec),
+            _format_nsec(stats.nsec // stats.calls if stats.calls > 0 else None),
+            _format_nsec(stats.percentile(50)), _format_nsec(stats.percentile(90)),
+            _format_nsec(stats.percentile(99)),
+        ))
+    return '\n'.join(lines)
+
+# A loop which does little but dispatch instructions and the address to run
+# it from
+_BENCH_PROGRAM = bytes(bytearray([
+    0xe8,               # INX
+    0xd0, 0x01,         # BNE $0204
+    0xc8,               # INY
+    0x8d, 0x00, 0x03,   # STA $0300
+    0x4c, 0x00, 0x02,   # JMP $0200
+]))
+_BENCH_START = 0x0200
+
+# Ticks run between checks of the time taken
+_BENCH_CHUNK = 10 * 1000 * 1000
+
+# Description and whether an IRQ line is asserted with interrupts disabled
+# for each benchmark
+_BENCH_CONFIGURATIONS = [
+    ('no irq', False),
+    ('masked irq', True),
+]
+
+def bench(seconds=2.0):
+    """Run the dispatch loop for around seconds seconds in each
+    configuration and return a list of (description, emulated MHz) pairs.
+
+    """
+    results = []
+    for description, irq in _BENCH_CONFIGURATIONS:
+        mpu = M6502()
+        mpu.target_freq = 0
+        mpu.idle_detection = False
+        mpu.write_memory(_BENCH_START, _BENCH_PROGRAM)
+        mpu.registers.pc = _BENCH_START
+        mpu.registers.p |= 0x04 # I
+        if irq:
+            mpu.set_irq_line(0, True)
+
+        mpu.run(_BENCH_CHUNK)
+        ticks, start = 0, default_timer()
+        while True:
+            ticks += mpu.run(_BENCH_CHUNK)
+            elapsed = default_timer() - start
+            if elapsed >= seconds:
+                break
+        results.append((description, 1e-6 * ticks / elapsed))
+    return results
+
+def _run(sim, cycles):
+    while sim.mpu.cycles < cycles:
+        try:
+            sim.step(cycles - sim.mpu.cycles)
+        except MachineError as e:
+            _LOGGER.warning('machine stopped: %s', e)
+            break
+
+def main():
+    opts = docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO, stream=sys.stderr, format='%(name)s: %(message)s'
+    )
+
+    if opts['bench']:
+        for description, mhz in bench(float(opts['--seconds'])):
+            print('{0:<12} {1:8.1f} MHz'.format(description, mhz))
+        return
+
+    sim = BuriSim()
+    if opts['--block-cache']:
+        sim.block_cache = True
+    if opts['--callgraph']:
+        sim.profiler = CallGraphProfiler()
+    if opts['--handlers']:
+        sim.record_handler_latency = True
+
+    if opts['--replay'] is not None:
+        with io.open(opts['--replay']) as fobj:
+            result = replay(fobj, sim)
+        for mismatch in result.mismatches:
+            _LOGGER.warning('replay mismatch: %s', mismatch)
+    else:
+        sim.load_rom(opts['<rom>'])
+        if opts['--load'] is not None:
+            sim.load_ram(opts['--load'], 0x5000)
+        sim.reset()
+        sim.throttled = False
+        _run(sim, int(opts['--cycles']))
+
+    name_for = None
+    if opts['--symbols'] is not None:
+        name_for = symbols.load(opts['--symbols']).name_for
+
+    if opts['--callgraph']:
+        call_graph = sim.call_graph()
+        print(call_graph.report(int(opts['--top']), name_for))
+
+        if opts['--collapsed'] is not None:
+            with io.open(opts['--collapsed'], 'w') as fobj:
+                call_graph.write_collapsed(fobj, name_for)
+
+    if opts['--handlers']:
+        if opts['--callgraph']:
+            print()
+        print(handler_report(sim.handler_stats))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Deterministic record and replay of the external events applied to a BuriSim.
+
+A Recorder logs each external event (serial byte received, reset, IRQ or NMI)
+along with the cycle count at which the simulation thread applied it. Since
+events are only ever applied between slices, replay() can run the machine
+unthrottled to exactly those cycle counts and apply the same events, turning
+hours of interactive use into seconds. At the end of a recording the serial
+output, memory and registers are hashed so that replay can verify that the
+machine behaved identically.
+
+A log is a text file with one JSON object per line. The first is a header
+giving the initial memory and registers, the last records the final cycle
+count and hashes and those in between are events:
+
+    {"cycle": 1234, "event": "rx", "value": 65}
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import base64
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+from burisim.lib6502 import ProcessorState
+from burisim.sim import BuriSim, MachineError, MachineSnapshot
+
+_LOGGER = logging.getLogger(__name__)
+
+# Version of the log format
+VERSION = 1
+
+_REGISTERS = ('a', 'x', 'y', 'p', 's', 'pc')
+
+class ReplayError(Exception):
+    """Raised if a log cannot be replayed, e.g. because the machine diverged
+    from the recording so that an event could not be applied at the recorded
+    cycle count."""
+    pass
+
+ReplayResult = namedtuple('ReplayResult', 'cycles events seconds mismatches')
+ReplayResult.__doc__ = """The result of replay(). cycles is the number of
+clock ticks replayed, events the number of events applied and seconds the
+wall-clock time taken. mismatches is a list of descriptions of each way in
+which the final machine differed from the recording and is empty if the replay
+matched.
+
+"""
+
+class Recorder(object):
+    """Record external events to fobj, a file-like object open for writing text.
+    Pass to BuriSim.start_recording().
+
+    """
+    def __init__(self, fobj):
+        self._fobj = fobj
+        self._serial = hashlib.sha1()
+        self._acia = None
+        self.events = 0
+
+    def start(self, sim):
+        """Called by BuriSim.start_recording() on the simulation thread.
+
+        """
+        snapshot = sim._snapshot() # pylint: disable=protected-access
+        self._write({
+            'type': 'header', 'version': VERSION,
+            'idle_detection': sim.mpu.idle_detection,
+            'block_cache': sim.block_cache,
+            'state': dict((r, getattr(snapshot.state, r)) for r in _REGISTERS),
+            'memory': _encode_memory(snapshot.memory),
+        })
+        self._acia = sim.acia1
+        self._acia.register_listener(self._serial_out)
+
+    def record(self, cycles, kind, value):
+        """Called by BuriSim on the simulation thread when an event is applied.
+
+        """
+        event = {'cycle': cycles, 'event': kind}
+        if value is not None:
+            event['value'] = value
+        self._write(event)
+        self.events += 1
+
+    def finish(self, sim):
+        """Called by BuriSim.stop_recording() on the simulation thread.
+
+        """
+        self._acia.unregister_listener(self._serial_out)
+        self._write(_end_record(sim, self._serial))
+        self._fobj.flush()
+
+    def _serial_out(self, b):
+        self._serial.update(bytes(bytearray([b])))
+
+    def _write(self, obj):
+        self._fobj.write(json.dumps(obj, sort_keys=True) + '\n')
+
+def replay(fobj, sim=None):
+    """Replay a log read from fobj, a file-like object open for reading text,
+    and return a ReplayResult. If sim is None, a new BuriSim is created.
+    Otherwise sim should be freshly created, with the same hardware as the
+    recording, and its simulation thread must not be running. The machine is
+    run unthrottled on the calling thread.
+
+    """
+    if sim is None:
+        sim = BuriSim()
+    if sim.is_running():
+        raise ValueError('Cannot replay while the simulation thread is running')
+
+    lines = iter(fobj)
+    try:
+        header = json.loads(next(lines))
+    except StopIteration:
+        raise ReplayError('Log is empty')
+    if header.get('type') != 'header' or header.get('version') != VERSION:
+        raise ReplayError('Not a version {0} log'.format(VERSION))
+
+    start_time = time.time()
+    mpu = sim.mpu
+    mpu.target_freq = 0
+    mpu.idle_detection = header['idle_detection']
+
+    # The block cache runs exactly the same instructions as the interpreter,
+    # so either may replay a log made with the other, e.g. to profile it.
+    # Note the difference in case the replay diverges.
+    recorded_block_cache = header.get('block_cache', False)
+    if sim.block_cache != recorded_block_cache:
+        _LOGGER.warning(
+            'replaying with the block cache %s but it was %s when recording',
+            'on' if sim.block_cache else 'off', 'on' if recorded_block_cache else 'off'
+        )
+    state = ProcessorState(
+        cycles=mpu.cycles, sequence=0,
+        **dict((r, header['state'][r]) for r in _REGISTERS)
+    )
+    sim._restore(MachineSnapshot(state, _decode_memory(header['memory']))) # pylint: disable=protected-access
+
+    serial = hashlib.sha1()
+    serial_out = lambda b: serial.update(bytes(bytearray([b])))
+    sim.acia1.register_listener(serial_out)
+
+    start, n_events, end = mpu.cycles, 0, None
+    try:
+        for line in lines:
+            record = json.loads(line)
+            if record.get('type') == 'end':
+                end = record
+                break
+            _run_until(sim, start + record['cycle'])
+            sim._apply_event(record['event'], record.get('value')) # pylint: disable=protected-access
+            n_events += 1
+
+        if end is None:
+            raise ReplayError('Log is truncated')
+        _run_until(sim, start + end['cycle'])
+    finally:
+        sim.acia1.unregister_listener(serial_out)
+
+    actual = _end_record(sim, serial)
+    mismatches = []
+    for key, what in (('serial_sha1', 'serial output'),
+                      ('memory_sha1', 'memory'), ('state', 'registers')):
+        if actual[key] != end[key]:
+            mismatches.append('{0} differs: expected {1}, got {2}'.format(
+                what, end[key], actual[key]
+            ))
+
+    return ReplayResult(
+        mpu.cycles - start, n_events, time.time() - start_time, mismatches
+    )
+
+def _run_until(sim, cycles):
+    """Run sim until its cycle count is exactly cycles. A machine stopped by an
+    error does not advance, just as the simulation thread pauses on an error
+    until the next event.
+
+    """
+    while sim.mpu.cycles < cycles:
+        try:
+            sim.step(cycles - sim.mpu.cycles)
+        except MachineError:
+            break
+    if sim.mpu.cycles != cycles:
+        raise ReplayError(
+            'Replay diverged: expected an event at cycle {0} but reached cycle '
+            '{1}'.format(cycles, sim.mpu.cycles)
+        )
+
+def _end_record(sim, serial):
+    r = sim.mpu.registers
+    return {
+        'type': 'end', 'cycle': sim.mpu.cycles,
+        'serial_sha1': serial.hexdigest(),
+        'memory_sha1': hashlib.sha1(sim.mpu.read_memory(0, 0x10000)).hexdigest(),
+        'state': dict((n, getattr(r, n)) for n in _REGISTERS),
+    }
+
+def _encode_memory(memory):
+    return base64.b64encode(zlib.compress(bytes(memory))).decode('ascii')
+
+def _decode_memory(s):
+    return zlib.decompress(base64.b64decode(s.encode('ascii')))
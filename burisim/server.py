@@ -0,0 +1,197 @@
+"""
+Serve a running BuriSim to clients over a local Unix socket.
+
+The server runs on its own thread and never touches the processor directly.
+Serial output and LCD changes are gathered cheaply from the simulation thread
+and forwarded to clients in batches. Memory and processor state are shared with
+clients via the simulator's memory backing. Commands from clients are
+applied through the simulator's control plane.
+
+Commands are JSON objects with an "op" key:
+
+    {"op": "reset"}
+    {"op": "pause"}
+    {"op": "resume"}
+    {"op": "poke", "addr": 512, "data": "a9ff"}    (data is hex)
+    {"op": "throttled", "value": false}
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import binascii
+from collections import deque
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+
+from burisim import ipc
+
+_LOGGER = logging.getLogger(__name__)
+
+class SimServer(object):
+    """Serve sim on the Unix socket at path. sim must have been created with a
+    burisim.backing shared memory or file backing which clients map to see
+    memory and processor state.
+
+    """
+    # How often, in seconds, serial output and LCD changes are sent to clients
+    FLUSH_INTERVAL = 0.02
+
+    def __init__(self, sim, path):
+        if sim.backing is None:
+            raise ValueError('Served simulators must have a memory backing')
+        self.sim = sim
+        self.path = path
+
+        self._listen_sock = None
+        self._clients = {}
+        self._thread = None
+        self._want_stop = False
+
+        # Bytes sent by ACIA1, appended to by the simulation thread.
+        self._serial_out = deque()
+        self._last_lcd = None
+
+        sim.acia1.register_listener(self._serial_out.append)
+
+    def start(self):
+        """Start listening and serving clients on a new thread.
+
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listen_sock.bind(self.path)
+        self._listen_sock.listen(5)
+        _LOGGER.info('serving simulator on %s', self.path)
+
+        self._want_stop = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._want_stop = True
+        self._thread.join()
+        self._thread = None
+
+        for sock in list(self._clients):
+            self._drop(sock)
+        self._listen_sock.close()
+        os.unlink(self.path)
+
+    def _serve(self):
+        while not self._want_stop:
+            socks = [self._listen_sock] + list(self._clients)
+            readable, _, _ = select.select(socks, [], [], self.FLUSH_INTERVAL)
+            for sock in readable:
+                if sock is self._listen_sock:
+                    self._accept()
+                else:
+                    self._receive(sock)
+            self._flush()
+
+    def _accept(self):
+        sock, _ = self._listen_sock.accept()
+        _LOGGER.info('client connected')
+        self._clients[sock] = ipc.MessageReader()
+        self._send(sock, ipc.encode_json(ipc.HELLO, {
+            'version': ipc.VERSION, 'backing': self.sim.backing.path,
+        }))
+        self._send(sock, self._lcd_message())
+
+    def _drop(self, sock):
+        _LOGGER.info('client disconnected')
+        self._clients.pop(sock, None)
+        sock.close()
+
+    def _send(self, sock, data):
+        try:
+            sock.sendall(data)
+        except socket.error as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            self._drop(sock)
+
+    def _broadcast(self, data):
+        for sock in list(self._clients):
+            self._send(sock, data)
+
+    def _receive(self, sock):
+        try:
+            data = sock.recv(4096)
+        except socket.error:
+            data = b''
+        if len(data) == 0:
+            self._drop(sock)
+            return
+
+        try:
+            messages = self._clients[sock].feed(data)
+        except ipc.ProtocolError as e:
+            _LOGGER.error('dropping client: %s', e)
+            self._drop(sock)
+            return
+
+        for msg_type, payload in messages:
+            if msg_type == ipc.SERIAL:
+                for b in bytearray(payload):
+                    self.sim.receive_serial(b)
+            elif msg_type == ipc.COMMAND:
+                try:
+                    self._command(ipc.decode_json(payload))
+                except Exception as e: # pylint: disable=broad-except
+                    _LOGGER.error('command failed: %s', e)
+                    self._send(sock, ipc.encode(ipc.ERROR, str(e).encode('utf8')))
+
+    def _command(self, cmd):
+        op = cmd['op']
+        if op == 'reset':
+            self.sim.reset()
+        elif op == 'pause':
+            self.sim.pause()
+        elif op == 'resume':
+            self.sim.resume()
+        elif op == 'poke':
+            self.sim.poke(cmd['addr'], binascii.unhexlify(cmd['data']))
+        elif op == 'throttled':
+            self.sim.throttled = cmd['value']
+        else:
+            raise ValueError('Unknown command: ' + repr(op))
+
+    def _lcd_message(self):
+        display = self.sim.display
+        return ipc.encode(
+            ipc.LCD, bytes(bytearray(
+                [display.cursor_index] + display.ddram + display.cgram
+            ))
+        )
+
+    def _flush(self):
+        # Serial output
+        out = bytearray()
+        try:
+            while True:
+                out.append(self._serial_out.popleft())
+        except IndexError:
+            pass
+        if len(out) > 0:
+            self._broadcast(ipc.encode(ipc.SERIAL, bytes(out)))
+
+        # LCD
+        lcd = self._lcd_message()
+        if lcd != self._last_lcd:
+            self._last_lcd = lcd
+            self._broadcast(lcd)
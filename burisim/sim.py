@@ -7,14 +7,20 @@ from builtins import (  # pylint: disable=redefined-builtin, unused-import
     filter, map, zip
 )
 
-from itertools import cycle
+from collections import namedtuple
+from itertools import cycle, islice
 import logging
+import queue
 import threading
 import time
+from timeit import default_timer
 
+import numpy as np
 from past.builtins import basestring # pylint: disable=redefined-builtin
 
-from burisim.lib6502 import M6502
+from burisim import memscan
+from burisim.metrics import Metrics
+from burisim.lib6502 import M6502, ProcessorState
 from burisim.hw.acia import ACIA
 from burisim.hw.hd44780 import HD44780
 
@@ -32,9 +38,74 @@ class ReadOnlyMemoryError(MachineError):
             'Illegal attempt to write ${0.value:02X} to ${0.address:04X}'.format(self)
         )
 
+class IllegalInstructionError(MachineError):
+    """Raised when the processor encounters an undefined opcode."""
+    def __init__(self, address, opcode):
+        self.address = address
+        self.opcode = opcode
+        super(IllegalInstructionError, self).__init__(
+            'Illegal instruction ${0.opcode:02X} at ${0.address:04X}'.format(self)
+        )
+
+class ProcessorStoppedError(MachineError):
+    """Raised when the processor has executed a STP instruction. The processor
+    remains stopped until reset."""
+    def __init__(self, address):
+        self.address = address
+        super(ProcessorStoppedError, self).__init__(
+            'Processor stopped by STP at ${0.address:04X}'.format(self)
+        )
+
+class TraceStopError(MachineError):
+    """Raised when an instruction hook has asked to stop the processor. See
+    burisim.trace.InstructionHook. Running continues from address."""
+    def __init__(self, address):
+        self.address = address
+        super(TraceStopError, self).__init__(
+            'Stopped by instruction hook at ${0.address:04X}'.format(self)
+        )
+
+class BreakpointError(MachineError):
+    """Raised when the processor has reached a breakpoint. See
+    BuriSim.add_breakpoint(). Resuming continues from address."""
+    def __init__(self, address):
+        self.address = address
+        super(BreakpointError, self).__init__(
+            'Breakpoint at ${0.address:04X}'.format(self)
+        )
+
+MachineSnapshot = namedtuple('MachineSnapshot', 'state memory')
+MachineSnapshot.__doc__ = """The processor state and full 64K memory image of
+the machine taken at a slice boundary. See BuriSim.snapshot().
+
+"""
+
+class _Command(object):
+    """A control operation which is applied by the simulation thread between
+    slices. The submitting thread waits on done.
+
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def apply(self):
+        try:
+            self.result = self.fn()
+        except Exception as e: # pylint: disable=broad-except
+            self.exception = e
+        self.done.set()
+
 class BuriSim(object):
     """Main simulator implementation.
 
+    While the simulation thread is running, control operations such as
+    reset(), poke() or snapshot() are queued and applied by the simulation
+    thread between slices. Slices are sized so that each takes around latency
+    seconds and so a control operation takes at most one slice to be applied.
+
     """
     ROM_SIZE = 0x2000 # 8K
     ROM_RANGE = 0x10000 - ROM_SIZE, 0x10000
@@ -43,25 +114,77 @@ class BuriSim(object):
 
     LCD1_START = 0xDFF0
 
-    def __init__(self):
-        # Create our processor
-        self.mpu = M6502()
+    # Default worst-case latency in seconds for control operations.
+    DEFAULT_LATENCY = 0.005
+
+    # Clock frequency in kHz.
+    CLOCK_FREQ = 2000
+
+    def __init__(self, latency=DEFAULT_LATENCY, backing=None):
+        # Create our processor, using a burisim.backing.MemoryBacking for
+        # memory and state if one is provided.
+        self.backing = backing
+        if backing is not None:
+            self.mpu = M6502(
+                memory=backing.memory, state=backing.state_buffer
+            )
+        else:
+            self.mpu = M6502()
         self._mpu_lock = threading.Lock()
         self._mpu_thread = None
         self._want_stop = True
+        self._paused = False
 
-        # Register ROM as read-only
-        def raise_rom_exception(addr, value):
-            raise ReadOnlyMemoryError(addr + BuriSim.ROM_RANGE[0], value)
-        self.mpu.register_write_handler(
-            BuriSim.ROM_RANGE[0], BuriSim.ROM_SIZE, raise_rom_exception
+        # Cycle count at which to pause, see resume(), and functions to call
+        # after each slice, see add_slice_listener().
+        self._pause_at = None
+        self._slice_listeners = []
+
+        # Measured emulation speed in Hz, used to size unthrottled slices.
+        self._effective_freq = BuriSim.CLOCK_FREQ * 1000
+
+        # Telemetry updated after each slice
+        self.metrics = Metrics(self.mpu)
+
+        # Control plane
+        self.latency = latency
+        self._commands = queue.Queue()
+        self._commands_lock = threading.Lock()
+        self._accepting_commands = False
+
+        # Register ROM as read-only. Writes stop the processor and are
+        # reported as a ReadOnlyMemoryError by step().
+        self.mpu.set_page_attributes(
+            BuriSim.ROM_RANGE[0], BuriSim.ROM_SIZE, M6502.PAGE_ROM_FAULT
         )
 
-        # Do not trace execution
-        self.tracing = False
+        # The MachineError which paused the simulation thread, if any.
+        self.error = None
+
+        # The burisim.replay.Recorder logging external events, if any.
+        self.recorder = None
+
+        # The burisim.coverage.Coverage being recorded, if any.
+        self._coverage = None
+
+        # The burisim.heatmap.HeatMap counting accesses, if any.
+        self._heat_map = None
+
+        # The burisim.profile.CallGraphProfiler following calls, if any.
+        self._profiler = None
+
+        # The burisim.trace.TraceWriter recording instructions, if any.
+        self._trace = None
+
+        # A byte per address, non-zero at breakpoints, once any have been set.
+        self._breakpoints = None
 
-        # IRQ lines
-        self._irq_lines = {}
+        # The burisim.trace.InstructionHook called with instructions, if any.
+        # This shares the processor's trace buffer with _trace.
+        self._instruction_hook = None
+
+        # Number of IRQ lines allocated to devices
+        self._n_irq_lines = 0
 
         self._create_hw()
 
@@ -72,29 +195,34 @@ class BuriSim(object):
         self.acia1 = ACIA()
         self.acia1.irq_cb = self._new_irq_line()
         self.mpu.register_read_handler(
-            BuriSim.ACIA1_RANGE[0], BuriSim.ACIA1_SIZE, self.acia1.read_reg
+            BuriSim.ACIA1_RANGE[0], BuriSim.ACIA1_SIZE, self.acia1.read_reg,
+            name='acia1'
         )
         self.mpu.register_write_handler(
-            BuriSim.ACIA1_RANGE[0], BuriSim.ACIA1_SIZE, self.acia1.write_reg
+            BuriSim.ACIA1_RANGE[0], BuriSim.ACIA1_SIZE, self.acia1.write_reg,
+            name='acia1'
         )
 
         self.display = HD44780()
         self.mpu.register_read_handler(
-            BuriSim.LCD1_START, 2, self.display.read
+            BuriSim.LCD1_START, 2, self.display.read, name='lcd1'
         )
         self.mpu.register_write_handler(
-            BuriSim.LCD1_START, 2, self.display.write
+            BuriSim.LCD1_START, 2, self.display.write, name='lcd1'
+        )
+
+        # Keep code touching devices out of the block cache
+        self.mpu.set_page_attributes(
+            BuriSim.LCD1_START, BuriSim.ACIA1_RANGE[1] - BuriSim.LCD1_START,
+            M6502.PAGE_IO
         )
 
     def _new_irq_line(self):
-        idx = len(self._irq_lines)
+        line = self._n_irq_lines
+        self._n_irq_lines += 1
         def setter(flag):
-            prev_irq = self.irq
-            self._irq_lines[idx] = flag
-            new_irq = self.irq
-            if prev_irq and not new_irq:
-                self.mpu.irq()
-        self._irq_lines[idx] = True
+            # flag is the state of the device's active-low ~IRQ output.
+            self.mpu.set_irq_line(line, not flag)
         return setter
 
     @property
@@ -105,13 +233,52 @@ class BuriSim(object):
         """
         return self.mpu.memory
 
+    @property
+    def memory_array(self):
+        """A numpy uint8 array viewing the machine memory without copying.
+        As with memory, it changes under your feet while the machine runs and
+        should not be mutated. See burisim.memscan.
+
+        """
+        return np.frombuffer(self.mpu.memory_buffer, np.uint8)
+
+    def find(self, pattern, start=0, end=None):
+        """Return a numpy array of the addresses at which pattern occurs in
+        memory. See burisim.memscan.find().
+
+        """
+        return memscan.find(self.memory_array, pattern, start, end)
+
+    def find_pointer(self, address, end_address=None):
+        """Return a numpy array of the addresses of little-endian pointers to
+        address. See burisim.memscan.find_pointer().
+
+        """
+        return memscan.find_pointer(self.memory_array, address, end_address)
+
+    def watch(self, ranges):
+        """Return a burisim.memscan.MemoryWatch of memory in ranges, a
+        sequence of (start, end) pairs.
+
+        """
+        return memscan.MemoryWatch(self.memory_array, ranges)
+
+    @property
+    def state(self):
+        """A ProcessorState giving the most recently published registers and
+        cycle count. Unlike step(), this never waits for the simulation thread
+        and so is safe to poll from the UI.
+
+        """
+        return self.mpu.state()
+
     @property
     def irq(self):
         """The state of the ~IRQ line. This is an AND of all the individual ~IRQ
         lines of each I/O device. (I.e. the NOR of the IRQ lines.)
 
         """
-        return all(self._irq_lines.values())
+        return self.mpu.irq_lines == 0
 
     def load_rom(self, fobj_or_string):
         """Load a ROM image from the passed file object or filename-string. The
@@ -145,35 +312,309 @@ class BuriSim(object):
         )
 
         # Copy ROM from 0xC000 to 0xFFFF. Loop if necessary.
-        with self._mpu_lock:
-            for addr, val in zip(range(*BuriSim.ROM_RANGE), cycle(rom_bytes)):
-                self.mpu.memory[addr] = val
+        rom_image = bytes(bytearray(islice(cycle(rom_bytes), BuriSim.ROM_SIZE)))
+        self._submit(lambda: self.mpu.write_memory(BuriSim.ROM_RANGE[0], rom_image))
 
     def load_ram_bytes(self, ram_bytes, addr):
         """Load a RAM image from the passed bytes object.
 
         """
         _LOGGER.info('loading RAM image of %s bytes', len(ram_bytes))
+        self.poke(addr, ram_bytes)
 
-        with self._mpu_lock:
-            for off, val in enumerate(ram_bytes):
-                self.mpu.memory[addr + off] = val
+    def poke(self, addr, data):
+        """Write data directly into memory starting at addr. data may be a single
+        integer byte value or a bytes-like object. No write handlers are
+        called.
+
+        """
+        if isinstance(data, int):
+            data = bytes(bytearray([data]))
+        data = bytes(data)
+        self._submit(lambda: self.mpu.write_memory(addr, data))
+
+    def snapshot(self):
+        """Return a MachineSnapshot of the processor and memory taken at a slice
+        boundary.
+
+        """
+        return self._submit(self._snapshot)
+
+    def restore(self, snapshot):
+        """Restore processor registers and memory from a MachineSnapshot. The
+        machine cycle count is unaffected.
+
+        """
+        self._submit(lambda: self._restore(snapshot))
 
     def reset(self):
-        was_running = self.is_running()
-        if was_running:
-            self.stop()
+        """Perform a hardware reset. If the simulation thread was paused by a
+        MachineError, it is resumed."""
+        self._submit(lambda: self._apply_event('reset'))
 
-        """Perform a hardware reset."""
-        # Reset hardware
-        self.acia1.hw_reset()
+    def receive_serial(self, b):
+        """Deliver byte b received by ACIA1 from the outside world. The byte is
+        delivered at the next slice boundary so that its arrival can be
+        recorded. Returns without waiting for it to be delivered.
 
-        # Reset MPU
-        with self._mpu_lock:
-            self.mpu.reset()
+        """
+        self._submit(lambda: self._apply_event('rx', b), wait=False)
+
+    def inject_irq(self):
+        """Trigger a one-shot IRQ at the next slice boundary."""
+        self._submit(lambda: self._apply_event('irq'))
+
+    def inject_nmi(self):
+        """Trigger an NMI at the next slice boundary."""
+        self._submit(lambda: self._apply_event('nmi'))
+
+    def start_recording(self, recorder):
+        """Record external events with a burisim.replay.Recorder. Recording
+        must start before the machine has run so that the log captures the
+        whole session. Only the events applied by reset(), receive_serial(),
+        inject_irq() and inject_nmi() are recorded. Other changes to the
+        machine, e.g. poke(), while recording will make replay diverge.
+
+        """
+        def start():
+            if self.mpu.cycles != 0:
+                raise ValueError('Recording must start before the machine has run')
+            recorder.start(self)
+            self.recorder = recorder
+        self._submit(start)
+
+    def stop_recording(self):
+        """Stop recording and finish the log. Returns the recorder or None if
+        there was no recording in progress.
+
+        """
+        def stop():
+            recorder, self.recorder = self.recorder, None
+            if recorder is not None:
+                recorder.finish(self)
+            return recorder
+        return self._submit(stop)
+
+    def pause(self):
+        """Pause the simulation thread at the next slice boundary. Returns once
+        the machine has been paused. Control operations continue to be applied
+        while paused.
+
+        """
+        self._submit(lambda: setattr(self, '_paused', True))
+
+    def resume(self, cycles=None):
+        """Resume simulation after a call to pause() or a MachineError, e.g.
+        a BreakpointError. If cycles is not None, pause again once the machine
+        has run for that many clock ticks. The last instruction may overrun by
+        a few ticks.
+
+        """
+        self._submit(lambda: self._resume(cycles))
+
+    def add_slice_listener(self, fn):
+        """Call fn() on the simulation thread after each slice, including a
+        slice which ended in a MachineError. fn() may inspect the machine
+        directly and call pause() but should be quick.
+
+        """
+        self._submit(lambda: self._slice_listeners.append(fn))
+
+    def remove_slice_listener(self, fn):
+        self._submit(lambda: self._slice_listeners.remove(fn))
 
-        if was_running:
-            self.start()
+    def is_paused(self):
+        return self._paused
+
+    @property
+    def throttled(self):
+        """If True, the machine is run at its real clock speed. Otherwise it is
+        run as fast as possible.
+
+        """
+        return self.mpu.target_freq != 0
+
+    @throttled.setter
+    def throttled(self, v):
+        freq = BuriSim.CLOCK_FREQ if v else 0
+        self._submit(lambda: setattr(self.mpu, 'target_freq', freq))
+
+    @property
+    def idle_detection(self):
+        """If True, busy-wait loops polling I/O are skipped over rather than
+        being emulated cycle by cycle. See M6502.idle_detection.
+
+        """
+        return self.mpu.idle_detection
+
+    @idle_detection.setter
+    def idle_detection(self, v):
+        self._submit(lambda: setattr(self.mpu, 'idle_detection', v))
+
+    @property
+    def block_cache(self):
+        """If True, straight-line code in ROM is decoded once and cached rather
+        than being decoded each time it is run. See M6502.set_block_cache().
+        Defaults to False.
+
+        """
+        return self.mpu.block_cache[1] != 0
+
+    @block_cache.setter
+    def block_cache(self, v):
+        size = BuriSim.ROM_SIZE if v else 0
+        self._submit(
+            lambda: self.mpu.set_block_cache(BuriSim.ROM_RANGE[0], size)
+        )
+
+    @property
+    def handler_stats(self):
+        """A dict mapping (kind, name) pairs to the burisim.lib6502.HandlerStats
+        of each I/O handler. kind is "read", "write" or "call" and name is the
+        device, e.g. "acia1". See M6502.handler_stats.
+
+        """
+        return self.mpu.handler_stats
+
+    @property
+    def record_handler_latency(self):
+        """If True, handler_stats keeps a histogram of how long each call of
+        each I/O handler took. Defaults to False. See M6502.record_latency.
+
+        """
+        return self.mpu.record_latency
+
+    @record_handler_latency.setter
+    def record_handler_latency(self, v):
+        self._submit(lambda: setattr(self.mpu, 'record_latency', v))
+
+    @property
+    def coverage(self):
+        """The burisim.coverage.Coverage into which the addresses executed,
+        read and written are recorded or None if coverage is not being
+        recorded, the default. Set to start or stop recording.
+
+        """
+        return self._coverage
+
+    @coverage.setter
+    def coverage(self, v):
+        def set_coverage():
+            self.mpu.set_coverage(None if v is None else v.buffer)
+            self._coverage = v
+        self._submit(set_coverage)
+
+    @property
+    def heat_map(self):
+        """The burisim.heatmap.HeatMap counting reads and writes of each
+        address or None if accesses are not being counted, the default. Set
+        to start or stop counting.
+
+        """
+        return self._heat_map
+
+    @heat_map.setter
+    def heat_map(self, v):
+        def set_heat_map():
+            self.mpu.set_access_counts(None if v is None else v.buffer)
+            self._heat_map = v
+        self._submit(set_heat_map)
+
+    @property
+    def profiler(self):
+        """The burisim.profile.CallGraphProfiler attributing cycles to the
+        routines running or None if not profiling, the default. Set to start
+        or stop profiling.
+
+        """
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, v):
+        def set_profiler():
+            self.mpu.set_profile(None if v is None else v.handle)
+            self._profiler = v
+        self._submit(set_profiler)
+
+    def call_graph(self):
+        """Return a burisim.profile.CallGraph of the cycles attributed by
+        profiler so far.
+
+        """
+        if self._profiler is None:
+            raise ValueError('Not profiling')
+        return self._submit(self._profiler.call_graph)
+
+    @property
+    def trace(self):
+        """The burisim.trace.TraceWriter recording each instruction executed
+        or None if not tracing, the default. Set to start or stop tracing. The
+        previous writer has any remaining records queued when detached but is
+        not closed.
+
+        """
+        return self._trace
+
+    @trace.setter
+    def trace(self, v):
+        def set_trace():
+            if v is not None and self._instruction_hook is not None:
+                raise ValueError('Cannot trace while an instruction hook is set')
+            self.mpu.set_trace(None if v is None else v.handle)
+            if self._trace is not None and self._trace is not v:
+                self._trace.flush()
+            self._trace = v
+        self._submit(set_trace)
+
+    @property
+    def breakpoints(self):
+        """A sorted list of the addresses of breakpoints.
+
+        """
+        if self._breakpoints is None:
+            return []
+        return [int(a) for a in np.flatnonzero(self._breakpoints)]
+
+    def add_breakpoint(self, address):
+        """Pause the simulation thread with a BreakpointError before the
+        instruction at address is executed. Resuming continues past the
+        breakpoint.
+
+        """
+        def add():
+            if self._breakpoints is None:
+                self._breakpoints = np.zeros(M6502.MEMORY_SIZE, np.uint8)
+                self.mpu.set_breakpoints(self._breakpoints)
+            self._breakpoints[address] = 1
+        self._submit(add)
+
+    def remove_breakpoint(self, address):
+        def remove():
+            if self._breakpoints is not None:
+                self._breakpoints[address] = 0
+        self._submit(remove)
+
+    @property
+    def instruction_hook(self):
+        """The burisim.trace.InstructionHook called with batches of the
+        instructions executed or None, the default. The hook and trace cannot
+        both be set. The previous hook is passed any remaining records when
+        detached. If a hook asks to stop, the simulation thread pauses with a
+        TraceStopError.
+
+        """
+        return self._instruction_hook
+
+    @instruction_hook.setter
+    def instruction_hook(self, v):
+        def set_instruction_hook():
+            if v is not None and self._trace is not None:
+                raise ValueError('Cannot set an instruction hook while tracing')
+            self.mpu.set_trace(None if v is None else v.handle)
+            if self._instruction_hook is not None and self._instruction_hook is not v:
+                self._instruction_hook.flush()
+            self._instruction_hook = v
+        self._submit(set_instruction_hook)
 
     def start(self):
         # ensure we're stopped!
@@ -181,17 +622,56 @@ class BuriSim(object):
 
         # create simulator loop function
         def loop():
-            ticks_per_loop = int(5*2e6) # should mean the loop is around 5Hz.
-            last_report, n_ticks = time.time(), 0
-            while not self._want_stop:
-                n_ticks += self.step(ticks_per_loop)
-                now = time.time()
-                print('Running at {0:d}Hz'.format(int(n_ticks / (now - last_report))))
-                last_report, n_ticks = now, 0
+            try:
+                idle = False
+                while True:
+                    # Block waiting for commands if paused. If the machine is
+                    # idle and not throttled, nothing happens until there is
+                    # some external input so wait up to a slice for commands.
+                    if self._paused:
+                        self._apply_commands(block=True)
+                    elif idle and not self.throttled:
+                        self._apply_commands(block=True, timeout=self.latency)
+                    else:
+                        self._apply_commands(block=False)
+
+                    if self._want_stop:
+                        break
+                    if self._paused:
+                        continue
+
+                    ticks = self.slice_ticks
+                    if self._pause_at is not None:
+                        ticks = max(1, min(ticks, self._pause_at - self.mpu.cycles))
+
+                    idle_cycles, start = self.mpu.idle_cycles, time.time()
+                    try:
+                        ticks = self.step(ticks)
+                    except MachineError as e:
+                        # Pause so that the machine can be inspected or reset.
+                        log = _LOGGER.info if isinstance(e, BreakpointError) else _LOGGER.error
+                        log('%s: pausing simulation', e)
+                        self.error, self._paused = e, True
+                        self._end_slice()
+                        continue
+                    now = time.time()
+                    self._end_slice()
+
+                    # Measure speed excluding skipped cycles.
+                    idle_ticks = self.mpu.idle_cycles - idle_cycles
+                    idle = idle_ticks > 0
+                    if now > start and ticks > idle_ticks:
+                        self._effective_freq = (ticks - idle_ticks) / (now - start)
+            finally:
+                # Stop accepting commands and apply any which are outstanding.
+                with self._commands_lock:
+                    self._accepting_commands = False
+                self._apply_commands(block=False)
 
         # create and start thread
         self._mpu_thread = threading.Thread(target=loop)
         self._want_stop = False
+        self._accepting_commands = True
         self._mpu_thread.start()
 
     def is_running(self):
@@ -202,15 +682,179 @@ class BuriSim(object):
             # we're not running
             return
 
-        # signal stop
+        # signal stop and wake the loop if it is paused
         self._want_stop = True
-        self.mpu.exit()
+        self._commands.put(None)
 
         # wait for thread
         self._mpu_thread.join()
 
     def step(self, ticks):
-        """Single-cycle the machine for a specified number of clock ticks."""
-        # TODO: tracing
+        """Single-cycle the machine for a specified number of clock ticks.
+        Raises a MachineError if the processor stopped early because of an
+        error in the running program."""
         with self._mpu_lock:
-            return self.mpu.run(ticks)
+            start = default_timer()
+            ticks = self.mpu.run(ticks)
+            self.metrics.record_slice(default_timer() - start)
+        self._check_stop()
+        return ticks
+
+    def step_instructions(self, count=1):
+        """Pause the simulation thread and run up to count instructions,
+        stepping over any breakpoint at the current address. Returns the
+        number of instructions run, which is less than count if a breakpoint
+        was reached. Raises a MachineError if the processor stopped early
+        because of an error in the running program.
+
+        The instructions are run in batches of at most a slice so that other
+        control operations are applied in between.
+
+        """
+        def step(n_run):
+            mpu, breakpoints = self.mpu, self._breakpoints
+            if n_run == 0:
+                # Run the first instruction on its own so that a breakpoint
+                # at it can be masked.
+                self.error, self._paused = None, True
+                pc = mpu.registers.pc
+                skip = breakpoints is not None and breakpoints[pc] != 0
+                if skip:
+                    breakpoints[pc] = 0
+                try:
+                    n_run = mpu.step(1)
+                finally:
+                    if skip:
+                        breakpoints[pc] = 1
+            else:
+                n_run = mpu.step(count - n_run, self.slice_ticks)
+            if mpu.stop_reason == M6502.STOP_BREAK:
+                return n_run, True
+            self._check_stop()
+            return n_run, False
+
+        n_run, stopped = 0, False
+        while n_run < count and not stopped:
+            n_batch, stopped = self._submit(lambda n=n_run: step(n))
+            n_run += n_batch
+        return n_run
+
+    def _check_stop(self):
+        """Raise a MachineError if the last run of the processor stopped
+        early because of an error in the running program.
+
+        """
+        reason = self.mpu.stop_reason
+        if reason == M6502.STOP_ILLEGAL:
+            raise IllegalInstructionError(self.mpu.stop_pc, self.mpu.stop_data)
+        elif reason == M6502.STOP_STP:
+            raise ProcessorStoppedError(self.mpu.stop_pc)
+        elif reason == M6502.STOP_FAULT:
+            raise ReadOnlyMemoryError(self.mpu.stop_address, self.mpu.stop_data)
+        elif reason == M6502.STOP_TRACE:
+            raise TraceStopError(self.mpu.stop_pc)
+        elif reason == M6502.STOP_BREAK:
+            raise BreakpointError(self.mpu.stop_pc)
+
+    @property
+    def slice_ticks(self):
+        """The number of clock ticks in each slice run by the simulation
+        thread. This is chosen so that a slice takes around latency seconds.
+
+        """
+        freq = self.mpu.target_freq * 1000
+        if freq == 0:
+            freq = self._effective_freq
+        return max(1, int(self.latency * freq))
+
+    # Control plane
+
+    def _submit(self, fn, wait=True):
+        """Call fn() from the simulation thread between slices and return its
+        result. If the simulation thread is not running, fn() is called
+        directly. If wait is False, return None without waiting for fn() to be
+        called.
+
+        """
+        if threading.current_thread() is self._mpu_thread:
+            return fn()
+
+        with self._commands_lock:
+            cmd = _Command(fn) if self._accepting_commands else None
+            if cmd is not None:
+                self._commands.put(cmd)
+
+        if cmd is None:
+            with self._mpu_lock:
+                return fn()
+
+        if not wait:
+            return None
+        cmd.done.wait()
+        if cmd.exception is not None:
+            raise cmd.exception
+        return cmd.result
+
+    def _apply_commands(self, block, timeout=None):
+        try:
+            cmd = self._commands.get(block, timeout)
+            while True:
+                if cmd is not None:
+                    cmd.apply()
+                cmd = self._commands.get(False)
+        except queue.Empty:
+            pass
+
+    def _resume(self, cycles):
+        self.error, self._paused = None, False
+        self._pause_at = None if cycles is None else self.mpu.cycles + cycles
+
+    def _end_slice(self):
+        if self._pause_at is not None and (self._paused or self.mpu.cycles >= self._pause_at):
+            self._pause_at, self._paused = None, True
+        for listener in self._slice_listeners:
+            listener()
+
+    def _apply_event(self, kind, value=None):
+        """Apply an external event. Called on the simulation thread between
+        slices so that the cycle count at which it is applied is exact.
+
+        """
+        if self.recorder is not None:
+            self.recorder.record(self.mpu.cycles, kind, value)
+
+        if kind == 'rx':
+            self.acia1.receive_byte(value)
+        elif kind == 'reset':
+            self._reset()
+        elif kind == 'irq':
+            self.mpu.irq()
+        elif kind == 'nmi':
+            self.mpu.nmi()
+        else:
+            raise ValueError('Unknown event: ' + repr(kind))
+
+    def _reset(self):
+        # Reset hardware
+        self.acia1.hw_reset()
+
+        # Reset MPU
+        self.mpu.reset()
+
+        # Resume if we were paused by an error
+        if self.error is not None:
+            self.error, self._paused = None, False
+
+    def _snapshot(self):
+        r = self.mpu.registers
+        state = ProcessorState(
+            r.a, r.x, r.y, r.p, r.s, r.pc, self.mpu.cycles, self.mpu.state().sequence
+        )
+        return MachineSnapshot(state, self.mpu.read_memory(0, 0x10000))
+
+    def _restore(self, snapshot):
+        state = snapshot.state
+        self.mpu.write_memory(0, snapshot.memory)
+        self.mpu.set_registers(
+            state.a, state.x, state.y, state.p, state.s, state.pc
+        )
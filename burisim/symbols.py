@@ -0,0 +1,195 @@
+"""
+Map addresses to symbols and source lines using the output of the cc65 tools.
+
+Two formats are understood:
+
+    * debug info files written by ld65 --dbgfile, which give the source lines
+      and symbols making up each address, and
+
+    * VICE label files written by ld65 -Ln, which give only symbols. Each
+      label is treated as a source line of the label file covering the
+      addresses from the label up to the next one so that per-line reports
+      are per-label.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import bisect
+from collections import namedtuple
+import io
+import re
+
+from past.builtins import basestring # pylint: disable=redefined-builtin
+
+SourceLine = namedtuple('SourceLine', 'filename line ranges')
+SourceLine.__doc__ = """A line of source. ranges is a list of (start, size)
+pairs giving the addresses of the bytes it assembled to.
+
+"""
+
+Symbol = namedtuple('Symbol', 'name address filename line')
+Symbol.__doc__ = """A label at address defined at line of filename. line and
+filename are None if unknown.
+
+"""
+
+class SymbolFileError(Exception):
+    """Raised if a debug info or label file cannot be parsed."""
+    pass
+
+class SourceMap(object):
+    """Source lines and symbols for a program. Use load() to read one from a
+    file.
+
+    """
+    def __init__(self, lines=None, symbols=None):
+        self.lines = list(lines or [])
+        self.symbols = sorted(symbols or [], key=lambda s: s.address)
+        self._addresses = [s.address for s in self.symbols]
+
+    def symbol_at(self, address):
+        """Return the Symbol with the highest address not above address or
+        None if there is no such symbol.
+
+        """
+        idx = bisect.bisect_right(self._addresses, address) - 1
+        return self.symbols[idx] if idx >= 0 else None
+
+    def name_for(self, address):
+        """Return a name for address of the form "label" or "label+offset",
+        falling back to "$XXXX" if no label precedes it.
+
+        """
+        symbol = self.symbol_at(address)
+        if symbol is None:
+            return '${0:04X}'.format(address)
+        if symbol.address == address:
+            return symbol.name
+        return '{0}+{1}'.format(symbol.name, address - symbol.address)
+
+def load(fobj_or_string):
+    """Load a SourceMap from a debug info or label file given as a file
+    object or filename-string. The format is detected from the contents.
+
+    """
+    if isinstance(fobj_or_string, basestring):
+        with io.open(fobj_or_string, encoding='utf8') as fobj:
+            return _load(fobj, fobj_or_string)
+    return _load(fobj_or_string, getattr(fobj_or_string, 'name', '<labels>'))
+
+def _load(fobj, name):
+    text = fobj.read()
+    if text.startswith('version'):
+        return parse_dbg(text)
+    return parse_labels(text, name)
+
+# A "key=value" field of a debug info record. Values are numbers, quoted
+# strings or lists of ids separated by "+".
+_DBG_FIELD = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|[^,]*)')
+
+def _dbg_value(v):
+    if v.startswith('"'):
+        return v[1:-1]
+    if '+' in v:
+        return [int(x, 0) for x in v.split('+')]
+    try:
+        return int(v, 0)
+    except ValueError:
+        return v
+
+def parse_dbg(text):
+    """Return a SourceMap parsed from the text of an ld65 debug info file.
+
+    """
+    if not text.startswith('version'):
+        raise SymbolFileError('Not a debug info file')
+
+    records = {}
+    for line in text.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            continue
+        fields = dict(
+            (k, _dbg_value(v)) for k, v in _DBG_FIELD.findall(parts[1])
+        )
+        records.setdefault(parts[0], {})
+        if 'id' in fields:
+            records[parts[0]][fields['id']] = fields
+
+    files = records.get('file', {})
+    segs = records.get('seg', {})
+
+    def span_range(span_id):
+        span = records['span'][span_id]
+        return (segs[span['seg']]['start'] + span['start'], span['size'])
+
+    def as_list(v):
+        return v if isinstance(v, list) else [v]
+
+    # Macro expansions are recorded as several lines with the same file and
+    # line number so merge lines by location.
+    by_location = {}
+    lines = records.get('line', {})
+    try:
+        for rec in lines.values():
+            if 'span' not in rec:
+                continue
+            key = (files[rec['file']]['name'], rec['line'])
+            by_location.setdefault(key, []).extend(
+                span_range(s) for s in as_list(rec['span'])
+            )
+
+        symbols = []
+        for rec in records.get('sym', {}).values():
+            if rec.get('type') != 'lab' or 'val' not in rec:
+                continue
+            filename, line = None, None
+            defs = as_list(rec.get('def', []))
+            if len(defs) > 0 and defs[0] in lines:
+                def_line = lines[defs[0]]
+                filename, line = files[def_line['file']]['name'], def_line['line']
+            symbols.append(Symbol(rec['name'], rec['val'], filename, line))
+    except KeyError as e:
+        raise SymbolFileError('Dangling reference in debug info: {0}'.format(e))
+
+    return SourceMap(
+        [SourceLine(f, l, r) for (f, l), r in sorted(by_location.items())],
+        symbols
+    )
+
+_LABEL = re.compile(r'^al\s+(?:C:)?([0-9A-Fa-f]+)\s+\.?(\S+)')
+
+def parse_labels(text, filename='<labels>'):
+    """Return a SourceMap parsed from the text of a VICE label file. filename
+    is used as the name of the source file in the lines of the map.
+
+    """
+    symbols = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if line.strip() == '':
+            continue
+        match = _LABEL.match(line)
+        if match is None:
+            raise SymbolFileError(
+                '{0}:{1}: not a label: {2!r}'.format(filename, line_no, line)
+            )
+        address = int(match.group(1), 16)
+        symbols.append(Symbol(match.group(2), address, filename, line_no))
+
+    # Each label covers the addresses up to the next distinct label.
+    addresses = sorted(set(s.address for s in symbols)) + [0x10000]
+    lines = []
+    for symbol in symbols:
+        end = addresses[bisect.bisect_right(addresses, symbol.address)]
+        lines.append(SourceLine(
+            filename, symbol.line, [(symbol.address, end - symbol.address)]
+        ))
+
+    return SourceMap(lines, symbols)
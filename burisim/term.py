@@ -0,0 +1,151 @@
+"""
+A terminal for serial output which needs no GUI.
+
+A TerminalSink registered as a listener of an ACIA, e.g. BuriSim.acia1,
+emulates a terminal with pyte so that the screen can be inspected by scripts
+and tests. The listener only appends bytes to a queue so that the simulation
+thread is not slowed down by terminal emulation. Queued bytes are fed to pyte
+in bulk whenever the screen is looked at.
+
+    sink = TerminalSink()
+    sink.attach(sim.acia1)
+    sim.start()
+    if sink.wait_for(r'READY', timeout=5) is None:
+        print(sink.text)
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from collections import deque
+import re
+import threading
+import time
+
+import pyte
+
+class TerminalSink(object):
+    """A columns by lines terminal fed with bytes received by receive_byte().
+    All methods may be called from any thread.
+
+    """
+    def __init__(self, columns=80, lines=24):
+        self.screen = pyte.Screen(columns, lines)
+        self._stream = pyte.ByteStream(self.screen)
+        self.screen.dirty.clear()
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._n_waiters = 0
+        self.received = 0
+
+    def attach(self, acia):
+        """Receive the output of acia, a burisim.hw.acia.ACIA.
+
+        """
+        acia.register_listener(self.receive_byte)
+
+    def detach(self, acia):
+        acia.unregister_listener(self.receive_byte)
+
+    def receive_byte(self, b):
+        """Queue byte b for the terminal. Called on the simulation thread.
+
+        """
+        self._pending.append(b)
+        # Only take the lock if someone is waiting. A waiter counts itself in
+        # _n_waiters before feeding the queue and so either sees this byte or
+        # is woken.
+        if self._n_waiters > 0:
+            with self._cond:
+                self._cond.notify_all()
+
+    def feed(self, data):
+        """Feed the bytes-like object data to the terminal directly, e.g. to
+        simulate local echo.
+
+        """
+        with self._cond:
+            self._feed_pending()
+            self._feed(bytes(data))
+
+    @property
+    def display(self):
+        """A list of the text of each line of the screen.
+
+        """
+        with self._cond:
+            self._feed_pending()
+            return list(self.screen.display)
+
+    @property
+    def text(self):
+        """The text of the screen with lines separated by newlines.
+
+        """
+        return '\n'.join(self.display)
+
+    @property
+    def cursor(self):
+        """The (column, line) position of the cursor.
+
+        """
+        with self._cond:
+            self._feed_pending()
+            return (self.screen.cursor.x, self.screen.cursor.y)
+
+    def dirty_lines(self):
+        """Return a dict mapping the index of each line which has changed
+        since the last call to its text.
+
+        """
+        with self._cond:
+            self._feed_pending()
+            dirty = dict(
+                (idx, self.screen.display[idx]) for idx in sorted(self.screen.dirty)
+            )
+            self.screen.dirty.clear()
+            return dirty
+
+    def wait_for(self, pattern, timeout=None):
+        """Wait until the regular expression pattern, a string or compiled
+        expression, matches the screen text and return the match. Returns
+        None if timeout seconds pass first. Patterns may match across lines.
+
+        """
+        regex = re.compile(pattern) if not hasattr(pattern, 'search') else pattern
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._n_waiters += 1
+            try:
+                while True:
+                    self._feed_pending()
+                    match = regex.search('\n'.join(self.screen.display))
+                    if match is not None:
+                        return match
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return None
+                    if len(self._pending) == 0:
+                        self._cond.wait(remaining)
+            finally:
+                self._n_waiters -= 1
+
+    def _feed_pending(self):
+        # Called with _cond held.
+        n_pending = len(self._pending)
+        if n_pending == 0:
+            return
+        popleft = self._pending.popleft
+        self._feed(bytes(bytearray(popleft() for _ in range(n_pending))))
+
+    def _feed(self, data):
+        self._stream.feed(data)
+        self.received += len(data)
@@ -0,0 +1,490 @@
+"""
+Capture instruction traces to disk and analyse them.
+
+Usage:
+    burisim-trace (-h | --help)
+    burisim-trace info <trace>
+    burisim-trace mix <trace>
+    burisim-trace (reads | writes) [options] <trace> <range>
+    burisim-trace dump [options] <trace>
+    burisim-trace bench [options]
+
+Options:
+    -h, --help          Show a brief usage summary.
+
+    --limit N           Show at most N records, 0 for all [default: 100].
+    --symbols FILE      Name addresses using an ld65 debug info file
+                        (--dbgfile) or VICE label file (-Ln).
+    --batch N           Records per batch of the benchmarked
+                        InstructionHook [default: 4096].
+    --instructions N    Instructions to run for each benchmark
+                        [default: 20000000].
+
+Ranges are given in hex as START-END, inclusive, or a single address, e.g.
+"0200-02FF" or "$DFFC".
+
+A TraceWriter attached to a BuriSim via BuriSim.trace has the processor
+append a record of each instruction to a native buffer. When the buffer
+fills, the run thread copies it and hands it to a writer thread which
+encodes, compresses and writes it so that emulation only waits for disk if
+the writer falls a long way behind.
+
+An InstructionHook uses the same native buffer to run Python on every
+instruction: the processor calls it with a numpy view of each batch of
+records and stops if it asks. "burisim-trace bench" measures the cost per
+instruction. As a guide, a do-nothing hook with the default batches of 4096
+records adds around 3ns per instruction to the 12ns or so of emulation, and
+each batch costs around 2us for calling into Python and wrapping the records.
+
+A trace file is the magic bytes MAGIC followed by chunks, each of which is a
+header, CHUNK, giving the number of records, the size of the payload, the
+cycle count of the first record and flags, followed by the payload. The
+payload is columnar: each field of the records in the chunk is stored
+contiguously in the order of COLUMNS. Program counter and cycle count are
+stored as differences from the previous record and registers as an XOR with
+the previous record so that most bytes are zero and compress well. The
+difference in program counter wraps around at 64K. Differences in cycle
+count are stored in 32 bits and so TraceWriter starts a new chunk at any
+larger gap, e.g. one skipped by idle detection. Chunks are independent and so TraceReader decodes one chunk at a time, letting
+traces much larger than memory be analysed.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import logging
+import queue
+import struct
+import sys
+import threading
+from timeit import default_timer
+import zlib
+
+from docopt import docopt
+import numpy as np
+from past.builtins import basestring # pylint: disable=redefined-builtin
+
+from burisim import symbols
+from burisim._lib6502 import lib, ffi # pylint: disable=no-name-in-module
+from burisim.lib6502 import M6502
+
+_LOGGER = logging.getLogger(__name__)
+
+# Values of the access field of a record
+READ = lib.M6502_TraceRead
+WRITE = lib.M6502_TraceWrite
+
+MAGIC = b'BURITRC1'
+
+# Chunk header: records, payload bytes, first cycle count and flags
+CHUNK = struct.Struct('<IIQB')
+FLAG_COMPRESSED = 1 << 0
+
+# Largest difference in cycle count between consecutive records of a chunk
+MAX_CYCLES_DELTA = (1 << 32) - 1
+
+# Encoding of each column of a chunk payload in order. Encodings are None,
+# 'delta' or 'xor' as described in the module documentation.
+COLUMNS = (
+    ('pc', '<u2', 'delta'),
+    ('opcode', 'u1', None),
+    ('a', 'u1', 'xor'),
+    ('x', 'u1', 'xor'),
+    ('y', 'u1', 'xor'),
+    ('p', 'u1', 'xor'),
+    ('s', 'u1', 'xor'),
+    ('cycles', '<u4', 'delta'),
+    ('access', 'u1', None),
+    ('address', '<u2', None),
+    ('data', 'u1', None),
+)
+
+# Decoded records as yielded by TraceReader
+RECORD_DTYPE = np.dtype([
+    ('cycles', '<u8'), ('pc', '<u2'), ('opcode', 'u1'),
+    ('a', 'u1'), ('x', 'u1'), ('y', 'u1'), ('p', 'u1'), ('s', 'u1'),
+    ('access', 'u1'), ('address', '<u2'), ('data', 'u1'),
+])
+
+# Layout of M6502_TraceRecord in the native buffer
+_NATIVE_DTYPE = np.dtype({
+    'names': RECORD_DTYPE.names,
+    'formats': [RECORD_DTYPE.fields[n][0] for n in RECORD_DTYPE.names],
+    'offsets': [ffi.offsetof('M6502_TraceRecord', n) for n in RECORD_DTYPE.names],
+    'itemsize': ffi.sizeof('M6502_TraceRecord'),
+})
+
+class TraceFormatError(Exception):
+    """Raised if a trace file is not valid."""
+    pass
+
+def _encode(records):
+    """Return the payload for a chunk of records and the cycle count of the
+    first.
+
+    """
+    columns = []
+    for name, dtype, encoding in COLUMNS:
+        col = records[name]
+        if encoding == 'delta':
+            prev = np.concatenate((col[:1] if name == 'cycles' else [0], col[:-1]))
+            col = col - prev.astype(col.dtype)
+        elif encoding == 'xor':
+            col = col ^ np.concatenate(([0], col[:-1])).astype(col.dtype)
+        columns.append(col.astype(dtype).tobytes())
+    return b''.join(columns), int(records['cycles'][0])
+
+def _decode(payload, n_records, first_cycles):
+    records = np.empty(n_records, RECORD_DTYPE)
+    offset = 0
+    for name, dtype, encoding in COLUMNS:
+        dtype = np.dtype(dtype)
+        col = np.frombuffer(payload, dtype, n_records, offset)
+        offset += dtype.itemsize * n_records
+        if encoding == 'delta':
+            col = np.cumsum(col, dtype=records.dtype[name])
+            if name == 'cycles':
+                col += np.uint64(first_cycles)
+        elif encoding == 'xor':
+            col = np.bitwise_xor.accumulate(col)
+        records[name] = col
+    return records
+
+class TraceWriter(object):
+    """Write a trace to a file object or filename. Attach to a BuriSim via
+    BuriSim.trace and close() once detached. Records are collected natively
+    in chunks of chunk_records and at most max_pending chunks wait for the
+    writer thread before the run thread waits for it. If compress is True,
+    chunks are compressed with zlib.
+
+    """
+    CHUNK_RECORDS = 1 << 16
+
+    def __init__(self, fobj_or_string, compress=True,
+                 chunk_records=CHUNK_RECORDS, max_pending=64):
+        if isinstance(fobj_or_string, basestring):
+            self._fobj, self._owns_fobj = open(fobj_or_string, 'wb'), True
+        else:
+            self._fobj, self._owns_fobj = fobj_or_string, False
+        self._fobj.write(MAGIC)
+        self.compress = compress
+        self.records_written = 0
+
+        self._records = ffi.new('M6502_TraceRecord[]', chunk_records)
+        self._trace = ffi.new('M6502_Trace *')
+        self._trace.records = self._records
+        self._trace.size = chunk_records
+        self._trace.n = 0
+        self._flush_cb = ffi.callback('void(M6502_Trace *)', self._flush_full)
+        self._trace.flush = self._flush_cb
+
+        self._pending = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._write_chunks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def handle(self):
+        """The cffi "M6502_Trace *" to pass to M6502.set_trace().
+
+        """
+        return self._trace
+
+    def flush(self):
+        """Queue any records collected since the last chunk. Must not be
+        called while the processor is running. BuriSim does this when the
+        trace is detached.
+
+        """
+        if self._trace.n > 0:
+            self._flush_full(self._trace)
+
+    def close(self):
+        """Write any remaining records and wait for the writer thread.
+
+        """
+        self.flush()
+        self._pending.put(None)
+        self._thread.join()
+        if self._owns_fobj:
+            self._fobj.close()
+        else:
+            self._fobj.flush()
+
+    def _flush_full(self, trace):
+        # Called on the run thread so copy the records and leave the rest to
+        # the writer thread.
+        size = trace.n * _NATIVE_DTYPE.itemsize
+        self._pending.put(ffi.buffer(trace.records, size)[:])
+        trace.n = 0
+
+    def _write_chunks(self):
+        while True:
+            data = self._pending.get()
+            if data is None:
+                return
+            records = np.frombuffer(data, _NATIVE_DTYPE)
+            gaps = np.flatnonzero(np.diff(records['cycles']) > MAX_CYCLES_DELTA)
+            for chunk in np.split(records, gaps + 1):
+                self._write_chunk(chunk)
+
+    def _write_chunk(self, records):
+        payload, first_cycles = _encode(records)
+        flags = 0
+        if self.compress:
+            payload, flags = zlib.compress(payload, 1), FLAG_COMPRESSED
+        self._fobj.write(CHUNK.pack(len(records), len(payload), first_cycles, flags))
+        self._fobj.write(payload)
+        self.records_written += len(records)
+
+class InstructionHook(object):
+    """Call fn(records) with each batch of batch_size records of the
+    instructions run. Attach to a BuriSim via BuriSim.instruction_hook or to a
+    M6502 via M6502.set_trace(hook.handle). records is a numpy array with the
+    fields of RECORD_DTYPE which views the native buffer and so is only valid
+    during the call. fn is called on the run thread while the processor is
+    running and must not use the processor other than to read memory.
+
+    If fn returns a true value, the processor stops with M6502.STOP_TRACE
+    before the next instruction. A BuriSim raises TraceStopError and pauses.
+    Larger batches cost less per instruction but fn sees instructions later.
+
+    """
+    BATCH_SIZE = 1 << 12
+
+    def __init__(self, fn, batch_size=BATCH_SIZE):
+        self.fn = fn
+        self.records_seen = 0
+        self._records = ffi.new('M6502_TraceRecord[]', batch_size)
+        self._trace = ffi.new('M6502_Trace *')
+        self._trace.records = self._records
+        self._trace.size = batch_size
+        self._trace.n = 0
+        self._flush_cb = ffi.callback('void(M6502_Trace *)', self._flush_full)
+        self._trace.flush = self._flush_cb
+
+    @property
+    def handle(self):
+        """The cffi "M6502_Trace *" to pass to M6502.set_trace().
+
+        """
+        return self._trace
+
+    def flush(self):
+        """Pass any records collected since the last batch to fn. Must not be
+        called while the processor is running. BuriSim does this when the hook
+        is detached. Returns the result of fn, or None if there were no
+        records.
+
+        """
+        if self._trace.n == 0:
+            return None
+        result = self._call(self._trace)
+        self._trace.n = 0
+        return result
+
+    def _flush_full(self, trace):
+        if self._call(trace):
+            trace.stop = 1
+        trace.n = 0
+
+    def _call(self, trace):
+        size = trace.n * _NATIVE_DTYPE.itemsize
+        records = np.frombuffer(ffi.buffer(trace.records, size), _NATIVE_DTYPE)
+        self.records_seen += trace.n
+        return self.fn(records)
+
+class TraceReader(object):
+    """Read a trace written by TraceWriter from a file object or filename.
+    Iterating yields numpy arrays of RECORD_DTYPE, one per chunk.
+
+    """
+    def __init__(self, fobj_or_string):
+        if isinstance(fobj_or_string, basestring):
+            self._fobj, self._owns_fobj = open(fobj_or_string, 'rb'), True
+        else:
+            self._fobj, self._owns_fobj = fobj_or_string, False
+        if self._fobj.read(len(MAGIC)) != MAGIC:
+            raise TraceFormatError('Not a trace file')
+        self._start = self._fobj.tell()
+
+    def chunks(self):
+        """Yield the records of each chunk in turn.
+
+        """
+        self._fobj.seek(self._start)
+        while True:
+            header = self._fobj.read(CHUNK.size)
+            if len(header) == 0:
+                return
+            if len(header) != CHUNK.size:
+                raise TraceFormatError('Truncated chunk header')
+            n_records, size, first_cycles, flags = CHUNK.unpack(header)
+            payload = self._fobj.read(size)
+            if len(payload) != size:
+                raise TraceFormatError('Truncated chunk')
+            if flags & FLAG_COMPRESSED:
+                payload = zlib.decompress(payload)
+            yield _decode(payload, n_records, first_cycles)
+
+    __iter__ = chunks
+
+    def close(self):
+        if self._owns_fobj:
+            self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def accesses(reader, start, end, access):
+    """Yield arrays of the records from reader, chunk by chunk, which read or
+    write, according to access (READ, WRITE or both), an address in the
+    inclusive range [start, end].
+
+    """
+    for records in reader:
+        mask = ((records['access'] & access) != 0) \
+            & (records['address'] >= start) & (records['address'] <= end)
+        if mask.any():
+            yield records[mask]
+
+def instruction_mix(reader):
+    """Return an array with the number of times each opcode was executed.
+
+    """
+    counts = np.zeros(0x100, np.uint64)
+    for records in reader:
+        counts += np.bincount(records['opcode'], minlength=0x100).astype(np.uint64)
+    return counts
+
+_MNEMONICS = []
+
+def mnemonic(opcode):
+    """Return the mnemonic of opcode as disassembled by lib6502, e.g. "lda".
+
+    """
+    if len(_MNEMONICS) == 0:
+        mpu, buf = M6502(), ffi.new('char[64]')
+        for op in range(0x100):
+            mpu.memory[0] = op
+            lib.M6502_disassemble(mpu._mpu, 0, buf) # pylint: disable=protected-access
+            _MNEMONICS.append(ffi.string(buf).decode('ascii').split()[0])
+    return _MNEMONICS[opcode]
+
+# A loop copying a page at $0300 to $0400 and the address to run it from
+_BENCH_PROGRAM = bytes(bytearray([
+    0xa2, 0x00,         # LDX #$00
+    0xbd, 0x00, 0x03,   # LDA $0300,X
+    0x9d, 0x00, 0x04,   # STA $0400,X
+    0xe8,               # INX
+    0xd0, 0xf7,         # BNE $0202
+    0x4c, 0x00, 0x02,   # JMP $0200
+]))
+_BENCH_START = 0x0200
+
+def bench(instructions, batch_size=InstructionHook.BATCH_SIZE):
+    """Run a copy loop for at least instructions instructions with no
+    hook, a hook which does nothing and a hook which sums the accumulator
+    with numpy and return a list of (description, nanoseconds per
+    instruction) pairs.
+
+    """
+    hooks = [
+        ('no hook', None),
+        ('empty hook', InstructionHook(lambda records: None, batch_size)),
+        ('numpy hook', InstructionHook(lambda records: records['a'].sum() < 0, batch_size)),
+    ]
+    results = []
+    for description, hook in hooks:
+        mpu = M6502()
+        mpu.write_memory(_BENCH_START, _BENCH_PROGRAM)
+        mpu.registers.pc = _BENCH_START
+        mpu.target_freq = 0
+        mpu.set_trace(None if hook is None else hook.handle)
+        # The loop averages 4.6 ticks per instruction.
+        start = default_timer()
+        mpu.run(instructions * 5)
+        elapsed = default_timer() - start
+        results.append((description, 1e9 * elapsed / max(1, mpu.instructions)))
+    return results
+
+def _parse_range(s):
+    bounds = [int(b.strip().lstrip('$'), 16) for b in s.split('-', 1)]
+    return bounds[0], bounds[-1]
+
+def _format_record(r, name_for):
+    access = ''
+    if r['access'] & WRITE:
+        access = ' W {0} = ${1:02X}'.format(name_for(int(r['address'])), r['data'])
+    elif r['access'] & READ:
+        access = ' R {0}'.format(name_for(int(r['address'])))
+    return '{0:>12} {1:<16} {2:<4} A={3:02X} X={4:02X} Y={5:02X} P={6:02X} S={7:02X}{8}'.format(
+        int(r['cycles']), name_for(int(r['pc'])), mnemonic(r['opcode']),
+        r['a'], r['x'], r['y'], r['p'], r['s'], access
+    )
+
+def _print_records(chunks, limit, name_for):
+    shown = 0
+    for records in chunks:
+        for r in records:
+            if limit > 0 and shown >= limit:
+                return
+            print(_format_record(r, name_for))
+            shown += 1
+
+def main():
+    opts = docopt(__doc__)
+    logging.basicConfig(
+        level=logging.INFO, stream=sys.stderr, format='%(name)s: %(message)s'
+    )
+
+    name_for = lambda addr: '${0:04X}'.format(addr)
+    if opts['--symbols'] is not None:
+        name_for = symbols.load(opts['--symbols']).name_for
+
+    if opts['bench']:
+        for description, nsec in bench(int(opts['--instructions']), int(opts['--batch'])):
+            print('{0:<12} {1:8.1f} ns/instruction'.format(description, nsec))
+        return
+
+    with TraceReader(opts['<trace>']) as reader:
+        if opts['info']:
+            n_chunks, n_records, first, last = 0, 0, None, None
+            for records in reader:
+                n_chunks += 1
+                n_records += len(records)
+                if first is None:
+                    first = int(records['cycles'][0])
+                last = int(records['cycles'][-1])
+            print('{0} records in {1} chunks'.format(n_records, n_chunks))
+            if first is not None:
+                print('cycles {0} to {1}'.format(first, last))
+        elif opts['mix']:
+            counts = instruction_mix(reader)
+            by_mnemonic = {}
+            for op in np.flatnonzero(counts):
+                name = mnemonic(op)
+                by_mnemonic[name] = by_mnemonic.get(name, 0) + int(counts[op])
+            total = max(1, sum(by_mnemonic.values()))
+            for name, count in sorted(by_mnemonic.items(), key=lambda i: -i[1]):
+                print('{0:<4} {1:>14} {2:>6.2f}%'.format(name, count, 100.0 * count / total))
+        elif opts['reads'] or opts['writes']:
+            start, end = _parse_range(opts['<range>'])
+            access = READ if opts['reads'] else WRITE
+            _print_records(
+                accesses(reader, start, end, access), int(opts['--limit']), name_for
+            )
+        elif opts['dump']:
+            _print_records(reader, int(opts['--limit']), name_for)
+
+if __name__ == '__main__':
+    main()
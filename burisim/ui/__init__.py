@@ -8,9 +8,13 @@ from builtins import (  # pylint: disable=redefined-builtin, unused-import
 )
 
 import cgi
+import time
 
+import numpy as np
 from PySide import QtCore, QtGui
 
+from burisim.heatmap import HeatMap, READS, WRITES
+from burisim.memscan import MemoryWatch, find, parse_pattern
 from .display import HD44780View, TerminalView
 
 class HexSpinBox(QtGui.QSpinBox):
@@ -49,11 +53,31 @@ class HexSpinBox(QtGui.QSpinBox):
             return QtGui.QValidator.Invalid
 
 class MemoryView(QtGui.QWidget):
+    # Seconds for which changed bytes stay highlighted
+    CHANGE_HIGHLIGHT_TIME = 1.0
+
+    # Background colours of changed bytes and bytes matching a search
+    CHANGED_COLOR = '#ffb0b0'
+    MATCHED_COLOR = '#ffff80'
+
     def __init__(self, *args, **kwargs):
         super(MemoryView, self).__init__(*args, **kwargs)
         self.simulator = None
         self._page = 0
         self._cached_page_contents = None
+
+        # Watch of the current page and when each byte of it stops being
+        # highlighted as changed
+        self._watch = None
+        self._changed_until = np.zeros(0x100)
+
+        # The last search, the addresses matching it, which match was shown
+        # last and which bytes of memory are part of a match
+        self._pattern_text = None
+        self._matches = np.zeros(0, np.intp)
+        self._match_index = -1
+        self._matched = np.zeros(0x10000, np.bool_)
+
         self._init_ui()
 
     def page(self):
@@ -61,6 +85,7 @@ class MemoryView(QtGui.QWidget):
 
     def setPage(self, v):
         self._page = v
+        self._watch = None
         self._refresh_mem()
 
     @QtCore.Slot(int)
@@ -94,45 +119,115 @@ class MemoryView(QtGui.QWidget):
         )
         sb.valueChanged.connect(self._spinValueChanged)
         h.addWidget(sb)
+        self._sb = sb
+        cb = QtGui.QCheckBox("Highlight changes")
+        cb.setChecked(True)
+        h.addWidget(cb)
+        self._highlight_changes = cb
+        l.addLayout(h)
+
+        h = QtGui.QHBoxLayout()
+        h.setSpacing(5)
+        h.addWidget(QtGui.QLabel("Find:"))
+        le = QtGui.QLineEdit()
+        le.setPlaceholderText('Hex bytes, e.g. A9 ?? 8D, or "text"')
+        le.returnPressed.connect(self._find_next)
+        h.addWidget(le)
+        self._find_edit = le
+        lb = QtGui.QLabel()
+        h.addWidget(lb)
+        self._find_label = lb
         l.addLayout(h)
 
         self._refresh_timer = QtCore.QTimer(self)
         self._refresh_timer.timeout.connect(self._refresh_mem)
         self._refresh_timer.start(66) # run at approx ~15Hz
 
+    @QtCore.Slot()
+    def _find_next(self):
+        """Search memory for the pattern entered if it is new and otherwise
+        show the page of the next match.
+
+        """
+        if self.simulator is None:
+            return
+
+        text = self._find_edit.text()
+        if text != self._pattern_text:
+            self._pattern_text = text
+            self._matches, self._match_index = np.zeros(0, np.intp), -1
+            self._matched[...] = False
+            try:
+                pattern = parse_pattern(text)
+            except ValueError:
+                self._find_label.setText('Invalid pattern')
+                self._refresh_mem()
+                return
+            self._matches = find(self.simulator.memory_array, pattern)
+            for offset in range(len(pattern)):
+                self._matched[np.minimum(self._matches + offset, 0xffff)] = True
+
+        if len(self._matches) == 0:
+            self._find_label.setText('Not found')
+        else:
+            self._match_index = (self._match_index + 1) % len(self._matches)
+            address = int(self._matches[self._match_index])
+            self._find_label.setText('${0:04X} ({1} of {2})'.format(
+                address, self._match_index + 1, len(self._matches)
+            ))
+            self._sb.setValue(address >> 8)
+        self._refresh_mem()
+
     def _refresh_mem(self):
         if self.simulator is None:
             return
 
         page_size = 0x100
         page_offset = page_size * self._page
-        current_page = list(
-            self.simulator.memory[page_offset:page_offset+page_size]
-        )
+        memory = self.simulator.memory_array
+        now = time.time()
+
+        # Note which bytes have changed since the last refresh
+        if self._watch is None:
+            self._watch = MemoryWatch(memory, [(page_offset, page_offset + page_size)])
+            self._changed_until[...] = 0
+        addresses, _, _ = self._watch.changes()
+        if self._highlight_changes.isChecked():
+            self._changed_until[addresses - page_offset] = \
+                now + MemoryView.CHANGE_HIGHLIGHT_TIME
+        changed = self._changed_until > now
+        matched = self._matched[page_offset:page_offset + page_size]
+
+        current_page = bytearray(memory[page_offset:page_offset + page_size])
         cpc = self._cached_page_contents
-        if cpc is not None and cpc == (page_offset, current_page):
+        page_contents = (page_offset, current_page, changed.tobytes(), matched.tobytes())
+        if cpc is not None and cpc == page_contents:
             # no change
             return
 
         # record page contents
-        self._cached_page_contents = (page_offset, current_page)
-
-        def mem_contents():
-            m = self.simulator.memory
-            start = 0x100 * self._page
-            for line_offset in range(0x000, 0x100, 0x010):
-                contents = m[start + line_offset:start + line_offset+0x010]
-                yield line_offset, contents
-            raise StopIteration()
-
-        def render_line(offset, contents):
+        self._cached_page_contents = page_contents
+
+        def render_byte(offset):
+            text = '{0:02X}'.format(current_page[offset])
+            color = None
+            if changed[offset]:
+                color = MemoryView.CHANGED_COLOR
+            elif matched[offset]:
+                color = MemoryView.MATCHED_COLOR
+            if color is None:
+                return text
+            return '<span style="background-color: {0}">{1}</span>'.format(color, text)
+
+        def render_line(offset):
+            contents = current_page[offset:offset+0x10]
             hexrepr = '  '.join(
-                ' '.join('{0:02X}'.format(b) for b in contents[o:o+8])
+                ' '.join(render_byte(offset + i) for i in range(o, o+8))
                 for o in range(0, len(contents), 8)
             )
             asciirepr = ''.join(chr(b) if b>=32 and b<127 else '.' for b  in contents)
-            return '<strong><code>{0:04X}</code></strong><code>  {1:48}  |{2:16}|</code>'.format(
-                self._page*0x100 + offset, hexrepr, cgi.escape(asciirepr)
+            return '<strong><code>{0:04X}</code></strong><code>  {1}  |{2:16}|</code>'.format(
+                page_offset + offset, hexrepr, cgi.escape(asciirepr)
             )
 
         self._te.setHtml(''.join((
@@ -145,12 +240,233 @@ class MemoryView(QtGui.QWidget):
                 ),
                 '</code></strong>',
             )),
-            '\n'.join(render_line(o, c) for o, c in mem_contents()),
+            '\n'.join(render_line(o) for o in range(0x000, page_size, 0x010)),
             '</pre>',
         )))
 
         self._te.setMinimumSize(self._te.document().size().toSize())
 
+class StateView(QtGui.QWidget):
+    def __init__(self, *args, **kwargs):
+        super(StateView, self).__init__(*args, **kwargs)
+        self.simulator = None
+        self._cached_state = None
+        self._init_ui()
+
+    def _init_ui(self):
+        l = QtGui.QVBoxLayout()
+        self.setLayout(l)
+        l.setContentsMargins(0, 0, 0, 0)
+
+        lb = QtGui.QLabel()
+        lb.setFont(QtGui.QFont('Monospace'))
+        lb.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+        l.addWidget(lb)
+        self._label = lb
+
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.timeout.connect(self._refresh_state)
+        self._refresh_timer.start(66) # run at approx ~15Hz
+
+    def _refresh_state(self):
+        if self.simulator is None:
+            return
+
+        # Reading the published state never blocks the simulation thread.
+        state = self.simulator.state
+        if self._cached_state is not None and \
+                self._cached_state.sequence == state.sequence:
+            # no change
+            return
+        self._cached_state = state
+
+        flags = ''.join(
+            c if state.p & (1<<(7-i)) != 0 else '-'
+            for i, c in enumerate('NV-BDIZC')
+        )
+        self._label.setText('\n'.join((
+            'PC={0.pc:04X} SP={1:04X}'.format(state, 0x100 + state.s),
+            'A={0.a:02X} X={0.x:02X} Y={0.y:02X}'.format(state),
+            'P={0.p:02X} {1}'.format(state, flags),
+            'Cycles={0.cycles:d}'.format(state),
+        )))
+
+class _HeatMapImage(QtGui.QWidget):
+    """Draws a 256x256 image scaled to fit and reports the address under the
+    mouse, taking the image as having a row per page.
+
+    """
+    hovered = QtCore.Signal(int)
+
+    def __init__(self, *args, **kwargs):
+        super(_HeatMapImage, self).__init__(*args, **kwargs)
+        self.image = None
+        self.setMouseTracking(True)
+        self.setMinimumSize(256, 256)
+        self.setSizePolicy(
+            QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding
+        )
+
+    def _image_rect(self):
+        side = min(self.width(), self.height())
+        return QtCore.QRect(
+            (self.width() - side) // 2, (self.height() - side) // 2, side, side
+        )
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.black)
+        if self.image is not None:
+            painter.drawImage(self._image_rect(), self.image)
+
+    def mouseMoveEvent(self, event):
+        r = self._image_rect()
+        if not r.contains(event.pos()):
+            return
+        col = (event.pos().x() - r.x()) * 0x100 // r.width()
+        row = (event.pos().y() - r.y()) * 0x100 // r.height()
+        self.hovered.emit((row << 8) | col)
+
+class HeatMapView(QtGui.QWidget):
+    """Shows how often each address has recently been read (green) and
+    written (red) as an image with a row per page. Counting is turned on by
+    the "Count accesses" check box since it slows the machine slightly.
+
+    """
+    # How often, in milliseconds, the image is refreshed
+    REFRESH_INTERVAL = 250
+
+    def __init__(self, *args, **kwargs):
+        super(HeatMapView, self).__init__(*args, **kwargs)
+        self.simulator = None
+        self.heat_map = HeatMap()
+        self._hovered = None
+        self._pixels = None
+        self._init_ui()
+
+    def _init_ui(self):
+        l = QtGui.QVBoxLayout()
+        self.setLayout(l)
+        l.setSpacing(5)
+        l.setContentsMargins(0, 0, 0, 0)
+
+        cb = QtGui.QCheckBox("Count accesses")
+        cb.toggled.connect(self._setCounting)
+        l.addWidget(cb)
+
+        im = _HeatMapImage()
+        im.hovered.connect(self._setHovered)
+        l.addWidget(im)
+        self._image = im
+
+        lb = QtGui.QLabel()
+        lb.setFont(QtGui.QFont('Monospace'))
+        l.addWidget(lb)
+        self._label = lb
+
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.timeout.connect(self._refresh)
+        self._refresh_timer.start(self.REFRESH_INTERVAL)
+
+    @QtCore.Slot(bool)
+    def _setCounting(self, v):
+        if self.simulator is None:
+            return
+        self.heat_map.reset()
+        self.simulator.heat_map = self.heat_map if v else None
+
+    @QtCore.Slot(int)
+    def _setHovered(self, addr):
+        self._hovered = addr
+        self._refresh_label()
+
+    def _refresh(self):
+        if self.simulator is None or self.simulator.heat_map is None:
+            return
+
+        self.heat_map.sample()
+        # Keep the pixels alive for as long as the image which refers to them.
+        self._pixels = self.heat_map.image().tobytes()
+        self._image.image = QtGui.QImage(
+            self._pixels, 0x100, 0x100, QtGui.QImage.Format_RGB32
+        )
+        self._image.update()
+        self._refresh_label()
+
+    def _refresh_label(self):
+        if self._hovered is None:
+            return
+        window = self.heat_map.window
+        self._label.setText('${0:04X}: {1:.0f} reads, {2:.0f} writes'.format(
+            self._hovered, window[READS, self._hovered],
+            window[WRITES, self._hovered]
+        ))
+
+class HandlerView(QtGui.QWidget):
+    """Shows the calls of and time spent in each I/O handler. Latency
+    percentiles are shown when "Record latency" is checked.
+
+    """
+    # How often, in milliseconds, the table is refreshed
+    REFRESH_INTERVAL = 500
+
+    COLUMNS = ('Handler', 'Calls', 'Total', 'Mean', 'p50', 'p99')
+
+    def __init__(self, *args, **kwargs):
+        super(HandlerView, self).__init__(*args, **kwargs)
+        self.simulator = None
+        self._init_ui()
+
+    def _init_ui(self):
+        l = QtGui.QVBoxLayout()
+        self.setLayout(l)
+        l.setSpacing(5)
+        l.setContentsMargins(0, 0, 0, 0)
+
+        cb = QtGui.QCheckBox("Record latency")
+        cb.toggled.connect(self._setRecording)
+        l.addWidget(cb)
+
+        t = QtGui.QTableWidget(0, len(self.COLUMNS))
+        t.setHorizontalHeaderLabels(self.COLUMNS)
+        t.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        t.verticalHeader().hide()
+        l.addWidget(t)
+        self._table = t
+
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.timeout.connect(self._refresh)
+        self._refresh_timer.start(self.REFRESH_INTERVAL)
+
+    @QtCore.Slot(bool)
+    def _setRecording(self, v):
+        if self.simulator is None:
+            return
+        self.simulator.record_handler_latency = v
+
+    def _refresh(self):
+        if self.simulator is None:
+            return
+
+        def us(nsec):
+            return '-' if nsec is None else '{0:.1f}us'.format(nsec / 1e3)
+
+        rows = sorted(self.simulator.handler_stats.items())
+        self._table.setRowCount(len(rows))
+        for row, ((kind, name), stats) in enumerate(rows):
+            cells = (
+                '{0} {1}'.format(name, kind), str(stats.calls),
+                '{0:.1f}ms'.format(stats.nsec / 1e6),
+                us(stats.nsec // stats.calls if stats.calls > 0 else None),
+                us(stats.percentile(50)), us(stats.percentile(99)),
+            )
+            for col, text in enumerate(cells):
+                item = self._table.item(row, col)
+                if item is None:
+                    item = QtGui.QTableWidgetItem()
+                    self._table.setItem(row, col, item)
+                item.setText(text)
+
 def create_ui(sim):
     mw = QtGui.QMainWindow()
 
@@ -166,6 +482,28 @@ def create_ui(sim):
     dw.setWidget(v)
     mw.addDockWidget(QtCore.Qt.LeftDockWidgetArea, dw)
 
+    v = StateView()
+    v.simulator = sim
+    dw = QtGui.QDockWidget("Processor state")
+    dw.setWidget(v)
+    mw.addDockWidget(QtCore.Qt.LeftDockWidgetArea, dw)
+
+    # Only a local simulator can count accesses.
+    if hasattr(sim, 'heat_map'):
+        v = HeatMapView()
+        v.simulator = sim
+        dw = QtGui.QDockWidget("Memory heat map")
+        dw.setWidget(v)
+        mw.addDockWidget(QtCore.Qt.RightDockWidgetArea, dw)
+
+    # Only a local simulator times its handlers.
+    if hasattr(sim, 'handler_stats'):
+        v = HandlerView()
+        v.simulator = sim
+        dw = QtGui.QDockWidget("I/O handlers")
+        dw.setWidget(v)
+        mw.addDockWidget(QtCore.Qt.RightDockWidgetArea, dw)
+
     v = HD44780View()
     v.display = sim.display
     dw = QtGui.QDockWidget("Display")
@@ -174,7 +512,7 @@ def create_ui(sim):
 
     v = TerminalView()
     sim.acia1.register_listener(v.receiveByte)
-    v.transmitByte.connect(sim.acia1.receive_byte)
+    v.transmitByte.connect(sim.receive_serial)
     dw = QtGui.QDockWidget("Serial console")
     dw.setWidget(v)
     mw.addDockWidget(QtCore.Qt.RightDockWidgetArea, dw)
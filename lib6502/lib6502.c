@@ -29,6 +29,7 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <time.h>
 
 #include "lib6502.h"
@@ -37,10 +38,59 @@ typedef uint8_t  byte;
 typedef uint16_t word;
 
 enum {
-  requestExit = (1<<1), /* Immediate exit from M6502_run() */
-  requestIRQ  = (1<<0), /* IRQ has been requested */
+  M6502_MaxLagNSec = 50000000, /* resynchronise throttling if this far behind */
+  M6502_UnthrottledSlice = 10000, /* ticks per slice if target_freq is 0 */
+  M6502_MaxBlockInsns = 32,    /* longest run of instructions in a cached block */
+  M6502_MaxStateTries = 100000, /* give up reading a state being updated after this many tries */
 };
 
+static void outOfMemory(void);
+
+/* State used to detect busy-wait loops. See idleBranch() in M6502_run(). */
+typedef struct
+{
+  word  pc;             /* target of the most recent backward branch */
+  byte  a, x, y, p, s;  /* registers when that branch was taken */
+  int   dirty;          /* memory written or call callback made since then */
+  int   io_reads;       /* non-zero if an I/O location has been read */
+  int   io_changed;     /* read a different I/O location or value */
+  word  io_addr;        /* the I/O location read */
+  byte  io_value;       /* the value read from it */
+} IdleState;
+
+static inline byte
+idleIORead_(IdleState *idle, word addr, byte value)
+{
+  if (!idle->io_reads)
+    {
+      idle->io_reads= 1;
+      idle->io_addr= addr;
+      idle->io_value= value;
+    }
+  else if ((addr != idle->io_addr) || (value != idle->io_value))
+    {
+      idle->io_changed= 1;
+    }
+  return value;
+}
+
+/* Bits of mpu->request_flags. The low byte holds one-shot requests which are
+ * cleared by M6502_run() when acted upon. The remaining bits are the
+ * level-sensitive IRQ lines set by M6502_setIRQLine(). Keeping these in the
+ * same word means M6502_run() need only load one word per instruction to
+ * find out if there is anything to do. */
+enum {
+  requestIRQ   = (1<<0), /* IRQ has been requested */
+  requestExit  = (1<<1), /* Immediate exit from M6502_run() */
+  requestNMI   = (1<<2), /* NMI has been requested */
+  requestMask  = 0xff,   /* all one-shot requests */
+  irqLineShift = 8,      /* IRQ line n is bit n + irqLineShift */
+  irqLineMask  = ~0xffu  /* all IRQ lines */
+};
+
+/* Anything which should wake the processor from a WAI. */
+#define wakeMask        (requestIRQ | requestNMI | irqLineMask)
+
 enum {
   flagN= (1<<7),        /* negative      */
   flagV= (1<<6),        /* overflow      */
@@ -71,16 +121,89 @@ enum {
 #define tick(n)
 #define tickIf(p)
 
-/* memory access (indirect if callback installed) -- ARGUMENTS ARE EVALUATED MORE THAN ONCE! */
+/* add ticks charged by call callbacks (see M6502_run) */
+
+#define chargeCycles()          ((void)0)
 
-#define putMemory(ADDR, BYTE)                   \
-  ( writeCallback[ADDR]                         \
-      ? writeCallback[ADDR](mpu, ADDR, BYTE)    \
-      : (memory[ADDR]= BYTE) )
+/* idle loop detection hooks (see M6502_run) */
+
+#define idleWrite()             ((void)0)
+#define idleRead(ADDR, BYTE)    (BYTE)
+#define idleBranch()
+
+/* coverage hooks (see M6502_run) */
+
+#define markExec(ADDR)          ((void)0)
+#define markRead(ADDR)          ((void)0)
+#define markWrite(ADDR)         ((void)0)
+#define countRead(ADDR)         ((void)0)
+#define countWrite(ADDR)        ((void)0)
+
+/* tracing hooks (see M6502_run) */
+
+#define traceInsn()             ((void)0)
+#define traceRead(ADDR)         ((void)0)
+#define traceWrite(ADDR, BYTE)  ((void)0)
+
+/* breakpoint hooks (see M6502_run) */
+
+#define checkBreakpoint()       ((void)0)
+
+/* profiling hooks (see M6502_run) */
+
+#define profileCall(ADDR, KIND) ((void)0)
+#define profileReturn()         ((void)0)
+
+/* write to a read-only page (see M6502_run) */
+
+#define writeFault(ADDR, BYTE)  0
+
+/* wall time since start in nanoseconds */
+
+static uint64_t M6502_nsecSince_(struct timespec *start)
+{
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint64_t)(now.tv_sec - start->tv_sec) * 1000000000 + now.tv_nsec - start->tv_nsec;
+}
 
-#define getMemory(ADDR)                         \
-  ( readCallback[ADDR]                          \
-      ?  readCallback[ADDR](mpu, ADDR, 0)       \
+/* call a read, write or call callback, accounting for the time spent in it
+ * (see invoke) */
+
+static int M6502_callback_(M6502 *mpu, M6502_Callback callback, uint16_t addr, uint8_t data)
+{
+  struct timespec start;
+  int result;
+  clock_gettime(CLOCK_MONOTONIC, &start);
+  result= callback(mpu, addr, data);
+  mpu->callback_nsec += M6502_nsecSince_(&start);
+  mpu->callbacks_run++;
+  return result;
+}
+
+#define invoke(CALLBACK, ADDR, DATA)    M6502_callback_(mpu, (CALLBACK), (ADDR), (DATA))
+
+/* memory access (indirect if callback installed) -- ARGUMENTS ARE EVALUATED MORE THAN ONCE! */
+
+#define putMemory(ADDR, BYTE)                                   \
+  ( idleWrite(),                                                \
+    markWrite(ADDR),                                            \
+    countWrite(ADDR),                                           \
+    traceWrite(ADDR, BYTE),                                     \
+    writeCallback[ADDR]                                         \
+      ? invoke(writeCallback[ADDR], ADDR, BYTE)                 \
+      : (pageAttrs[(ADDR) >> 8] < M6502_PageROMIgnore)          \
+        ? (memory[ADDR]= BYTE)                                  \
+        : (pageAttrs[(ADDR) >> 8] == M6502_PageROMFault)        \
+          ? writeFault(ADDR, BYTE)                              \
+          : 0 )
+
+#define getMemory(ADDR)                                         \
+  ( markRead(ADDR),                                             \
+    countRead(ADDR),                                            \
+    traceRead(ADDR),                                            \
+    readCallback[ADDR]                                          \
+      ?  idleRead(ADDR, invoke(readCallback[ADDR], ADDR, 0))    \
       :  memory[ADDR] )
 
 /* stack access (always direct) */
@@ -90,6 +213,11 @@ enum {
 
 /* adressing modes (memory access direct) */
 
+/* operand bytes following the opcode at PC - 1 (redefined by the block cache) */
+
+#define operandByte()   (memory[PC])
+#define operandWord()   (memory[PC] + (memory[PC + 1] << 8))
+
 #define implied(ticks)                          \
   tick(ticks);
 
@@ -99,7 +227,7 @@ enum {
 
 #define abs(ticks)                              \
   tick(ticks);                                  \
-  ea= memory[PC] + (memory[PC + 1] << 8);       \
+  ea= operandWord();                            \
   PC += 2;
 
 #define relative(ticks)                         \
@@ -119,43 +247,48 @@ enum {
 
 #define absx(ticks)                                             \
   tick(ticks);                                                  \
-  ea= memory[PC] + (memory[PC + 1] << 8);                       \
+  ea= operandWord();                                            \
   PC += 2;                                                      \
   tickIf((ticks == 4) && ((ea >> 8) != ((ea + X) >> 8)));       \
   ea += X;
 
 #define absy(ticks)                                             \
   tick(ticks);                                                  \
-  ea= memory[PC] + (memory[PC + 1] << 8);                       \
+  ea= operandWord();                                            \
   PC += 2;                                                      \
   tickIf((ticks == 4) && ((ea >> 8) != ((ea + Y) >> 8)));       \
   ea += Y
 
 #define zp(ticks)                               \
   tick(ticks);                                  \
-  ea= memory[PC++];
+  ea= operandByte();                            \
+  PC++;
 
 #define zpx(ticks)                              \
   tick(ticks);                                  \
-  ea= memory[PC++] + X;                         \
+  ea= operandByte() + X;                        \
+  PC++;                                         \
   ea &= 0x00ff;
 
 #define zpy(ticks)                              \
   tick(ticks);                                  \
-  ea= memory[PC++] + Y;                         \
+  ea= operandByte() + Y;                        \
+  PC++;                                         \
   ea &= 0x00ff;
 
 #define indx(ticks)                             \
   tick(ticks);                                  \
   {                                             \
-    byte tmp= memory[PC++] + X;                 \
+    byte tmp= operandByte() + X;                \
+    PC++;                                       \
     ea= memory[tmp] + (memory[tmp + 1] << 8);   \
   }
 
 #define indy(ticks)                                             \
   tick(ticks);                                                  \
   {                                                             \
-    byte tmp= memory[PC++];                                     \
+    byte tmp= operandByte();                                    \
+    PC++;                                                       \
     ea= memory[tmp] + (memory[tmp + 1] << 8);                   \
     tickIf((ticks == 5) && ((ea >> 8) != ((ea + Y) >> 8)));     \
     ea += Y;                                                    \
@@ -173,7 +306,8 @@ enum {
   tick(ticks);                                          \
   {                                                     \
     byte tmp;                                           \
-    tmp= memory[PC++];                                  \
+    tmp= operandByte();                                 \
+    PC++;                                               \
     ea = memory[tmp] + (memory[tmp + 1] << 8);          \
   }
 
@@ -476,6 +610,7 @@ enum {
       adrmode(ticks);                           \
       PC += ea;                                 \
       tick(1);                                  \
+      idleBranch();                             \
     }                                           \
   else                                          \
     {                                           \
@@ -499,6 +634,7 @@ enum {
   PC += ea;                                     \
   fetch();                                      \
   tick(1);                                      \
+  idleBranch();                                 \
   next();
 
 #define jmp(ticks, adrmode)                             \
@@ -507,8 +643,11 @@ enum {
   if (mpu->callbacks->call[ea])                         \
     {                                                   \
       word addr;                                        \
+      idleWrite();                                      \
       externalise();                                    \
-      if ((addr= mpu->callbacks->call[ea](mpu, ea, 0))) \
+      addr= invoke(mpu->callbacks->call[ea], ea, 0);    \
+      chargeCycles();                                   \
+      if (addr)                                         \
         {                                               \
           internalise();                                \
           PC= addr;                                     \
@@ -526,8 +665,11 @@ enum {
   if (mpu->callbacks->call[ea])                         \
     {                                                   \
       word addr;                                        \
+      idleWrite();                                      \
       externalise();                                    \
-      if ((addr= mpu->callbacks->call[ea](mpu, ea, 0))) \
+      addr= invoke(mpu->callbacks->call[ea], ea, 0);    \
+      chargeCycles();                                   \
+      if (addr)                                         \
         {                                               \
           internalise();                                \
           PC= addr;                                     \
@@ -535,12 +677,14 @@ enum {
           next();                                       \
         }                                               \
     }                                                   \
+  profileCall(ea, M6502_ProfileCall);                   \
   PC=ea;                                                \
   fetch();                                              \
   next();
 
 #define rts(ticks, adrmode)                     \
   tick(ticks);                                  \
+  profileReturn();                              \
   PC  =  pop();                                 \
   PC |= (pop() << 8);                           \
   PC++;                                         \
@@ -560,13 +704,17 @@ enum {
     if (mpu->callbacks->call[hdlr])                             \
       {                                                         \
         word addr;                                              \
+        idleWrite();                                            \
         externalise();                                          \
-        if ((addr= mpu->callbacks->call[hdlr](mpu, PC - 2, 0))) \
+        addr= invoke(mpu->callbacks->call[hdlr], PC - 2, 0);    \
+        chargeCycles();                                         \
+        if (addr)                                               \
           {                                                     \
             internalise();                                      \
             hdlr= addr;                                         \
           }                                                     \
       }                                                         \
+    profileCall(hdlr, M6502_ProfileBRK);                        \
     PC= hdlr;                                                   \
   }                                                             \
   fetch();                                                      \
@@ -574,6 +722,7 @@ enum {
 
 #define rti(ticks, adrmode)                     \
   tick(ticks);                                  \
+  profileReturn();                              \
   P=     pop();                                 \
   PC=    pop();                                 \
   PC |= (pop() << 8);                           \
@@ -588,9 +737,30 @@ enum {
 #define ill(ticks, adrmode)                                             \
   fetch();                                                              \
   tick(ticks);                                                          \
-  fflush(stdout);                                                       \
-  fprintf(stderr, "\nundefined instruction %02X\n", memory[PC-1]);      \
-  abort();
+  --PC;                                                                 \
+  stopProcessor(M6502_StopIllegal, PC, memory[PC]);                     \
+  next();
+
+#define stp(ticks, adrmode)                                             \
+  fetch();                                                              \
+  tick(ticks);                                                          \
+  /* leave PC at the STP so that we stop again until reset */           \
+  --PC;                                                                 \
+  stopProcessor(M6502_StopSTP, PC, memory[PC]);                         \
+  next();
+
+#define wai(ticks, adrmode)                                             \
+  fetch();                                                              \
+  tick(ticks);                                                          \
+  if (!(mpu->request_flags & wakeMask))                                 \
+    {                                                                   \
+      /* Stay on the WAI until an interrupt is requested. */            \
+      --PC;                                                             \
+      waitForInterrupt();                                               \
+    }                                                                   \
+  else                                                                  \
+    mpu->waiting= 0;                                                    \
+  next();
 
 #define phR(ticks, adrmode, R)                  \
   fetch();                                      \
@@ -692,11 +862,11 @@ enum {
   _(bc, ldy, absx,      4);  _(bd, lda, absx,      4);  _(be, ldx, absy,      4);  _(bf, ill, implied, 2);      \
   _(c0, cpy, immediate, 3);  _(c1, cmp, indx,      6);  _(c2, ill, implied,   2);  _(c3, ill, implied, 2);      \
   _(c4, cpy, zp,        3);  _(c5, cmp, zp,        3);  _(c6, dec, zp,        5);  _(c7, ill, implied, 2);      \
-  _(c8, iny, implied,   2);  _(c9, cmp, immediate, 3);  _(ca, dex, implied,   2);  _(cb, ill, implied, 2);      \
+  _(c8, iny, implied,   2);  _(c9, cmp, immediate, 3);  _(ca, dex, implied,   2);  _(cb, wai, implied, 3);      \
   _(cc, cpy, abs,       4);  _(cd, cmp, abs,       4);  _(ce, dec, abs,       6);  _(cf, ill, implied, 2);      \
   _(d0, bne, relative,  2);  _(d1, cmp, indy,      5);  _(d2, cmp, indzp,     3);  _(d3, ill, implied, 2);      \
   _(d4, ill, implied,   2);  _(d5, cmp, zpx,       4);  _(d6, dec, zpx,       6);  _(d7, ill, implied, 2);      \
-  _(d8, cld, implied,   2);  _(d9, cmp, absy,      4);  _(da, phx, implied,   3);  _(db, ill, implied, 2);      \
+  _(d8, cld, implied,   2);  _(d9, cmp, absy,      4);  _(da, phx, implied,   3);  _(db, stp, implied, 3);      \
   _(dc, ill, implied,   2);  _(dd, cmp, absx,      4);  _(de, dec, absx,      7);  _(df, ill, implied, 2);      \
   _(e0, cpx, immediate, 3);  _(e1, sbc, indx,      6);  _(e2, ill, implied,   2);  _(e3, ill, implied, 2);      \
   _(e4, cpx, zp,        3);  _(e5, sbc, zp,        3);  _(e6, inc, zp,        5);  _(e7, ill, implied, 2);      \
@@ -709,43 +879,138 @@ enum {
 
 
 
+/* Wake M6502_run() if it is waiting for an interrupt. */
+static void M6502_wake_(M6502 *mpu)
+{
+  pthread_mutex_lock(&mpu->wait_mutex);
+  pthread_cond_broadcast(&mpu->wait_cond);
+  pthread_mutex_unlock(&mpu->wait_mutex);
+}
+
+
 void M6502_irq(M6502 *mpu)
 {
   /* Atomically set request IRQ flag via GCC builtin. */
   __sync_fetch_and_or(&mpu->request_flags, requestIRQ);
+  M6502_wake_(mpu);
 }
 
-/* Actually perform IRQ. */
-void M6502_irq_real_(M6502 *mpu)
+void M6502_setIRQLine(M6502 *mpu, unsigned int line, int asserted)
 {
-  if (!(mpu->registers->p & flagI))
+  unsigned int bit= 1u << (line + irqLineShift);
+
+  /* Atomically update the line via GCC builtins. */
+  if (asserted)
     {
-      mpu->memory[0x0100 + mpu->registers->s--] = (byte)(mpu->registers->pc >> 8);
-      mpu->memory[0x0100 + mpu->registers->s--] = (byte)(mpu->registers->pc & 0xff);
-      mpu->memory[0x0100 + mpu->registers->s--] = mpu->registers->p;
-      mpu->registers->p &= ~flagB;
-      mpu->registers->p |=  flagI;
-      mpu->registers->pc = M6502_getVector(mpu, IRQ);
+      __sync_fetch_and_or(&mpu->request_flags, bit);
+      M6502_wake_(mpu);
     }
+  else
+    __sync_fetch_and_and(&mpu->request_flags, ~bit);
 }
 
 
-void M6502_nmi(M6502 *mpu)
+unsigned int M6502_getIRQLines(M6502 *mpu)
+{
+  return mpu->request_flags >> irqLineShift;
+}
+
+
+/* Push PC and P and jump through the vector at VEC. */
+static void M6502_interrupt_(M6502 *mpu, word vector)
 {
   mpu->memory[0x0100 + mpu->registers->s--] = (byte)(mpu->registers->pc >> 8);
   mpu->memory[0x0100 + mpu->registers->s--] = (byte)(mpu->registers->pc & 0xff);
   mpu->memory[0x0100 + mpu->registers->s--] = mpu->registers->p;
   mpu->registers->p &= ~flagB;
   mpu->registers->p |=  flagI;
-  mpu->registers->pc = M6502_getVector(mpu, NMI);
+  mpu->registers->pc = mpu->memory[vector] | (mpu->memory[vector + 1] << 8);
+}
+
+
+void M6502_nmi(M6502 *mpu)
+{
+  /* Atomically set request NMI flag via GCC builtin. The NMI is performed by
+   * the thread running the processor. */
+  __sync_fetch_and_or(&mpu->request_flags, requestNMI);
+  M6502_wake_(mpu);
+}
+
+
+void M6502_publish(M6502 *mpu)
+{
+  M6502_State *state= mpu->state;
+
+  /* The GCC atomic builtins also act as full memory barriers. */
+  __sync_fetch_and_add(&state->sequence, 1);
+  state->registers= *mpu->registers;
+  state->cycles= mpu->cycles;
+  __sync_fetch_and_add(&state->sequence, 1);
+}
+
+
+/* Set the registers from outside M6502_run(), e.g. to restore a snapshot.
+ * Any WAI being waited on is forgotten since PC need no longer point at it:
+ * an interrupt would otherwise step PC past the instruction at the new
+ * address. */
+void M6502_setRegisters(M6502 *mpu, const M6502_Registers *registers)
+{
+  *mpu->registers= *registers;
+  mpu->waiting= 0;
+  M6502_publish(mpu);
+}
+
+
+int M6502_readState(const M6502_State *shared, M6502_State *out)
+{
+  const volatile M6502_State *state= shared;
+  unsigned int sequence;
+  int tries;
+
+  for (tries= 0;  tries < M6502_MaxStateTries;  ++tries)
+    {
+      /* skip any in-progress update */
+      if ((sequence= state->sequence) & 1)
+        continue;
+      __sync_synchronize();
+      out->registers= *(M6502_Registers *)&state->registers;
+      out->cycles= state->cycles;
+      __sync_synchronize();
+      if (sequence == state->sequence)
+        {
+          out->sequence= sequence;
+          return 1;
+        }
+    }
+
+  return 0;
+}
+
+
+void M6502_getState(M6502 *mpu, M6502_State *out)
+{
+  while (!M6502_readState(mpu->state, out))
+    ;
+}
+
+
+void M6502_setState(M6502 *mpu, M6502_State *state)
+{
+  if (mpu->flags & M6502_StateAllocated) free(mpu->state);
+  mpu->flags &= ~M6502_StateAllocated;
+  mpu->state= state;
+  M6502_publish(mpu);
 }
 
 
 void M6502_reset(M6502 *mpu)
 {
+  mpu->waiting= 0;
   mpu->registers->p &= ~flagD;
   mpu->registers->p |=  flagI;
   mpu->registers->pc = M6502_getVector(mpu, RST);
+  if (mpu->profile) mpu->profile->depth= 0;
+  M6502_publish(mpu);
 }
 
 
@@ -753,6 +1018,26 @@ void M6502_exit(M6502 *mpu)
 {
   /* Atomically set request exit flag via GCC builtin. */
   __sync_fetch_and_or(&mpu->request_flags, requestExit);
+  M6502_wake_(mpu);
+}
+
+
+/* Block until an IRQ or exit is requested or, if deadline is non-NULL, until
+ * deadline. Returns immediately if a request is already pending. */
+static void M6502_wait_(M6502 *mpu, struct timespec *deadline)
+{
+  struct timespec start;
+  clock_gettime(CLOCK_MONOTONIC, &start);
+  pthread_mutex_lock(&mpu->wait_mutex);
+  while (!(mpu->request_flags & (wakeMask | requestExit)))
+    {
+      if (!deadline)
+        pthread_cond_wait(&mpu->wait_cond, &mpu->wait_mutex);
+      else if (pthread_cond_timedwait(&mpu->wait_cond, &mpu->wait_mutex, deadline))
+        break; /* timed out */
+    }
+  pthread_mutex_unlock(&mpu->wait_mutex);
+  mpu->sleep_nsec += M6502_nsecSince_(&start);
 }
 
 
@@ -804,6 +1089,313 @@ void fixup_timespec(struct timespec *ts)
   }
 }
 
+/* The block cache. A block is the longest run of instructions starting at a
+ * given address which contains no control flow, no instruction which might
+ * stop the processor and no direct access to a location with a read or write
+ * callback or to an M6502_PageIO page. Each instruction is stored with its operand already fetched so
+ * that M6502_run() need not fetch and decode it again. The cache should only
+ * cover memory which does not change, e.g. ROM, unless M6502_flushBlockCache()
+ * is called whenever it does. */
+
+typedef struct
+{
+  byte  opcode;
+  byte  length;   /* including the opcode */
+  word  operand;  /* the operand bytes, if any */
+} M6502_Insn;
+
+struct _M6502_Block
+{
+  unsigned int  n_insns;    /* 0 => the first instruction is always interpreted */
+  M6502_Insn    insns[];
+};
+
+/* Instructions which must always be interpreted: control flow and anything
+ * which might stop or suspend the processor. */
+static const char *M6502_unblockable_[]= {
+  "brk", "jsr", "rti", "rts", "jmp",
+  "bpl", "bmi", "bvc", "bvs", "bcc", "bcs", "bne", "beq", "bra",
+  "wai", "stp", "ill",
+  NULL
+};
+
+/* Return the length of the instruction with the given opcode or 0 if it must
+ * always be interpreted. *direct is set if the operand is a fixed address. */
+static int
+M6502_blockInsnInfo_(byte opcode, int *direct)
+{
+  const char  *name= NULL;
+  const char **p;
+  int          length= 0;
+
+# define _implied       length= 1;  *direct= 0
+# define _immediate     length= 2;  *direct= 0
+# define _relative      length= 2;  *direct= 0
+# define _zp            length= 2;  *direct= 1
+# define _zpx           length= 2;  *direct= 0
+# define _zpy           length= 2;  *direct= 0
+# define _indx          length= 2;  *direct= 0
+# define _indy          length= 2;  *direct= 0
+# define _indzp         length= 2;  *direct= 0
+# define _abs           length= 3;  *direct= 1
+# define _absx          length= 3;  *direct= 0
+# define _absy          length= 3;  *direct= 0
+# define _indirect      length= 3;  *direct= 0
+# define _indabsx       length= 3;  *direct= 0
+# define blockInfo(num, insn, mode, cycles)     case 0x##num: name= #insn;  _##mode;  break
+
+  switch (opcode)
+    {
+      do_insns(blockInfo);
+    }
+
+# undef blockInfo
+# undef _implied
+# undef _immediate
+# undef _relative
+# undef _zp
+# undef _zpx
+# undef _zpy
+# undef _indx
+# undef _indy
+# undef _indzp
+# undef _abs
+# undef _absx
+# undef _absy
+# undef _indirect
+# undef _indabsx
+
+  for (p= M6502_unblockable_;  *p;  ++p)
+    if (!strcmp(name, *p))
+      return 0;
+
+  return length;
+}
+
+/* Decode the block starting at addr, which must be within the cache. */
+static M6502_Block *
+M6502_decodeBlock_(M6502 *mpu, word addr)
+{
+  M6502_Insn    insns[M6502_MaxBlockInsns];
+  M6502_Block  *block;
+  unsigned int  n= 0;
+  uint32_t      pc= addr;
+  uint32_t      end= mpu->block_start + mpu->block_size;
+  M6502_Callbacks *callbacks= mpu->callbacks;
+
+  while (n < M6502_MaxBlockInsns)
+    {
+      byte opcode= mpu->memory[pc];
+      int  direct;
+      int  length= M6502_blockInsnInfo_(opcode, &direct);
+      word operand;
+
+      if (!length || (pc + length > end))
+        break;
+
+      operand= (length > 1) ? mpu->memory[pc + 1] : 0;
+      if (length > 2) operand |= mpu->memory[pc + 2] << 8;
+
+      /* leave I/O to the interpreter */
+      if (direct && (callbacks->read[operand] || callbacks->write[operand]
+                     || (mpu->page_attrs[operand >> 8] == M6502_PageIO)))
+        break;
+
+      insns[n].opcode= opcode;
+      insns[n].length= length;
+      insns[n].operand= operand;
+      ++n;
+      pc += length;
+    }
+
+  block= (M6502_Block *)malloc(sizeof(M6502_Block) + n * sizeof(M6502_Insn));
+  if (!block) outOfMemory();
+  block->n_insns= n;
+  memcpy(block->insns, insns, n * sizeof(M6502_Insn));
+
+  return block;
+}
+
+
+void M6502_flushBlockCache(M6502 *mpu)
+{
+  uint32_t i;
+
+  if (!mpu->blocks)
+    return;
+
+  for (i= 0;  i < mpu->block_size;  ++i)
+    {
+      free(mpu->blocks[i]);
+      mpu->blocks[i]= NULL;
+    }
+}
+
+
+void M6502_setPageAttrs(M6502 *mpu, uint16_t start, uint32_t size, uint8_t attr)
+{
+  uint32_t page;
+
+  for (page= start >> 8;  (page < 0x100) && (page << 8) < start + size;  ++page)
+    mpu->page_attrs[page]= attr;
+
+  M6502_flushBlockCache(mpu);
+}
+
+
+void M6502_setBlockCache(M6502 *mpu, uint16_t start, uint32_t size)
+{
+  if (size > 0x10000 - (uint32_t)start)
+    size= 0x10000 - start;
+
+  M6502_flushBlockCache(mpu);
+  free(mpu->blocks);
+  mpu->blocks= NULL;
+  mpu->block_start= start;
+  mpu->block_size= 0;
+
+  if (size)
+    {
+      mpu->blocks= (M6502_Block **)calloc(size, sizeof(M6502_Block *));
+      if (!mpu->blocks) outOfMemory();
+      mpu->block_size= size;
+    }
+}
+
+void M6502_setCoverage(M6502 *mpu, uint8_t *coverage)
+{
+  mpu->coverage= coverage;
+}
+
+void M6502_setAccessCounts(M6502 *mpu, uint32_t *counts)
+{
+  mpu->access_counts= counts;
+}
+
+
+M6502_Profile *M6502_newProfile(void)
+{
+  M6502_Profile *profile= (M6502_Profile *)calloc(1, sizeof(M6502_Profile));
+  if (!profile) outOfMemory();
+
+  profile->max_nodes= 1024;
+  profile->nodes= (M6502_ProfileNode *)calloc(profile->max_nodes, sizeof(M6502_ProfileNode));
+  if (!profile->nodes) outOfMemory();
+  profile->n_nodes= 1;  /* the root */
+
+  return profile;
+}
+
+
+void M6502_deleteProfile(M6502_Profile *profile)
+{
+  free(profile->nodes);
+  free(profile);
+}
+
+
+void M6502_setProfile(M6502 *mpu, M6502_Profile *profile)
+{
+  mpu->profile= profile;
+  if (profile) profile->mark= mpu->cycles;
+}
+
+
+void M6502_setTrace(M6502 *mpu, M6502_Trace *trace)
+{
+  mpu->trace= trace;
+}
+
+
+/* breakpoints has a byte per address. The processor stops with
+ * M6502_StopBreak before executing an instruction at an address whose
+ * byte is non-zero, unless the previous run stopped there, so that running
+ * again continues past the breakpoint. */
+void M6502_setBreakpoints(M6502 *mpu, uint8_t *breakpoints)
+{
+  mpu->breakpoints= breakpoints;
+}
+
+
+/* Attribute the ticks up to cycle count now to the innermost frame. */
+static inline void
+M6502_profileMark_(M6502_Profile *profile, uint64_t now)
+{
+  profile->nodes[profile->stack_node[profile->depth]].cycles += now - profile->mark;
+  profile->mark= now;
+}
+
+
+/* Return the node for calls to addr from parent, adding it if necessary. */
+static uint32_t
+M6502_profileChild_(M6502_Profile *profile, uint32_t parent, word addr, byte kind)
+{
+  M6502_ProfileNode *node;
+  uint32_t child;
+
+  for (child= profile->nodes[parent].first_child;  child;  child= profile->nodes[child].next_sibling)
+    if ((profile->nodes[child].address == addr) && (profile->nodes[child].kind == kind))
+      return child;
+
+  if (profile->n_nodes == M6502_ProfileMaxNodes)
+    return parent;
+
+  if (profile->n_nodes == profile->max_nodes)
+    {
+      profile->max_nodes *= 2;
+      profile->nodes= (M6502_ProfileNode *)realloc(profile->nodes,
+                                                   profile->max_nodes * sizeof(M6502_ProfileNode));
+      if (!profile->nodes) outOfMemory();
+    }
+
+  child= profile->n_nodes++;
+  node= &profile->nodes[child];
+  memset(node, 0, sizeof(*node));
+  node->address= addr;
+  node->kind= kind;
+  node->parent= parent;
+  node->next_sibling= profile->nodes[parent].first_child;
+  profile->nodes[parent].first_child= child;
+
+  return child;
+}
+
+
+/* A routine at addr was entered leaving the stack pointer at sp. */
+static void
+M6502_profileEnter_(M6502_Profile *profile, uint64_t now, word addr, byte kind, byte sp)
+{
+  uint32_t child;
+
+  M6502_profileMark_(profile, now);
+
+  /* frames at or below the new one were abandoned without returning */
+  while (profile->depth && (profile->stack_sp[profile->depth] <= sp))
+    --profile->depth;
+  if (profile->depth == M6502_ProfileMaxDepth - 1)
+    return;
+
+  child= M6502_profileChild_(profile, profile->stack_node[profile->depth], addr, kind);
+  profile->nodes[child].calls++;
+  ++profile->depth;
+  profile->stack_node[profile->depth]= child;
+  profile->stack_sp[profile->depth]= sp;
+}
+
+
+/* An RTS or RTI is about to pull its return address from above sp. */
+static void
+M6502_profileLeave_(M6502_Profile *profile, uint64_t now, byte sp)
+{
+  M6502_profileMark_(profile, now);
+
+  /* unwind frames abandoned by stack manipulation */
+  while (profile->depth && (profile->stack_sp[profile->depth] < sp))
+    --profile->depth;
+  if (profile->depth && (profile->stack_sp[profile->depth] == sp))
+    --profile->depth;
+}
+
 uint64_t M6502_run(M6502 *mpu, uint64_t ticks)
 {
   /* There used to be an implementation making use of computed goto here.
@@ -817,13 +1409,144 @@ uint64_t M6502_run(M6502 *mpu, uint64_t ticks)
 # define next()                                 break
 # define dispatch(num, name, mode, cycles)      case 0x##num: name(cycles, mode);  next()
 # define end()                                  }
-# define abort()                                return tick_count
 
 # undef tick
 # undef tickIf
 # define tick(n) (tick_count+=(n))
 # define tickIf(p) (tick_count+=((p)?1:0))
-# define should_continue() (!exit_immediately && ((ticks==0) || (tick_count<ticks)))
+# define should_continue() (!exit_immediately && (instructions < end_instructions) && ((ticks==0) || (tick_count<ticks)))
+
+  /* A short backward branch taken with all registers the same as the last
+   * time it was taken, with no memory written, no call callbacks and at most
+   * one I/O location read, always giving the same value, means that the
+   * processor is busy-waiting. Since nothing can change until the I/O value
+   * does, skip ahead to the end of the slice (throttled) or of the run
+   * (unthrottled). The loop is re-checked once per slice. */
+# undef idleWrite
+# undef idleRead
+# undef idleBranch
+# define idleWrite()            (idle.dirty= 1)
+# define idleRead(ADDR, BYTE)   idleIORead_(&idle, (ADDR), (BYTE))
+# define idleBranch()                                                                   \
+  if ((ea & 0x8000) && mpu->idle_detect)                                                \
+    {                                                                                   \
+      if ((PC == idle.pc) && !idle.dirty && !idle.io_changed                            \
+          && (A == idle.a) && (X == idle.x) && (Y == idle.y)                            \
+          && (P == idle.p) && (S == idle.s))                                            \
+        {                                                                               \
+          uint64_t limit= next_ticks;                                                   \
+          if ((ticks != 0) && ((ticks < limit) || !mpu->target_freq)) limit= ticks;    \
+          if ((tick_count < limit) && !mpu->request_flags)                              \
+            {                                                                           \
+              mpu->idle_cycles += limit - tick_count;                                   \
+              tick_count= limit;                                                        \
+            }                                                                           \
+        }                                                                               \
+      else                                                                              \
+        {                                                                               \
+          idle.pc= PC;  idle.a= A;  idle.x= X;  idle.y= Y;  idle.p= P;  idle.s= S;      \
+          idle.dirty= 0;  idle.io_reads= 0;  idle.io_changed= 0;                        \
+        }                                                                               \
+    }
+
+  /* Account for emulated ticks charged by a call callback. */
+# undef chargeCycles
+# define chargeCycles()                                         \
+  ( tick_count += mpu->cycle_charge,                            \
+    mpu->trap_cycles += mpu->cycle_charge,                      \
+    mpu->cycle_charge= 0 )
+
+  /* Stop running and record why. */
+# define stopProcessor(REASON, ADDR, DATA)                      \
+  ( mpu->stop_reason= (REASON), mpu->stop_pc= PC,               \
+    mpu->stop_address= (ADDR), mpu->stop_data= (DATA),          \
+    exit_immediately= 1 )
+
+  /* A write to a M6502_PageROMFault page. The instruction completes, without
+   * the write, and so stop_pc is that of the next instruction. */
+# undef writeFault
+# define writeFault(ADDR, BYTE)         stopProcessor(M6502_StopFault, (ADDR), (BYTE))
+
+  /* Record coverage if enabled. A predictable branch and a byte store. */
+# undef markExec
+# undef markRead
+# undef markWrite
+# define markExec(ADDR)         (coverage ? (void)(coverage[M6502_CoverageExec + (ADDR)]= 1) : (void)0)
+# define markRead(ADDR)         (coverage ? (void)(coverage[M6502_CoverageRead + (ADDR)]= 1) : (void)0)
+# define markWrite(ADDR)        (coverage ? (void)(coverage[M6502_CoverageWrite + (ADDR)]= 1) : (void)0)
+
+  /* Count accesses if enabled. */
+# undef countRead
+# undef countWrite
+# define countRead(ADDR)        (counts ? (void)(++counts[M6502_CountReads + (ADDR)]) : (void)0)
+# define countWrite(ADDR)       (counts ? (void)(++counts[M6502_CountWrites + (ADDR)]) : (void)0)
+
+  /* Record each instruction if tracing. traceRecord is the record of the
+   * instruction being executed. */
+# undef traceInsn
+# undef traceRead
+# undef traceWrite
+# define traceInsn()                                                             \
+  if (trace)                                                                    \
+    {                                                                           \
+      if (trace->n == trace->size)                                              \
+        {                                                                       \
+          trace->flush(trace);                                                  \
+          if (trace->stop)                                                      \
+            {                                                                   \
+              trace->stop= 0;                                                   \
+              stopProcessor(M6502_StopTrace, PC, memory[PC]);                   \
+              break;                                                            \
+            }                                                                   \
+        }                                                                       \
+      traceRecord= &trace->records[trace->n++];                                 \
+      traceRecord->cycles= start_cycles + tick_count;                           \
+      traceRecord->pc= PC;  traceRecord->opcode= memory[PC];                    \
+      traceRecord->a= A;  traceRecord->x= X;  traceRecord->y= Y;                \
+      traceRecord->p= P;  traceRecord->s= S;                                    \
+      traceRecord->address= 0;  traceRecord->access= 0;  traceRecord->data= 0;  \
+    }
+# define traceRead(ADDR)                                                        \
+  (trace ? (void)(traceRecord->address= (ADDR), traceRecord->access |= M6502_TraceRead) : (void)0)
+# define traceWrite(ADDR, BYTE)                                                 \
+  (trace ? (void)(traceRecord->address= (ADDR), traceRecord->access |= M6502_TraceWrite,        \
+                  traceRecord->data= (BYTE)) : (void)0)
+
+  /* Stop at breakpoints. resumeBreakpoint is the address of the breakpoint
+   * at which the previous run stopped until the first instruction is run. */
+# undef checkBreakpoint
+# define checkBreakpoint()                                                      \
+  if (breakpoints)                                                              \
+    {                                                                           \
+      if (breakpoints[PC] && (PC != resumeBreakpoint))                          \
+        {                                                                       \
+          stopProcessor(M6502_StopBreak, PC, memory[PC]);                       \
+          break;                                                                \
+        }                                                                       \
+      resumeBreakpoint= -1;                                                     \
+    }
+
+  /* Follow calls and returns if profiling. */
+# undef profileCall
+# undef profileReturn
+# define profileCall(ADDR, KIND)                                                 \
+  (profile ? M6502_profileEnter_(profile, start_cycles + tick_count, (ADDR), (KIND), S) : (void)0)
+# define profileReturn()                                                        \
+  (profile ? M6502_profileLeave_(profile, start_cycles + tick_count, S) : (void)0)
+
+  /* WAI with no interrupt pending. Skip to the end of the slice like an idle
+   * loop and then wait on mpu->wait_cond rather than sleeping. */
+# define waitForInterrupt()                                                     \
+  {                                                                             \
+    uint64_t limit= next_ticks;                                                 \
+    if ((ticks != 0) && ((ticks < limit) || !mpu->target_freq)) limit= ticks;  \
+    if (tick_count < limit)                                                     \
+      {                                                                         \
+        mpu->idle_cycles += limit - tick_count;                                 \
+        tick_count= limit;                                                      \
+      }                                                                         \
+    mpu->waiting= 1;                                                            \
+  }
 
   register byte  *memory= mpu->memory;
   register word   PC;
@@ -831,49 +1554,159 @@ uint64_t M6502_run(M6502 *mpu, uint64_t ticks)
   byte            A, X, Y, P, S;
   M6502_Callback *readCallback=  mpu->callbacks->read;
   M6502_Callback *writeCallback= mpu->callbacks->write;
+  byte           *pageAttrs= mpu->page_attrs;
+  byte           *coverage= mpu->coverage;
+  uint32_t       *counts= mpu->access_counts;
+  M6502_Profile  *profile= mpu->profile;
+  M6502_Trace    *trace= mpu->trace;
+  M6502_TraceRecord *traceRecord= NULL;
+  byte           *breakpoints= mpu->breakpoints;
+  int             resumeBreakpoint= -1;
   uint64_t        tick_count = 0;
-  struct timespec expected_loop_start;
+  uint64_t        start_cycles = mpu->cycles;
+  uint64_t        instructions = mpu->instructions;
+  uint64_t        end_instructions = mpu->step_insns ? instructions + mpu->step_insns : UINT64_MAX;
   struct timespec now, delta;
   int             exit_immediately = 0;
+  unsigned int    flags;
+  IdleState       idle = { 0 };
+
+  idle.dirty= 1;
+  if (mpu->stop_reason == M6502_StopBreak) resumeBreakpoint= mpu->stop_pc;
+  mpu->stop_reason= M6502_StopNone;
 
 # define internalise()  A= mpu->registers->a;  X= mpu->registers->x;  Y= mpu->registers->y;  P= mpu->registers->p;  S= mpu->registers->s;  PC= mpu->registers->pc
 # define externalise()  mpu->registers->a= A;  mpu->registers->x= X;  mpu->registers->y= Y;  mpu->registers->p= P;  mpu->registers->s= S;  mpu->registers->pc= PC
 
   internalise();
 
-  /* each iteration of this loop should be 1ms */
-  clock_gettime(CLOCK_MONOTONIC, &expected_loop_start);
+  /* each iteration of this loop should be 1ms. The schedule is carried over
+   * between calls in mpu->deadline so that running in short slices is
+   * throttled correctly. If we've fallen a long way behind, e.g. because the
+   * caller paused between slices, start a new schedule from now. */
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  {
+    struct timespec deadline = mpu->deadline;
+    if((0 == timespec_subtract(&delta, &now, &deadline))
+        && ((delta.tv_sec > 0) || (delta.tv_nsec > M6502_MaxLagNSec))) {
+      mpu->deadline = now;
+    }
+  }
+
   for(;should_continue();) {
     /* end tick count for this iteration */
-    uint64_t next_ticks = tick_count + mpu->target_freq;
+    uint64_t next_ticks = tick_count
+      + (mpu->target_freq ? mpu->target_freq : M6502_UnthrottledSlice);
     uint64_t start_tick = tick_count;
-    struct timespec expected_loop_end = expected_loop_start, expected_loop_duration;
+    struct timespec expected_loop_end = mpu->deadline, expected_loop_duration;
 
     /* begin(); */
-    while((tick_count < next_ticks) && (tick_count < ticks)) {
-      /* was exit requested? */
-      if(__sync_fetch_and_and(&mpu->request_flags, ~((unsigned int)requestExit)) & requestExit) {
-        exit_immediately = 1;
-        break;
+    while(!exit_immediately && (tick_count < next_ticks) && ((ticks == 0) || (tick_count < ticks))
+          && (instructions < end_instructions)) {
+      /* Is there anything to do other than run the next instruction? This is
+       * a single relaxed load so that the common case is cheap. IRQ lines
+       * are ignored while interrupts are disabled. */
+      flags = __atomic_load_n(&mpu->request_flags, __ATOMIC_RELAXED);
+      if(__builtin_expect(flags & (getI() ? requestMask : ~0u), 0)) {
+        /* was exit requested? */
+        if(flags & requestExit) {
+          __sync_fetch_and_and(&mpu->request_flags, ~((unsigned int)requestExit));
+          exit_immediately = 1;
+          break;
+        }
+
+        /* interrupts resume after any WAI */
+        if(mpu->waiting) { PC++; mpu->waiting = 0; }
+
+        if(flags & requestNMI) {
+          __sync_fetch_and_and(&mpu->request_flags, ~((unsigned int)requestNMI));
+          idleWrite();
+          externalise();
+          M6502_interrupt_(mpu, M6502_NMIVector);
+          tick_count += 7; /* NMI sequence takes 7 clock cycles */
+          mpu->nmis++;
+          internalise();
+          profileCall(PC, M6502_ProfileNMI);
+        } else if(flags & (requestIRQ | irqLineMask)) {
+          /* a one-shot IRQ request is consumed even if interrupts are disabled */
+          if(flags & requestIRQ) {
+            __sync_fetch_and_and(&mpu->request_flags, ~((unsigned int)requestIRQ));
+          }
+          if(!getI()) {
+            idleWrite();
+            externalise();
+            M6502_interrupt_(mpu, M6502_IRQVector);
+            tick_count += 7; /* IRQ sequence takes 7 clock cycles */
+            mpu->irqs++;
+            internalise();
+            profileCall(PC, M6502_ProfileIRQ);
+          }
+        }
       }
 
-      /* was IRQ requested? */
-      if(__sync_fetch_and_and(&mpu->request_flags, ~((unsigned int)requestIRQ)) & requestIRQ) {
-        /* yes, perform one */
-        externalise();
-        M6502_irq_real_(mpu);
-        tick_count += 7; /* IRQ sequence takes 7 clock cycles */
-        internalise();
+      /* run a cached block if there is one, unless stepping */
+      if(mpu->blocks && (end_instructions == UINT64_MAX)
+         && ((word)(PC - mpu->block_start) < mpu->block_size)) {
+        M6502_Block **entry = &mpu->blocks[(word)(PC - mpu->block_start)];
+        M6502_Block *block = *entry;
+        if(!block) { block = *entry = M6502_decodeBlock_(mpu, PC); }
+        if(block->n_insns) {
+          M6502_Insn *insn = block->insns, *last = insn + block->n_insns;
+          uint64_t block_limit = ((ticks != 0) && (ticks < next_ticks)) ? ticks : next_ticks;
+#         undef operandByte
+#         undef operandWord
+#         define operandByte()  ((byte)insn->operand)
+#         define operandWord()  (insn->operand)
+          /* The first instruction runs just as the interpreter would run it.
+           * Leave the block where the interpreter would stop or take an
+           * interrupt before any later one. */
+          for(; insn < last; ++insn) {
+            if((insn != block->insns)
+               && (exit_immediately || (tick_count >= block_limit)
+                   || __builtin_expect(__atomic_load_n(&mpu->request_flags, __ATOMIC_RELAXED)
+                                       & (getI() ? requestMask : ~0u), 0))) {
+              break;
+            }
+            checkBreakpoint();
+            traceInsn();
+            markExec(PC);
+            instructions++;
+            PC++;
+            switch (insn->opcode) {
+              do_insns(dispatch);
+            }
+          }
+#         undef operandByte
+#         undef operandWord
+#         define operandByte()  (memory[PC])
+#         define operandWord()  (memory[PC] + (memory[PC + 1] << 8))
+          continue;
+        }
       }
 
+      checkBreakpoint();
+      traceInsn();
+      markExec(PC);
+      instructions++;
       switch (memory[PC++]) {
         do_insns(dispatch);
       }
     }
     /* end(); */
 
-    /* exit immediately if we've reached the tick count */
-    if(tick_count >= ticks) { break; }
+    /* let observers know where we've got to */
+    externalise();
+    mpu->cycles = start_cycles + tick_count;
+    mpu->instructions = instructions;
+    if(profile) { M6502_profileMark_(profile, mpu->cycles); }
+    M6502_publish(mpu);
+
+    /* run flat out if not throttled */
+    if(!mpu->target_freq) {
+      /* if waiting forever for an interrupt, there's nothing to do until one arrives */
+      if(mpu->waiting && (ticks == 0) && should_continue()) { M6502_wait_(mpu, NULL); }
+      continue;
+    }
 
     /* how long should this loop have taken in reality? */
     expected_loop_duration.tv_sec = 0;
@@ -886,17 +1719,27 @@ uint64_t M6502_run(M6502 *mpu, uint64_t ticks)
     fixup_timespec(&expected_loop_end);
 
     /* record this new end point as the next loop start */
-    expected_loop_start = expected_loop_end;
+    mpu->deadline = expected_loop_end;
 
     /* record actual end time and compute delta */
-    clock_gettime(CLOCK_MONOTONIC, &now);
-    if(0 == timespec_subtract(&delta, &expected_loop_end, &now)) {
-      /* we were slow, we need to sleep */
-      nanosleep(&delta, NULL);
+    if(mpu->waiting) {
+      /* sleep until the end of the slice unless woken by an interrupt */
+      M6502_wait_(mpu, &expected_loop_end);
+    } else {
+      clock_gettime(CLOCK_MONOTONIC, &now);
+      if(0 == timespec_subtract(&delta, &expected_loop_end, &now)) {
+        /* we were fast, we need to sleep */
+        nanosleep(&delta, NULL);
+        mpu->sleep_nsec += M6502_nsecSince_(&now);
+      }
     }
   }
 
   externalise();
+  mpu->cycles = start_cycles + tick_count;
+  mpu->instructions = instructions;
+  if(profile) { M6502_profileMark_(profile, mpu->cycles); }
+  M6502_publish(mpu);
 
 # undef begin
 # undef internalise
@@ -905,20 +1748,89 @@ uint64_t M6502_run(M6502 *mpu, uint64_t ticks)
 # undef next
 # undef dispatch
 # undef end
-# undef abort
 # undef should_continue
+# undef stopProcessor
+# undef waitForInterrupt
+# undef writeFault
+# define writeFault(ADDR, BYTE)         0
+# undef markExec
+# undef markRead
+# undef markWrite
+# define markExec(ADDR)         ((void)0)
+# define markRead(ADDR)         ((void)0)
+# define markWrite(ADDR)        ((void)0)
+# undef countRead
+# undef countWrite
+# define countRead(ADDR)        ((void)0)
+# define countWrite(ADDR)       ((void)0)
+# undef profileCall
+# undef profileReturn
+# define profileCall(ADDR, KIND) ((void)0)
+# define profileReturn()        ((void)0)
+# undef traceInsn
+# undef traceRead
+# undef traceWrite
+# define traceInsn()            ((void)0)
+# define traceRead(ADDR)        ((void)0)
+# define traceWrite(ADDR, BYTE) ((void)0)
+# undef checkBreakpoint
+# define checkBreakpoint()      ((void)0)
+# undef chargeCycles
+# define chargeCycles()         ((void)0)
 
 # undef tick
 # undef tickIf
 # define tick(n)
 # define tickIf(p)
 
+# undef idleWrite
+# undef idleRead
+# undef idleBranch
+# define idleWrite()            ((void)0)
+# define idleRead(ADDR, BYTE)   (BYTE)
+# define idleBranch()
+
   (void)oops;
 
   return tick_count;
 }
 
 
+/* Run at most n_insns instructions, one at a time rather than in cached
+ * blocks, or until n_ticks have been run (0 => no limit). Returns the number
+ * of instructions run, which is less than n_insns if the processor stopped
+ * early. */
+uint64_t M6502_step(M6502 *mpu, uint64_t n_insns, uint64_t n_ticks)
+{
+  uint64_t start= mpu->instructions;
+
+  if (!n_insns) return 0;
+  mpu->step_insns= n_insns;
+  M6502_run(mpu, n_ticks);
+  mpu->step_insns= 0;
+
+  return mpu->instructions - start;
+}
+
+
+int M6502_trapReturn(M6502 *mpu, uint16_t address, uint8_t data)
+{
+  M6502_Registers *r= mpu->registers;
+  word addr;
+
+  (void)address;
+  (void)data;
+
+  /* behave as if the routine consisted of a single RTS */
+  addr=  mpu->memory[0x0100 + (byte)(r->s + 1)];
+  addr |= mpu->memory[0x0100 + (byte)(r->s + 2)] << 8;
+  r->s += 2;
+  mpu->cycle_charge += 6;
+
+  return (word)(addr + 1);
+}
+
+
 int M6502_disassemble(M6502 *mpu, word ip, char buffer[64])
 {
   char *s= buffer;
@@ -980,13 +1892,48 @@ M6502 *M6502_new(M6502_Registers *registers, M6502_Memory memory, M6502_Callback
   if (!memory   )  { memory    = (uint8_t         *)calloc(1, sizeof(M6502_Memory   ));  mpu->flags |= M6502_MemoryAllocated;    }
   if (!callbacks)  { callbacks = (M6502_Callbacks *)calloc(1, sizeof(M6502_Callbacks));  mpu->flags |= M6502_CallbacksAllocated; }
 
-  if (!registers || !memory || !callbacks) outOfMemory();
+  mpu->state= (M6502_State *)calloc(1, sizeof(M6502_State));
+  mpu->flags |= M6502_StateAllocated;
+
+  if (!registers || !memory || !callbacks || !mpu->state) outOfMemory();
 
   mpu->registers      = registers;
   mpu->memory         = memory;
   mpu->callbacks      = callbacks;
   mpu->target_freq    = 2000; /* kHz */
   mpu->request_flags  = 0;
+  mpu->cycles         = 0;
+  mpu->idle_detect    = 1;
+  mpu->idle_cycles    = 0;
+  mpu->stop_reason    = M6502_StopNone;
+  mpu->waiting        = 0;
+  mpu->cycle_charge   = 0;
+  mpu->trap_cycles    = 0;
+  mpu->instructions   = 0;
+  mpu->step_insns     = 0;
+  mpu->irqs           = 0;
+  mpu->nmis           = 0;
+  mpu->callbacks_run  = 0;
+  mpu->callback_nsec  = 0;
+  mpu->sleep_nsec     = 0;
+  memset(mpu->page_attrs, M6502_PageRAM, sizeof(mpu->page_attrs));
+  mpu->blocks         = NULL;
+  mpu->block_start    = 0;
+  mpu->block_size     = 0;
+  mpu->coverage       = NULL;
+  mpu->access_counts  = NULL;
+  mpu->profile        = NULL;
+  mpu->trace          = NULL;
+  mpu->breakpoints    = NULL;
+
+  {
+    pthread_condattr_t attr;
+    pthread_condattr_init(&attr);
+    pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+    pthread_cond_init(&mpu->wait_cond, &attr);
+    pthread_condattr_destroy(&attr);
+    pthread_mutex_init(&mpu->wait_mutex, NULL);
+  }
 
   return mpu;
 }
@@ -997,6 +1944,12 @@ void M6502_delete(M6502 *mpu)
   if (mpu->flags & M6502_CallbacksAllocated) free(mpu->callbacks);
   if (mpu->flags & M6502_MemoryAllocated   ) free(mpu->memory);
   if (mpu->flags & M6502_RegistersAllocated) free(mpu->registers);
+  if (mpu->flags & M6502_StateAllocated    ) free(mpu->state);
+
+  M6502_setBlockCache(mpu, 0, 0);
+
+  pthread_cond_destroy(&mpu->wait_cond);
+  pthread_mutex_destroy(&mpu->wait_mutex);
 
   free(mpu);
 }
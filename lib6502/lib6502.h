@@ -4,10 +4,18 @@
 
 #include <stdio.h>
 #include <stdint.h>
+#include <time.h>
+#include <pthread.h>
 
 typedef struct _M6502           M6502;
 typedef struct _M6502_Registers M6502_Registers;
 typedef struct _M6502_Callbacks M6502_Callbacks;
+typedef struct _M6502_State     M6502_State;
+typedef struct _M6502_Block     M6502_Block;  /* opaque, see M6502_setBlockCache() */
+typedef struct _M6502_Profile   M6502_Profile;
+typedef struct _M6502_ProfileNode M6502_ProfileNode;
+typedef struct _M6502_Trace     M6502_Trace;
+typedef struct _M6502_TraceRecord M6502_TraceRecord;
 
 typedef int   (*M6502_Callback)(M6502 *mpu, uint16_t address, uint8_t data);
 
@@ -37,6 +45,20 @@ struct _M6502_Callbacks
   M6502_CallbackTable call;
 };
 
+/* Snapshot of processor state published by M6502_run() at the end of each
+ * 1ms slice. Writers bump sequence before and after updating the other fields
+ * so that it is odd while an update is in progress (a seqlock). Use
+ * M6502_getState() to read a consistent copy from another thread. The state
+ * may live in memory shared with other processes, see M6502_setState(), which
+ * can use M6502_readState() to read it.
+ */
+struct _M6502_State
+{
+  unsigned int    sequence;   /* seqlock counter */
+  M6502_Registers registers;  /* registers at time of publication */
+  uint64_t        cycles;     /* total ticks run at time of publication */
+};
+
 struct _M6502
 {
   M6502_Registers *registers;
@@ -44,24 +66,201 @@ struct _M6502
   M6502_Callbacks *callbacks;
   unsigned int     flags;
 
-  uint32_t         target_freq;   /* in kHz, defaults to 2000 */
-  unsigned int     request_flags; /* set by M6502_irq, etc. */
+  uint32_t         target_freq;   /* in kHz, defaults to 2000, 0 => unthrottled */
+  unsigned int     request_flags; /* set by M6502_irq, M6502_setIRQLine, etc. */
+
+  uint64_t         cycles;        /* total ticks run over all calls to _run() */
+  M6502_State     *state;         /* latest published state */
+  struct timespec  deadline;      /* when the current 1ms slice should end */
+
+  int              idle_detect;   /* skip busy-wait loops, defaults to 1 */
+  uint64_t         idle_cycles;   /* total ticks skipped in busy-wait loops and WAI */
+
+  unsigned int     stop_reason;   /* why _run() stopped early, see below */
+  uint16_t         stop_pc;       /* address of instruction which stopped it */
+  uint16_t         stop_address;  /* address associated with stop_reason */
+  uint8_t          stop_data;     /* data associated with stop_reason */
+
+  int              waiting;       /* non-zero if stopped at a WAI instruction */
+
+  uint32_t         cycle_charge;  /* ticks to charge for the current call callback */
+  uint64_t         trap_cycles;   /* total ticks charged by call callbacks */
+
+  uint64_t         instructions;  /* total instructions run */
+  uint64_t         step_insns;    /* if non-zero, _run() stops after this many, see M6502_step() */
+  uint64_t         irqs;          /* total IRQs taken, excluding BRK */
+  uint64_t         nmis;          /* total NMIs taken */
+  uint64_t         callbacks_run; /* total read, write and call callbacks called */
+  uint64_t         callback_nsec; /* total wall time spent in callbacks */
+  uint64_t         sleep_nsec;    /* total wall time _run() has spent sleeping or waiting */
+
+  uint8_t          page_attrs[0x100]; /* M6502_Page... for each 256 byte page */
+
+  M6502_Block    **blocks;        /* decoded blocks indexed by address - block_start */
+  uint16_t         block_start;   /* first address of the block cache */
+  uint32_t         block_size;    /* bytes covered by the block cache, 0 => none */
+
+  uint8_t         *coverage;      /* M6502_CoverageSize bytes of flags, NULL => off */
+  uint32_t        *access_counts; /* M6502_CountSize counters, NULL => off */
+  M6502_Profile   *profile;       /* calling-context profile, NULL => off */
+  M6502_Trace     *trace;         /* instruction trace, NULL => off */
+  uint8_t         *breakpoints;   /* flag per address, see M6502_setBreakpoints(), NULL => off */
+
+  pthread_mutex_t  wait_mutex;    /* protects waiting on wait_cond */
+  pthread_cond_t   wait_cond;     /* signalled by M6502_irq and M6502_exit */
+};
+
+/* Values for stop_reason. Running the processor again after a stop will stop
+ * again at the same instruction until the program counter is changed. */
+enum {
+  M6502_StopNone    = 0,  /* ran normally */
+  M6502_StopIllegal = 1,  /* undefined opcode stop_data at stop_address */
+  M6502_StopSTP     = 2,  /* STP instruction executed */
+  M6502_StopFault   = 3,  /* wrote stop_data to stop_address in a M6502_PageROMFault page */
+  M6502_StopTrace   = 4,  /* a trace flush set stop; the next run continues from stop_pc */
+  M6502_StopBreak   = 5   /* reached a breakpoint at stop_pc; the next run continues from it */
+};
+
+/* Values for page_attrs. Writes to pages with a write callback installed at
+ * the address written always go to the callback. */
+enum {
+  M6502_PageRAM       = 0,  /* readable and writeable (the default) */
+  M6502_PageIO        = 1,  /* as RAM but never cached, see M6502_setBlockCache() */
+  M6502_PageROMIgnore = 2,  /* writes are ignored */
+  M6502_PageROMFault  = 3   /* writes stop the processor with M6502_StopFault */
+};
+
+/* Layout of the coverage buffer passed to M6502_setCoverage(). Each plane has
+ * a byte per address which is set to 1 when an instruction starting at the
+ * address is executed, or when an instruction reads or writes the address as
+ * data. Immediate operands count as reads but pointer, stack and other operand
+ * accesses are not counted. */
+enum {
+  M6502_CoverageExec  = 0x00000,
+  M6502_CoverageRead  = 0x10000,
+  M6502_CoverageWrite = 0x20000,
+  M6502_CoverageSize  = 0x30000
+};
+
+/* Layout of the counters passed to M6502_setAccessCounts(). Each plane has a
+ * counter per address which is incremented, wrapping around, each time an
+ * instruction reads or writes the address as data. Accesses are counted as
+ * for coverage. */
+enum {
+  M6502_CountReads  = 0x00000,
+  M6502_CountWrites = 0x10000,
+  M6502_CountSize   = 0x20000
+};
+
+/* A calling-context profile, see M6502_setProfile(). A shadow call stack
+ * follows JSR, BRK and interrupts into routines and RTS and RTI out of them,
+ * building a tree with a node for each distinct chain of calls. Ticks are
+ * attributed to the node of the innermost routine running. Frames are matched
+ * by stack pointer so that a return unwinds any frames abandoned by stack
+ * manipulation and a call discards frames at or below the new one. An RTS
+ * which does not match a frame, e.g. one used as a computed jump, is not a
+ * return. Calls diverted by a call callback returning an address are not
+ * followed. */
+enum {
+  M6502_ProfileCall = 0,  /* JSR */
+  M6502_ProfileIRQ  = 1,  /* IRQ */
+  M6502_ProfileNMI  = 2,  /* NMI */
+  M6502_ProfileBRK  = 3   /* BRK */
+};
+
+enum {
+  M6502_ProfileMaxDepth = 257,      /* the root and a frame per stack pointer */
+  M6502_ProfileMaxNodes = 1 << 20   /* callees beyond this are merged into callers */
+};
+
+struct _M6502_ProfileNode
+{
+  uint16_t  address;        /* entry point of the routine */
+  uint8_t   kind;           /* M6502_Profile... by which it was entered */
+  uint32_t  parent;         /* index of the calling context */
+  uint32_t  first_child;    /* index of the first callee, 0 => none */
+  uint32_t  next_sibling;   /* index of the next callee of parent, 0 => none */
+  uint64_t  calls;          /* times entered */
+  uint64_t  cycles;         /* ticks spent in this context excluding callees */
+};
+
+struct _M6502_Profile
+{
+  M6502_ProfileNode *nodes;       /* node 0 is the root, i.e. outside any call */
+  uint32_t           n_nodes;
+  uint32_t           max_nodes;   /* allocated */
+  uint32_t           depth;       /* frames on the shadow stack above the root */
+  uint32_t           stack_node[M6502_ProfileMaxDepth]; /* node of each frame */
+  uint8_t            stack_sp[M6502_ProfileMaxDepth];   /* S after entering each frame */
+  uint64_t           mark;        /* ticks have been attributed up to this cycle count */
+};
+
+/* An instruction trace, see M6502_setTrace(). A record is appended to
+ * records for each instruction executed. When records is full, flush is
+ * called from M6502_run() and must empty it by setting n to zero, e.g. after
+ * copying the records elsewhere. If flush sets stop, the processor stops
+ * with M6502_StopTrace before the instruction which would have been recorded
+ * next. Records left over when tracing stops are not flushed. */
+struct _M6502_TraceRecord
+{
+  uint64_t  cycles;         /* cycle count before the instruction */
+  uint16_t  pc;             /* address of the instruction */
+  uint16_t  address;        /* data address read and/or written */
+  uint8_t   opcode;
+  uint8_t   a, x, y, p, s;  /* registers before the instruction */
+  uint8_t   access;         /* M6502_TraceRead | M6502_TraceWrite, 0 => none */
+  uint8_t   data;           /* value written, 0 if not written */
+};
+
+enum {
+  M6502_TraceRead  = 1 << 0,
+  M6502_TraceWrite = 1 << 1
+};
+
+struct _M6502_Trace
+{
+  M6502_TraceRecord *records;
+  uint32_t           size;    /* capacity of records */
+  uint32_t           n;       /* records used */
+  void             (*flush)(M6502_Trace *trace);
+  void              *context; /* for use by flush */
+  int                stop;    /* set non-zero by flush to stop the processor */
 };
 
 enum {
   M6502_RegistersAllocated = 1 << 0,
   M6502_MemoryAllocated    = 1 << 1,
-  M6502_CallbacksAllocated = 1 << 2
+  M6502_CallbacksAllocated = 1 << 2,
+  M6502_StateAllocated     = 1 << 3
 };
 
 extern M6502 *M6502_new(M6502_Registers *registers, M6502_Memory memory, M6502_Callbacks *callbacks);
 extern void     M6502_reset(M6502 *mpu);
 extern void     M6502_nmi(M6502 *mpu);
 extern void     M6502_irq(M6502 *mpu);
+extern void     M6502_setIRQLine(M6502 *mpu, unsigned int line, int asserted); /* line < 24 */
+extern unsigned int M6502_getIRQLines(M6502 *mpu); /* bitmask of asserted lines */
 extern void     M6502_exit(M6502 *mpu); /* return ASAP from _run() */
 extern uint64_t M6502_run(M6502 *mpu, uint64_t n_ticks); // NB. n_ticks == 0 => forever
+extern uint64_t M6502_step(M6502 *mpu, uint64_t n_insns, uint64_t n_ticks); /* instructions run */
+extern int      M6502_trapReturn(M6502 *mpu, uint16_t address, uint8_t data); /* call callback */
 extern int      M6502_disassemble(M6502 *mpu, uint16_t addr, char buffer[64]);
 extern void     M6502_dump(M6502 *mpu, char buffer[64]);
+extern void     M6502_publish(M6502 *mpu); /* update mpu->state from registers */
+extern void     M6502_setRegisters(M6502 *mpu, const M6502_Registers *registers); /* and publish */
+extern void     M6502_getState(M6502 *mpu, M6502_State *state); /* thread-safe */
+extern int      M6502_readState(const M6502_State *shared, M6502_State *state); /* 0 => gave up */
+extern void     M6502_setState(M6502 *mpu, M6502_State *state); /* publish to external memory */
+extern void     M6502_setPageAttrs(M6502 *mpu, uint16_t start, uint32_t size, uint8_t attr);
+extern void     M6502_setBlockCache(M6502 *mpu, uint16_t start, uint32_t size); /* size == 0 => off */
+extern void     M6502_flushBlockCache(M6502 *mpu); /* after memory in the cache changes */
+extern void     M6502_setCoverage(M6502 *mpu, uint8_t *coverage); /* NULL => off */
+extern void     M6502_setAccessCounts(M6502 *mpu, uint32_t *counts); /* NULL => off */
+extern M6502_Profile *M6502_newProfile(void);
+extern void     M6502_deleteProfile(M6502_Profile *profile);
+extern void     M6502_setProfile(M6502 *mpu, M6502_Profile *profile); /* NULL => off */
+extern void     M6502_setTrace(M6502 *mpu, M6502_Trace *trace); /* NULL => off */
+extern void     M6502_setBreakpoints(M6502 *mpu, uint8_t *breakpoints); /* NULL => off */
 extern void     M6502_delete(M6502 *mpu);
 
 #define M6502_getVector(MPU, VEC)                       \
@@ -14,12 +14,16 @@ setup(
         'docopt',
         'future',
         'intervaltree',
+        'numpy',
         'pyside',
         'pyte',
     ],
     entry_points={
         'console_scripts': [
             'burisim = burisim:main',
+            'burisim-coverage = burisim.coverage:main',
+            'burisim-profile = burisim.profile:main',
+            'burisim-trace = burisim.trace:main',
         ],
     },
 )
@@ -0,0 +1,226 @@
+"""
+Differential test of the block cache against the interpreter.
+
+Random ROM programs are run on two processors, one with the block cache
+covering the ROM and one without, in random sized run() budgets. The programs
+mix straight-line code, forward branches and I/O. Writing to an I/O register
+through a pointer asserts an IRQ line in the middle of a block so that the
+timing of interrupts is exercised. The processors must agree after every
+run() and at the end.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import random
+
+import pytest
+
+from burisim.lib6502 import M6502
+
+ROM_START = 0xC000
+ROM_SIZE = 0x4000
+PROGRAM_START = 0xC000
+IRQ_HANDLER = 0xF000
+
+# I/O registers: writing a value with bit 7 set to IRQ_SET asserts IRQ line
+# 0, writing to IRQ_ACK releases it and reading COUNTER returns the number of
+# times it has been read.
+IO_PAGE = 0x8000
+IRQ_SET = 0x8000
+IRQ_ACK = 0x8001
+COUNTER = 0x8002
+
+# Zero page pointers to IRQ_SET and COUNTER which random code leaves alone
+IRQ_SET_PTR = 0xF0
+COUNTER_PTR = 0xF2
+
+# Opcodes by addressing mode
+_OPCODES = {
+    'implied': [
+        0xE8, 0xC8, 0xCA, 0x88, 0x1A, 0x3A, 0x0A, 0x4A, 0x2A, 0x6A, 0xAA,
+        0x8A, 0xA8, 0x98, 0x48, 0x68, 0xDA, 0xFA, 0x18, 0x38, 0xD8, 0xF8,
+        0xB8, 0x58, 0x78, 0xEA,
+    ],
+    'immediate': [
+        0xA9, 0xA2, 0xA0, 0x69, 0xE9, 0x29, 0x09, 0x49, 0xC9, 0xE0, 0xC0,
+        0x89,
+    ],
+    'zp': [
+        0xA5, 0xA6, 0xA4, 0x85, 0x86, 0x84, 0x64, 0x65, 0xE5, 0x25, 0x05,
+        0x45, 0xC5, 0xE6, 0xC6, 0x06, 0x24, 0x04, 0x14,
+    ],
+    'zpx': [0xB5, 0xB4, 0x95],
+    'zpy': [0xB6],
+    'abs': [0xAD, 0xAE, 0xAC, 0x8D, 0x9C, 0x6D, 0xED],
+    'absx': [0xBD, 0xBC, 0x9D],
+    'absy': [0xB9, 0xBE, 0x99],
+    'indirect_zp': [0xA1, 0xB1, 0xB2, 0x81, 0x91, 0x92, 0x71],
+    'branch': [0xD0, 0xF0, 0x90, 0xB0, 0x10, 0x30],
+}
+_MODES = sorted(_OPCODES)
+
+def _random_insn(rng):
+    mode = rng.choice(_MODES)
+    opcode = rng.choice(_OPCODES[mode])
+    if mode == 'implied':
+        return [opcode]
+    elif mode == 'immediate':
+        return [opcode, rng.randrange(0x100)]
+    elif mode in ('zp', 'zpx', 'zpy', 'indirect_zp'):
+        return [opcode, rng.randrange(IRQ_SET_PTR)]
+    elif mode == 'branch':
+        # The offset is filled in by _random_program()
+        return [opcode, None]
+    return [opcode] + _word(rng.randrange(0x0200, 0x0700))
+
+def _word(v):
+    return [v & 0xFF, v >> 8]
+
+def _random_program(rng, n_insns):
+    """Return the bytes of a program which initialises the machine and then
+    loops forever over n_insns random instructions.
+
+    """
+    preamble = (
+        [0xA2, 0xFF, 0x9A] +                                    # LDX #$FF; TXS
+        [0xA9, IRQ_SET & 0xFF, 0x85, IRQ_SET_PTR] +             # pointers
+        [0xA9, IRQ_SET >> 8, 0x85, IRQ_SET_PTR + 1] +
+        [0xA9, COUNTER & 0xFF, 0x85, COUNTER_PTR] +
+        [0xA9, COUNTER >> 8, 0x85, COUNTER_PTR + 1] +
+        [0x58]                                                  # CLI
+    )
+    loop = PROGRAM_START + len(preamble)
+
+    # Mostly straight-line code with the occasional use of the pointers to
+    # I/O so that blocks are long but do reach the devices.
+    insns = []
+    for _ in range(n_insns):
+        r = rng.random()
+        if r < 0.05:
+            insns.append([0x92, IRQ_SET_PTR])                   # STA (IRQ_SET_PTR)
+        elif r < 0.08:
+            insns.append([0xB2, COUNTER_PTR])                   # LDA (COUNTER_PTR)
+        else:
+            insns.append(_random_insn(rng))
+
+    # Branches skip forward a whole number of instructions
+    for idx, insn in enumerate(insns):
+        if insn[-1] is None:
+            skipped = insns[idx+1:idx+1+rng.randrange(8)]
+            insn[-1] = sum(len(i) for i in skipped)
+
+    body = [b for insn in insns for b in insn]
+    return preamble + body + [0x4C] + _word(loop)               # JMP loop
+
+class _Devices(object):
+    """The I/O registers of a processor, recording each access.
+
+    """
+    def __init__(self, mpu):
+        self.mpu = mpu
+        self.log = []
+        self.counter = 0
+        mpu.register_write_handler(IRQ_SET, 2, self.write)
+        mpu.register_read_handler(COUNTER, 1, self.read)
+
+    def write(self, offset, value):
+        self.log.append(('write', offset, value))
+        if offset == 0 and value & 0x80:
+            self.mpu.set_irq_line(0, True)
+        elif offset == 1:
+            self.mpu.set_irq_line(0, False)
+
+    def read(self, _):
+        self.counter += 1
+        self.log.append(('read', self.counter))
+        return self.counter & 0xFF
+
+def _machine(program, ram, block_cache):
+    mpu = M6502()
+    mpu.target_freq = 0
+    mpu.write_memory(0, ram)
+    rom = bytearray(ROM_SIZE)
+    rom[PROGRAM_START-ROM_START:PROGRAM_START-ROM_START+len(program)] = program
+    handler = [0x48, 0xA9, 0x00, 0x8D] + _word(IRQ_ACK) + [0x68, 0x40] # PHA; LDA #0; STA IRQ_ACK; PLA; RTI
+    rom[IRQ_HANDLER-ROM_START:IRQ_HANDLER-ROM_START+len(handler)] = handler
+    mpu.write_memory(ROM_START, bytes(rom))
+    mpu.set_page_attributes(ROM_START, ROM_SIZE, M6502.PAGE_ROM_IGNORE)
+    mpu.set_page_attributes(IO_PAGE, 0x100, M6502.PAGE_IO)
+    mpu.rst_vector = PROGRAM_START
+    mpu.irq_vector = IRQ_HANDLER
+    mpu.nmi_vector = IRQ_HANDLER
+    if block_cache:
+        mpu.set_block_cache(ROM_START, ROM_SIZE)
+    devices = _Devices(mpu)
+    mpu.reset()
+    return mpu, devices
+
+def _registers(mpu):
+    r = mpu.registers
+    return (r.a, r.x, r.y, r.p, r.s, r.pc)
+
+@pytest.mark.parametrize('seed', range(200))
+def test_block_cache_matches_interpreter(seed):
+    rng = random.Random(seed)
+    program = _random_program(rng, rng.randrange(10, 200))
+    ram = bytes(bytearray(rng.randrange(0x100) for _ in range(M6502.MEMORY_SIZE)))
+    interpreted, interpreted_io = _machine(program, ram, False)
+    cached, cached_io = _machine(program, ram, True)
+
+    while interpreted.cycles < 50000:
+        # Mostly budgets shorter than a block, which must not be overrun
+        budget = rng.randrange(1, 8) if rng.random() < 0.7 else rng.randrange(1, 2000)
+        ticks = interpreted.run(budget)
+        assert cached.run(budget) == ticks
+        assert cached.cycles == interpreted.cycles
+        assert _registers(cached) == _registers(interpreted)
+        assert cached.stop_reason == interpreted.stop_reason
+        assert cached.irq_lines == interpreted.irq_lines
+
+    assert cached.instructions == interpreted.instructions
+    assert cached.irqs == interpreted.irqs
+    assert cached_io.log == interpreted_io.log
+    assert cached.read_memory(0, M6502.MEMORY_SIZE) == \
+        interpreted.read_memory(0, M6502.MEMORY_SIZE)
+
+def test_block_cache_honours_tick_budget():
+    # A long run of two cycle instructions forms one block
+    program = [0xEA] * 64 + [0x4C] + _word(PROGRAM_START)
+    mpu, _ = _machine(program, bytes(M6502.MEMORY_SIZE), True)
+    assert mpu.run(3) == 4
+    assert mpu.instructions == 2
+    assert mpu.registers.pc == PROGRAM_START + 2
+
+def test_block_cache_takes_irq_mid_block():
+    # STA (IRQ_SET_PTR) asserts the IRQ in the middle of a block of NOPs. The
+    # interrupt must be taken before the next NOP and not at the end of the
+    # block.
+    program = (
+        [0xA9, IRQ_SET & 0xFF, 0x85, IRQ_SET_PTR, 0xA9, IRQ_SET >> 8, 0x85, IRQ_SET_PTR + 1] +
+        [0xA2, 0xFF, 0x9A, 0x58, 0xA9, 0x80] +                  # LDX #$FF; TXS; CLI; LDA #$80
+        [0xEA] * 4 + [0x92, IRQ_SET_PTR] + [0xEA] * 20 +
+        [0xDB]                                                  # STP
+    )
+    irq_at = PROGRAM_START + program.index(0x92) + 2
+    for block_cache in (False, True):
+        mpu, _ = _machine(program, bytes(M6502.MEMORY_SIZE), block_cache)
+        mpu.run(500)
+        assert mpu.irqs == 1
+        pushed = mpu.read_memory(0x1FE, 2)
+        assert bytearray(pushed)[0] | (bytearray(pushed)[1] << 8) == irq_at
+
+def test_step_runs_single_instructions():
+    program = [0xEA] * 64 + [0x4C] + _word(PROGRAM_START)
+    mpu, _ = _machine(program, bytes(M6502.MEMORY_SIZE), True)
+    assert mpu.step(1) == 1
+    assert mpu.registers.pc == PROGRAM_START + 1
+    assert mpu.step(5) == 5
+    assert mpu.cycles == 12
+    assert mpu.step(100, 10) == 5
@@ -0,0 +1,46 @@
+"""
+Booting until a condition is met.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from burisim.bootcache import BootCondition, boot
+from burisim.sim import BuriSim
+
+MAIN_LOOP = 0xE010
+
+def _sim():
+    # LDY #0; NOPs; loop: INY; JMP loop
+    rom = bytearray(BuriSim.ROM_SIZE)
+    rom[:0x10] = [0xA0, 0x00] + [0xEA] * 14
+    rom[0x10:0x14] = [0xC8, 0x4C, MAIN_LOOP & 0xFF, MAIN_LOOP >> 8]
+    rom[-4:-2] = [0x00, 0xE0]                   # reset vector
+    sim = BuriSim()
+    sim.load_rom_bytes(bytes(rom))
+    sim.reset()
+    return sim
+
+def test_boot_stops_at_pc():
+    sim = _sim()
+    assert boot(sim, BootCondition(MAIN_LOOP, None))
+    assert sim.mpu.registers.pc == MAIN_LOOP
+    assert sim.mpu.registers.y == 0
+    assert sim.breakpoints == []
+
+def test_boot_keeps_existing_breakpoint():
+    sim = _sim()
+    sim.add_breakpoint(MAIN_LOOP)
+    assert boot(sim, BootCondition(MAIN_LOOP, None))
+    assert sim.breakpoints == [MAIN_LOOP]
+
+def test_boot_gives_up_after_max_cycles():
+    sim = _sim()
+    assert not boot(sim, BootCondition(0xE100, None), max_cycles=1000)
+    assert sim.breakpoints == []
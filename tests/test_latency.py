@@ -0,0 +1,87 @@
+"""
+Worst-case latency of BuriSim control operations.
+
+The machine runs unthrottled with a Python read handler called every few
+instructions, so that slices are sized from the measured emulation speed and
+not from the clock frequency. Each control operation must be applied within
+about one slice, i.e. BuriSim.latency, plus a margin for thread scheduling.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import time
+from timeit import default_timer
+
+import pytest
+
+from burisim.sim import BuriSim
+
+# Allowance for waking the waiting thread on a loaded machine
+MARGIN = 0.025
+
+# Number of times each operation is timed
+REPEATS = 20
+
+# loop: LDA ACIA status; STA $0200; INC $0201; JMP loop
+_PROGRAM = [
+    0xAD, 0xFD, 0xDF, 0x8D, 0x00, 0x02, 0xEE, 0x01, 0x02, 0x4C, 0x00, 0xE0,
+]
+
+@pytest.fixture
+def sim():
+    rom = bytearray(BuriSim.ROM_SIZE)
+    rom[:len(_PROGRAM)] = _PROGRAM
+    rom[-4:-2] = [0x00, 0xE0]                   # reset vector
+    sim = BuriSim()
+    sim.load_rom_bytes(bytes(rom))
+    sim.throttled = False
+    sim.idle_detection = False
+    sim.reset()
+    sim.start()
+    # Let the emulation speed, and so the slice size, settle
+    time.sleep(0.2)
+    yield sim
+    sim.stop()
+
+def _worst_case(op):
+    worst = 0
+    for _ in range(REPEATS):
+        time.sleep(0.01)
+        start = default_timer()
+        op()
+        worst = max(worst, default_timer() - start)
+    return worst
+
+def test_control_operations_complete_within_latency(sim):
+    operations = [
+        ('reset', sim.reset),
+        ('poke', lambda: sim.poke(0x0300, 0x55)),
+        ('snapshot', sim.snapshot),
+    ]
+    for name, op in operations:
+        worst = _worst_case(op)
+        assert worst < sim.latency + MARGIN, '{0} took {1:.1f}ms'.format(name, 1e3 * worst)
+
+    # Only the pause is timed. A paused machine applies resume() at once.
+    worst = 0
+    for _ in range(REPEATS):
+        time.sleep(0.01)
+        start = default_timer()
+        sim.pause()
+        worst = max(worst, default_timer() - start)
+        sim.resume()
+    assert worst < sim.latency + MARGIN, 'pause took {0:.1f}ms'.format(1e3 * worst)
+
+    # The machine is still running flat out
+    assert sim.is_running() and not sim.is_paused()
+    start = default_timer()
+    sim.stop()
+    worst = default_timer() - start
+    assert worst < sim.latency + MARGIN, 'stop took {0:.1f}ms'.format(1e3 * worst)
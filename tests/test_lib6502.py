@@ -0,0 +1,88 @@
+"""
+How the processor core stops and waits: WAI, STP and illegal opcodes.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from burisim.lib6502 import M6502
+
+START = 0x0200
+IRQ_HANDLER = 0x0300
+
+def _mpu(program, at=START):
+    mpu = M6502()
+    mpu.target_freq = 0
+    mpu.write_memory(at, bytes(bytearray(program)))
+    mpu.write_memory(IRQ_HANDLER, bytes(bytearray([0xC8, 0x40])))  # INY; RTI
+    mpu.rst_vector = START
+    mpu.irq_vector = IRQ_HANDLER
+    mpu.nmi_vector = IRQ_HANDLER
+    mpu.reset()
+    return mpu
+
+def test_wai_with_interrupts_disabled_resumes_on_irq():
+    mpu = _mpu([0x78, 0xCB, 0xE8, 0xDB])        # SEI; WAI; INX; STP
+    mpu.run(1000)
+    assert mpu.stop_reason == M6502.STOP_NONE
+    assert mpu.registers.pc == START + 1
+    assert mpu.registers.x == 0
+
+    mpu.set_irq_line(0, True)
+    mpu.run(1000)
+    assert mpu.registers.x == 1
+    assert mpu.registers.y == 0                 # the handler did not run
+    assert mpu.irqs == 0
+    assert mpu.stop_reason == M6502.STOP_STP
+    assert mpu.stop_pc == START + 3
+
+def test_stp_stops_until_reset():
+    mpu = _mpu([0xE8, 0xDB, 0xE8])              # INX; STP; INX
+    mpu.run(1000)
+    assert mpu.stop_reason == M6502.STOP_STP
+    assert mpu.stop_pc == START + 1
+
+    for _ in range(3):
+        mpu.run(1000)
+        assert mpu.stop_reason == M6502.STOP_STP
+        assert mpu.stop_pc == START + 1
+        assert mpu.registers.pc == START + 1
+        assert mpu.registers.x == 1
+
+    mpu.reset()
+    mpu.run(1000)
+    assert mpu.stop_reason == M6502.STOP_STP
+    assert mpu.registers.x == 2
+
+def test_illegal_opcode_stops():
+    mpu = _mpu([0xE8, 0xE8, 0x02, 0xE8])        # INX; INX; illegal; INX
+    mpu.run(1000)
+    assert mpu.stop_reason == M6502.STOP_ILLEGAL
+    assert mpu.stop_pc == START + 2
+    assert mpu.stop_data == 0x02
+    assert mpu.registers.pc == START + 2
+    assert mpu.registers.x == 2
+
+def test_set_registers_forgets_wai():
+    # An interrupt ends a WAI by moving past it. Once the registers have been
+    # set the WAI is forgotten and the interrupt returns to the new PC.
+    mpu = _mpu([0x58, 0xCB])                    # CLI; WAI
+    mpu.write_memory(0x0210, bytes(bytearray([0xE8, 0xDB])))   # INX; STP
+    mpu.run(1000)
+    assert mpu.registers.pc == START + 1
+
+    r = mpu.registers
+    mpu.set_registers(r.a, r.x, r.y, r.p, r.s, 0x0210)
+    mpu.irq()
+    mpu.run(1000)
+    assert mpu.irqs == 1
+    assert mpu.registers.y == 1
+    assert mpu.registers.x == 1
+    assert mpu.stop_reason == M6502.STOP_STP
+    assert mpu.stop_pc == 0x0211
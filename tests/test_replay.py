@@ -0,0 +1,121 @@
+"""
+Deterministic record and replay of a session.
+
+A session is recorded by stepping a machine on the test's thread and applying
+events between steps of different lengths, just as the simulation thread
+applies them between slices. Replaying the log on a fresh machine must end in
+the same state.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from io import StringIO
+import json
+
+import pytest
+
+from burisim.replay import Recorder, ReplayError, replay
+from burisim.sim import BuriSim
+
+# Echo ACIA1 input, counting bytes echoed, IRQs and NMIs at $0300-$0302.
+_PROGRAM = {
+    0xE000: [
+        0xA2, 0xFF, 0x9A, 0x58,                 # LDX #$FF; TXS; CLI
+        0xAD, 0xFD, 0xDF,                       # loop: LDA ACIA status
+        0x29, 0x08,                             # AND #RDRF
+        0xF0, 0xF9,                             # BEQ loop
+        0xAD, 0xFC, 0xDF,                       # LDA ACIA data
+        0x8D, 0xFC, 0xDF,                       # STA ACIA data
+        0xEE, 0x00, 0x03,                       # INC $0300
+        0x4C, 0x04, 0xE0,                       # JMP loop
+    ],
+    0xE020: [0xEE, 0x01, 0x03, 0x40],           # IRQ: INC $0301; RTI
+    0xE030: [0xEE, 0x02, 0x03, 0x40],           # NMI: INC $0302; RTI
+    0xFFFA: [0x30, 0xE0, 0x00, 0xE0, 0x20, 0xE0],   # vectors
+}
+
+# (ticks to run, event, value) in the order applied
+_SESSION = [
+    (1000, 'rx', ord('h')),
+    (37, 'rx', ord('i')),
+    (5000, 'irq', None),
+    (1, 'nmi', None),
+    (20000, 'rx', ord('!')),
+    (3000, 'reset', None),
+    (777, 'rx', ord('x')),
+    (12345, 'irq', None),
+    (2, 'nmi', None),
+    (4000, None, None),
+]
+
+def _sim():
+    rom = bytearray(BuriSim.ROM_SIZE)
+    for address, code in _PROGRAM.items():
+        offset = address - BuriSim.ROM_RANGE[0]
+        rom[offset:offset+len(code)] = code
+    sim = BuriSim()
+    sim.load_rom_bytes(bytes(rom))
+    return sim
+
+@pytest.fixture(scope='module')
+def log():
+    sim = _sim()
+    output = []
+    sim.acia1.register_listener(output.append)
+    fobj = StringIO()
+    sim.start_recording(Recorder(fobj))
+    sim.reset()
+    for ticks, event, value in _SESSION:
+        sim.step(ticks)
+        if event == 'rx':
+            sim.receive_serial(value)
+        elif event == 'reset':
+            sim.reset()
+        elif event == 'irq':
+            sim.inject_irq()
+        elif event == 'nmi':
+            sim.inject_nmi()
+    recorder = sim.stop_recording()
+
+    # The session did what it was meant to
+    assert recorder.events == len([e for _, e, _ in _SESSION if e is not None]) + 1
+    assert bytes(bytearray(output)) == b'hi!x'
+    assert bytearray(sim.mpu.read_memory(0x0300, 3)) == bytearray([4, 2, 2])
+    return fobj.getvalue()
+
+def _records(log):
+    return [json.loads(line) for line in log.splitlines()]
+
+def _log(records):
+    return ''.join(json.dumps(r, sort_keys=True) + '\n' for r in records)
+
+def test_replay_matches(log):
+    result = replay(StringIO(log), _sim())
+    assert result.mismatches == []
+    assert result.events == len(_records(log)) - 2
+    assert result.cycles == _records(log)[-1]['cycle']
+
+def test_replay_with_block_cache_matches(log):
+    assert not _records(log)[0]['block_cache']
+    sim = _sim()
+    sim.block_cache = True
+    assert replay(StringIO(log), sim).mismatches == []
+
+def test_replay_of_edited_event_cycle_fails(log):
+    records = _records(log)
+    # Receiving the first byte a cycle late shifts the echo loop so that the
+    # machine is mid-instruction at the cycle of the next event.
+    records[2]['cycle'] += 1
+    with pytest.raises(ReplayError):
+        replay(StringIO(_log(records)), _sim())
+
+def test_replay_of_truncated_log_fails(log):
+    with pytest.raises(ReplayError):
+        replay(StringIO(_log(_records(log)[:-1])), _sim())
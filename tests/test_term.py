@@ -0,0 +1,94 @@
+"""
+The headless terminal fed with serial output.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+import threading
+import time
+
+from burisim.term import TerminalSink
+
+def _receive(sink, data):
+    for b in bytearray(data):
+        sink.receive_byte(b)
+
+def _send_later(sink, data, delay):
+    thread = threading.Thread(target=lambda: (time.sleep(delay), _receive(sink, data)))
+    thread.start()
+    return thread
+
+def test_text():
+    sink = TerminalSink(columns=20, lines=3)
+    _receive(sink, b'hello\r\nworld')
+    assert sink.display == ['hello'.ljust(20), 'world'.ljust(20), ' ' * 20]
+    assert sink.text == '\n'.join(sink.display)
+    assert sink.cursor == (5, 1)
+    assert sink.received == 12
+
+def test_dirty_lines_are_cleared_by_each_query():
+    sink = TerminalSink(columns=20, lines=3)
+    assert sink.dirty_lines() == {}
+    _receive(sink, b'one\r\ntwo')
+    dirty = sink.dirty_lines()
+    assert sorted(dirty) == [0, 1]
+    assert dirty[1].rstrip() == 'two'
+    assert sink.dirty_lines() == {}
+    _receive(sink, b'!')
+    assert dict((k, v.rstrip()) for k, v in sink.dirty_lines().items()) == {1: 'two!'}
+    assert sink.dirty_lines() == {}
+
+def test_wait_for_matches_across_lines():
+    sink = TerminalSink()
+    thread = _send_later(sink, b'READY\r\n> ', 0.05)
+    match = sink.wait_for(r'READY\s*\n> ', timeout=5)
+    thread.join()
+    assert match is not None
+    assert match.group(0).startswith('READY')
+
+def test_wait_for_returns_at_once_if_already_on_screen():
+    sink = TerminalSink()
+    _receive(sink, b'READY')
+    start = time.time()
+    assert sink.wait_for('READY', timeout=5) is not None
+    assert time.time() - start < 1
+
+def test_wait_for_times_out():
+    sink = TerminalSink()
+    _receive(sink, b'nothing to see')
+    start = time.time()
+    assert sink.wait_for('READY', timeout=0.2) is None
+    assert time.time() - start >= 0.2
+
+def test_concurrent_waiters_are_all_woken():
+    sink = TerminalSink()
+    results = {}
+
+    def wait(name, pattern):
+        start = time.time()
+        results[name] = (sink.wait_for(pattern, timeout=5), time.time() - start)
+
+    waiters = [
+        threading.Thread(target=wait, args=('first', 'first')),
+        threading.Thread(target=wait, args=('second', 'second')),
+    ]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.1)
+    _receive(sink, b'first\r\n')
+    time.sleep(0.1)
+    _receive(sink, b'second\r\n')
+    for waiter in waiters:
+        waiter.join()
+
+    for name in ('first', 'second'):
+        match, elapsed = results[name]
+        assert match is not None, name
+        assert elapsed < 2, '{0} woken after {1:.1f}s'.format(name, elapsed)
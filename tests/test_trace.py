@@ -0,0 +1,88 @@
+"""
+Round trip of instruction traces through TraceWriter and TraceReader.
+
+"""
+# Make py2 like py3
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import (  # pylint: disable=redefined-builtin, unused-import
+    bytes, dict, int, list, object, range, str,
+    ascii, chr, hex, input, next, oct, open,
+    pow, round, super,
+    filter, map, zip
+)
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from burisim.lib6502 import M6502
+from burisim.trace import (
+    MAX_CYCLES_DELTA, RECORD_DTYPE, InstructionHook, TraceReader, TraceWriter,
+)
+
+# A loop which runs through $FFFF to $0000 and writes memory
+_PROGRAM = {
+    0xFFF8: [0xEA, 0xEA, 0xE8, 0x9D, 0x00, 0x03, 0xEA, 0xEA],  # ...; INX; STA $0300,X; ...
+    0x0000: [0xEA, 0x4C, 0xF8, 0xFF],                           # NOP; JMP $FFF8
+}
+
+def _run(trace, ticks):
+    mpu = M6502()
+    for address, code in _PROGRAM.items():
+        mpu.write_memory(address, bytes(bytearray(code)))
+    mpu.registers.pc = 0xFFF8
+    mpu.target_freq = 0
+    mpu.set_trace(trace)
+    mpu.run(ticks)
+    mpu.set_trace(None)
+
+def _read(data):
+    with TraceReader(BytesIO(data)) as reader:
+        chunks = list(reader)
+    return chunks, np.concatenate(chunks)
+
+def _assert_records_equal(actual, expected):
+    assert len(actual) == len(expected)
+    for name in RECORD_DTYPE.names:
+        assert (actual[name] == expected[name]).all(), name
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(compress):
+    batches = []
+    hook = InstructionHook(lambda records: batches.append(records.copy()))
+    _run(hook.handle, 5000)
+    hook.flush()
+    expected = np.concatenate(batches)
+
+    fobj = BytesIO()
+    writer = TraceWriter(fobj, compress=compress, chunk_records=100)
+    _run(writer.handle, 5000)
+    writer.close()
+
+    chunks, records = _read(fobj.getvalue())
+    assert len(chunks) > 10
+    assert writer.records_written == len(records)
+    _assert_records_equal(records, expected)
+
+    # The program counter wrapped and memory was written
+    pcs = list(records['pc'])
+    assert any(a == 0xFFFF and b == 0x0000 for a, b in zip(pcs, pcs[1:]))
+    assert (records['access'] != 0).any()
+
+def test_large_cycle_gap_starts_a_chunk():
+    fobj = BytesIO()
+    writer = TraceWriter(fobj, compress=False)
+    cycles = [10, 12, 12 + MAX_CYCLES_DELTA, 20 + MAX_CYCLES_DELTA, 1 << 40, (1 << 40) + 3]
+    trace = writer.handle
+    for idx, c in enumerate(cycles):
+        trace.records[idx].cycles = c
+        trace.records[idx].pc = 0xFFFF if idx % 2 == 0 else 0x0000
+        trace.records[idx].opcode = 0xEA
+    trace.n = len(cycles)
+    writer.close()
+
+    chunks, records = _read(fobj.getvalue())
+    assert [len(c) for c in chunks] == [4, 2]
+    assert [int(c) for c in records['cycles']] == cycles
+    assert [int(pc) for pc in records['pc']] == [0xFFFF, 0x0000] * 3